@@ -8,10 +8,10 @@ Usage: (python) Eggnog_KEGG_KO_extracter.py input.emapper.annotations output_nam
 import sys
 import os
 
-#Generator function that reads file line by line, without reading the full file into memory
-def gen_line_reader(file_path):
-    for line in open(file_path, "r"):
-        yield line
+# The eggnog annotations are read with the shared reader of the KEGGstand scripts (header based KEGG_ko column lookup,
+# gzip/bz2 support)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "KEGGstand_publication_versionWIP", "KEGGstand_python_scripts"))
+from KEGGstand_eggnog_reader import iter_gene_kos
 
 #Obtain inputs
 eggnog_file = sys.argv[1]
@@ -22,17 +22,7 @@ else:
 out = open(outname, "w")
 
 #Read over EggNOG file, and write the KEGG KO terms per gene to the output
-for line in gen_line_reader(eggnog_file):
-    if line.startswith("#"):
-        continue
-    gene = line.split("\t")[0]
-    ko = line.split("\t")[11]
-    #!!!!A comma means there is multiple ko terms. BLASTkoala appears to only save the first one, so will do the same here
-    if ko == "-":
-        ko = ""
-    elif "," in ko: 
-        ko = ko.partition(",")[0]
-    ko = ko.replace("ko:", "")
+for gene, kos in iter_gene_kos(eggnog_file):
+    #!!!!Multiple ko terms per gene are possible. BLASTkoala appears to only save the first one, so will do the same here
+    ko = kos[0] if kos else ""
     out.write("{}\t{}\n".format(gene, ko))
-    
-                    
@@ -4,7 +4,8 @@ Parses the K number from an Eggnog .annotation file. Uses a database of KEGG mod
 all possible combinations of genes that complete the pathway. Using the parsed K number,
 checks which combination is most complete, and gives the highest completion per KEGG module.
 
-Usage: (python) KEGGstand_module_checker input.emapper.annotations Output_prefix path/to/KEGG_module_db
+Usage: (python) KEGGstand_module_checker input.emapper.annotations Output_prefix path/to/KEGG_module_db [max_searched_combinations]
+       (python) KEGGstand_module_checker --combinations path/to/KEGG_module_db Output_file
 
 Output:
 Writes a .tsv file following the name: *input.emapper.annotations*_KEGG_completion.tsv. 
@@ -17,6 +18,9 @@ and the k numbers of the genes that comprise this highest completion.
 
 import sys
 import os
+from collections import Counter
+from fractions import Fraction
+from operator import itemgetter
 
 ###################
 #File handling functions
@@ -67,6 +71,24 @@ def output_tsv(outputname, output_dict, minimum_completion):
                 out.write("None")
             out.write("\n")
     out.close()
+
+def output_combination_report(outputname, report):
+    """
+    Outputs a tsv containing per module (see combination_report) the number of combinations of genes, the number of
+    genes in the longest combination and in all combinations together, the bytes needed at least to list all
+    combinations, and the number of nodes of the definition as written and after sharing equal brackets.
+    """
+    #Every combination listed as a python list takes at least an empty list plus a pointer per gene
+    list_bytes = sys.getsizeof([])
+    pointer_bytes = sys.getsizeof([None]) - list_bytes
+    out = open(outputname, "w")
+    out.write("#Entry\tName\tCombinations\tLongest_combination\tGenes_in_all_combinations\tListing_bytes\tNodes\tUnique_nodes\n")
+    for modulename, statistics in report:
+        listing_bytes = statistics["combinations"] * list_bytes + statistics["total_genes"] * pointer_bytes
+        out.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(modulename.partition(" ")[0], modulename.partition(" ")[2],
+                  statistics["combinations"], statistics["longest"], statistics["total_genes"], listing_bytes,
+                  statistics["nodes"], statistics["unique_nodes"]))
+    out.close()
     
 def eggnog_parser(eggnog_path):
     """
@@ -94,337 +116,604 @@ def eggnog_parser(eggnog_path):
 #Functions for parsing KEGG definitions
 ###################  
 
+#The possible combinations of genes are not listed explicitly, since their number grows as the product of the
+#alternatives in a module. Instead the parsing functions build a tree of possibilities:
+#   ("gene", K term)              a single gene
+#   ("and", parts, slowest_first) every combination of one possibility per part, the genes in the order of the parts
+#   ("or", options)               the possibilities of every option, one after another
+#The combinations of an "and" are counted like digits: by default the first part changes fastest (as the brackets
+#were substituted by the original list based parser), with slowest_first the first part changes slowest. This keeps
+#the order of the combinations, and therefore which combination wins a tie, the same as before.
+
 #Wrapper for KEGG definition parsing
-def retrieve_all_possible_pathways(KEGG_definition):
+def build_possibility_tree(KEGG_definition):
     """
-    Finds the different possible combinations of genes that complete the module in the KEGG_definition
+    Returns the tree of the different possible combinations of genes that complete the module in the KEGG_definition
     """
-    final_list = [[]]
-    #The "for reaction" structure is required since sometimes KEGG gives 2 definitions for the same module. 
+    #The "for reaction" structure is required since sometimes KEGG gives 2 definitions for the same module.
     #It seems these are merging pathways required to for example generate substrates. Therefore, they will be treated as prerequisites for completion.
-    for reaction in KEGG_definition:
-        #Pluses and dashes are functionally the same
-        if " " in reaction:
-            reaction = reaction.replace(" ", "+")
-        #Minuses denote non-essential genes. They will be considered here for calculating the gene combinations
-        #but their absence will not count as pathway incompletion later. 
-        if "-" in reaction:
-            reaction = reaction.replace("-", "+")
-        #To deal with nested brackets, first find the possible combination WITHIN each bracket, so these
-        #can then be substituted into the appropriate brackets when parsing the complete definitions.
-        #These possible combinations are put into poss_dict
-        poss_dict = {}
-        if "(" in reaction:
-            #If there is brackets in the definition, first find the possibilities contained therein.
-            poss_dict = find_bracket_possibilities(reaction)
-        #Parse the different pathways
-        poss_list = parse_possibilities(reaction, poss_dict)
-        temp_list = []
-        for option in final_list:
-            for poss in poss_list:
-                new_option = option[:] + poss
-                temp_list.append(new_option)
-        final_list = temp_list[:]   
-    return final_list
-
-#Wrapper for parsing (nested) brackets
-def find_bracket_possibilities(KEGG_definition):
-    """
-    Finds all (nested) brackets, and iterates through each level of brackets to find the possibilties.
-    Returns a completed dictionary of possibilities for the lowest level of brackets, which can be used to 
-    analyze the KEGG_definition
-    """
-    #Finds the brackets and their level of nestedness
-    brackets_list = find_bracket_contents(KEGG_definition)
-    #Find the highest level of nested brackets
-    highest = 0
-    for element in brackets_list:
-        if element[0] > highest:
-            highest = element[0]
-    poss_dict = {}
-    #Iterate over each bracket level
-    #For each bracket, make a list of lists representing each possible option and store them in the poss_dict
-    for level in reversed(range(highest+1)):
-        #iterate over each bracket pair in the KEGG definition
-        for bracket_pair in brackets_list:
-            #starting at the highest level of brackets, start searching for options
-            if bracket_pair[0] == level:
-                poss_dict["({})".format(bracket_pair[1])] = parse_possibilities(bracket_pair[1],poss_dict)
-    return poss_dict
-
-#Main parsing function    
-def parse_possibilities(string, poss_dict):
-    """
-    Returns a list of lists, representing the options possible in the string
-    according to the KEGG definitions. 
-    
-    Utilizes the poss_dict to resolve brackets
-    """
-    #To prevent parsing mistakes, replace brackets with empty brackets.
-    #The removed contents of the brackets are present in the bracket_list,
-    #in the order that they occur in the string
-    bracket_list = []
-    if "(" in string:
-        string, bracket_list  = empty_brackets(string)
-    #If the string has commas in it, it is a bracketed substring. Comma's will take priority
-    #over plusses and spaces, and will thus be considered first    
-    if "," in string:
-        option_list = []
-        for alternative in string.split(","):
-            if alternative == "":
-                continue
-            elif "+" in alternative:
-                poss_list = parse_pluses(alternative, bracket_list, poss_dict)
-                #Since considered parts are separated by commas, each combination in the poss_list here 
-                #denotes a branching path ALTERNATIVE to the other parts of the string being parsed here.
-                #Therefore, add each possibility as a separate one to the option_list
-                for poss in poss_list:
-                    option_list.append(poss)     
-            elif alternative == "()":
-                #Again, since this is in a comma string, each possibility is an entirely different option
-                bracket_possibilities = parse_bracket_possibilities(bracket_list.pop(0), poss_dict)
-                for poss in bracket_possibilities:
-                    option_list.append(poss)     
-            #If there is only spaces, simply add the genes to existing options
-            else:
-                option_list.append([alternative])
-    #If there is no commas in the string, then it is only comprised of additions.
-    #simply add each addition, and add the options contained in each bracket
-    else:
-        option_list = [[]]
-        for addition in string.split("+"):
-            if addition == "":
-                continue
-            elif addition == "()":
-                poss_list = parse_bracket_possibilities(bracket_list.pop(0), poss_dict)
-                temp_list = []
-                for poss in poss_list:
-                    for option in option_list:
-                        new_option = option[:]
-                        for item in poss:
-                            new_option.append(item)   
-                        temp_list.append(new_option)
-                option_list = temp_list[:]        
-            #If there is only spaces, simply add the genes to existing options
-            else:
-                if len(option_list) == 0:
-                    option_list = []
-                for option in option_list:
-                    option.append(addition)
-    return option_list
+    return ("and", [possibility_tree(parse_definition(reaction), {}) for reaction in KEGG_definition], True)
 
-#Secondary functions    
-def parse_pluses(plus_string, bracket_list, poss_dict):
+def retrieve_all_possible_pathways(KEGG_definition, max_combinations=None):
     """
-    Parses a plus-containing substring found in brackets, or between 
-    comma's. 
-    
-    Returns a list of lists where each nested list represents a possible combination
-    of genes following the KEGG definition
-    """
-    out_list = [[]]
-    for part in plus_string.split("+"):
-        #If a part of the pluses are brackets, remove them and add the possibilities contained
-        if part == "()":
-            bracket_possibilities = parse_bracket_possibilities(bracket_list.pop(0), poss_dict)
-            temp_list = []
-            for poss in bracket_possibilities:
-                for option in out_list:
-                    new_option = option[:]
-                    for item in poss:
-                        new_option.append(item)   
-                    temp_list.append(new_option)
-            out_list = temp_list[:]        
-        #If there is no brackets, simply add each part of the chain of pluses as a an addition to the existing combinations
-        else:
-            temp_list = []
-            for option in out_list:
-                new_option = option[:]
-                new_option.append(part)   
-                temp_list.append(new_option)
-            out_list = temp_list[:]   
-    return out_list
+    Generator of the different possible combinations of genes that complete the module in the KEGG_definition.
+    Raises a ValueError if there are more than max_combinations combinations
+    """
+    tree = build_possibility_tree(KEGG_definition)
+    if max_combinations is not None and count_combinations(tree, {})[0] > max_combinations:
+        raise ValueError("{} has {} combinations, more than {}".format(KEGG_definition, count_combinations(tree, {})[0], max_combinations))
+    return iter_combinations(tree)
 
-def find_bracket_pairs(string):
+def iter_combinations(tree):
     """
-    Returns a dictionary for each bracket pair, where the first bracket
-    is the dict key, and the second is the value
+    Yields every combination of genes of a possibility tree as a list, one at a time
     """
-    match_bracket_index_dict = {}
-    stack_list = []
-    for index, char in enumerate(string):
-        if char == "(":
-            stack_list.append(index)
-        elif char == ")":
-            match_bracket_index_dict[stack_list.pop()] = index
-    return dict(sorted(match_bracket_index_dict.items()))
-    #return match_bracket_index_dict
+    if tree[0] == "gene":
+        yield [tree[1]]
+    elif tree[0] == "or":
+        for option in tree[1]:
+            yield from iter_combinations(option)
+    else:
+        parts = tree[1]
+        #Iterate over the part that changes slowest in the outer loop
+        order = list(range(len(parts))) if tree[2] else list(reversed(range(len(parts))))
+        def combine(i, chosen):
+            if i == len(order):
+                yield [gene for part_index in range(len(parts)) for gene in chosen[part_index]]
+                return
+            for combination in iter_combinations(parts[order[i]]):
+                chosen[order[i]] = combination
+                yield from combine(i + 1, chosen)
+        yield from combine(0, [None] * len(parts))
 
-def find_bracket_contents(string):
+def count_combinations(tree, counts):
     """
-    returns a list of tuples for each bracket pair in the string.
-    Each tuple contains (bracket nestedness level, bracket contents).
+    Number of combinations of a tree and the number of genes in its first combination.
+    counts caches the result per node, since brackets with equal contents share their node
     """
-    stack = []
-    bracket_list = []
-    out_dict = {}
-    for index, char in enumerate(string):
-        if char == '(':
-            stack.append(index)
-        elif char == ')' and stack:
-            start = stack.pop()
-            bracket_list.append((len(stack), string[start + 1: index]))
-    return bracket_list
-
-def parse_bracket_possibilities(bracket_string, poss_dict):
-    """
-    If brackets are found, tries to find them in the poss_dict to give 
-    the options they represent. The options are not added to an option list
-    since from the brackets itself its impossible to tell if it is an addition or
-    a branch.
-    """
-    if bracket_string in poss_dict:
-        return poss_dict[bracket_string]
+    if id(tree) in counts:
+        return counts[id(tree)]
+    if tree[0] == "gene":
+        res = (1, 1)
+    elif tree[0] == "or":
+        number, first_len = 0, 0
+        for option in tree[1]:
+            option_number, option_first_len = count_combinations(option, counts)
+            if number == 0:
+                first_len = option_first_len
+            number += option_number
+        res = (number, first_len)
     else:
-        print("Error, could not find {} in poss_dict".format(bracket_string))
+        number, first_len = 1, 0
+        for part in tree[1]:
+            part_number, part_first_len = count_combinations(part, counts)
+            number *= part_number
+            first_len += part_first_len
+        res = (number, first_len if number else 0)
+    counts[id(tree)] = res
+    return res
 
-def empty_brackets(string):
+def combination_statistics(tree, counts, statistics):
     """
-    Returns the provided string, but with the brackets replaced with empty brackets. In addition, 
-    returns a list containing the removed bracketed contents, so these can be retrieved later from 
-    the poss_dict
-    
-    Only considers the lowest level of bracket present, assuming nested brackets are already included in 
-    its possibilities
+    Sizes of the combinations of a tree without listing them: (number of genes in all combinations together, number
+    of genes in the longest combination, number of nodes of the tree as written). statistics caches the result per node
     """
-    out_list = []
-    #Make dictionary of bracket pairs
-    bracket_dict = find_bracket_pairs(string)
-    #Only consider the lowest level of brackets, ignoring any nested ones
-    lowest_list = []
-    for key in bracket_dict:
-        lower_exists = False
-        for key2 in bracket_dict:
-            if key > key2 and bracket_dict[key] < bracket_dict[key2]:
-                lower_exists = True
-        if not lower_exists:
-            lowest_list.append(key)
-    #Store the lowest brackets in the out_list, so they can be called later
-    for key in lowest_list:
-        out_list.append(string[key:bracket_dict[key]+1])
-    #Replace the lowest level brackets with empty brackets
-    for key in reversed(lowest_list):
-        string = string.replace(string[key:bracket_dict[key]+1], "()")
-    return string, out_list
+    if id(tree) in statistics:
+        return statistics[id(tree)]
+    if tree[0] == "gene":
+        res = (1, 1, 1)
+    else:
+        number = count_combinations(tree, counts)[0]
+        total, longest, nodes = 0, 0, 1
+        for child in tree[1]:
+            child_number = count_combinations(child, counts)[0]
+            child_total, child_longest, child_nodes = combination_statistics(child, counts, statistics)
+            nodes += child_nodes
+            if tree[0] == "or":
+                total += child_total
+                if child_number:
+                    longest = max(longest, child_longest)
+            else:
+                #Every combination of a part occurs once with every combination of the other parts
+                if child_number:
+                    total += child_total * (number // child_number)
+                longest += child_longest
+        res = (total, longest if number else 0, nodes)
+    statistics[id(tree)] = res
+    return res
+
+#Main parsing function
+def parse_definition(KEGG_definition):
+    """
+    Parses a single KEGG definition in one pass over its characters, into a list of alternatives (separated by commas).
+    Each alternative is a list of steps (separated by pluses, spaces or minuses), and each step a tuple of
+    (K term or bracket, where "" is an empty step, whether the step follows a minus).
+    A bracket is a tuple of ("bracket", its alternatives, its text, its text up to the first closing bracket inside it)
+    """
+    alternatives = [[]]
+    step = ""
+    after_minus = False
+    #The start, the enclosing alternatives and the minus flag of every open bracket, the open brackets not followed
+    #by any closing bracket yet, and the first closing bracket after every opening bracket
+    open_brackets = []
+    not_closed = []
+    first_closing = {}
+    for index, char in enumerate(KEGG_definition):
+        if char in "+ -,)":
+            alternatives[-1].append((step, after_minus))
+            step = ""
+            after_minus = char == "-"
+            if char == ",":
+                alternatives.append([])
+            elif char == ")":
+                if not open_brackets:
+                    raise ValueError("Unmatched closing bracket at position {} of {}".format(index, KEGG_definition))
+                for start in not_closed:
+                    first_closing[start] = index
+                not_closed = []
+                start, outer_alternatives, after_minus = open_brackets.pop()
+                step = ("bracket", alternatives, KEGG_definition[start:index + 1],
+                        KEGG_definition[start:first_closing[start]].strip("("))
+                alternatives = outer_alternatives
+        elif char == "(":
+            if step != "":
+                raise ValueError("Missing separator before the bracket at position {} of {}".format(index, KEGG_definition))
+            open_brackets.append((index, alternatives, after_minus))
+            not_closed.append(index)
+            alternatives = [[]]
+            after_minus = False
+        else:
+            if not isinstance(step, str):
+                raise ValueError("Missing separator after the bracket at position {} of {}".format(index, KEGG_definition))
+            step += char
+    if open_brackets:
+        raise ValueError("Unmatched opening bracket at position {} of {}".format(open_brackets[-1][0], KEGG_definition))
+    alternatives[-1].append((step, after_minus))
+    return alternatives
+
+def possibility_tree(alternatives, brackets):
+    """
+    Returns the possibility tree of parsed alternatives (see parse_definition). Brackets with the same text share
+    their tree, which brackets caches
+    """
+    #Pluses, spaces and minuses are functionally the same. Minuses denote non-essential genes. They will be considered
+    #here for calculating the gene combinations, but their absence will not count as pathway incompletion later.
+    #If there are several alternatives, each is a branching path ALTERNATIVE to the others
+    if len(alternatives) > 1:
+        option_list = []
+        for steps in alternatives:
+            if len(steps) > 1:
+                #Every combination of the steps is an option. Empty steps (between double minuses) are kept as an empty gene
+                option_list.append(("and", [step_tree(step, brackets) for step, after_minus in steps], False))
+            elif steps[0][0] != "":
+                option_list.append(step_tree(steps[0][0], brackets))
+        return ("or", option_list)
+    #If there is a single alternative, it is only comprised of additions
+    return ("and", [step_tree(step, brackets) for step, after_minus in alternatives[0] if step != ""], False)
+
+def step_tree(step, brackets):
+    """
+    Returns the possibility tree of a single step: a gene, or the shared tree of a bracket
+    """
+    if isinstance(step, str):
+        return ("gene", step)
+    if step[2] not in brackets:
+        brackets[step[2]] = possibility_tree(step[1], brackets)
+    return brackets[step[2]]
 
 def non_essential_finder(KEGG_definition):
     """
     In KEGG definitions, minuses denote non-essential genes. These will be parsed here, and returned as a list.
     """
+    return non_essential_genes(parse_definition(KEGG_definition))
+
+def non_essential_genes(alternatives):
+    """
+    Returns the non-essential genes of parsed alternatives (see parse_definition) as a list, in the order of the definition
+    """
     out_list = []
-    if "-" in KEGG_definition:
-        #Find all minuses in the string
-        i = 0
-        minus_indices = []
-        while i < len(KEGG_definition):
-            if KEGG_definition[i] == "-":
-                minus_indices.append(i)
-            i+= 1
-        #Find the genes after the minus, counting multiple if they are bracketed. 
-        for i in minus_indices:
-            string = KEGG_definition[i+1:]
-            #If the minus is followed by brackets, inside are all non-essential genes
-            if string.startswith("("):
-                string = string.partition(")")[0].strip("(")
-                splt = string.split(",")
-                for comma_split in splt:
+    for steps in alternatives:
+        for step, after_minus in steps:
+            if isinstance(step, str):
+                #A gene following a minus is non-essential. Several instances of double minuses exist, such as M00814,
+                #M00840 or M00890. Their meaning is unclear, only the gene after the second minus is counted
+                if after_minus and step.strip():
+                    out_list.append(step)
+                continue
+            #If the minus is followed by brackets, inside are all non-essential genes (up to the first closing bracket)
+            if after_minus:
+                for comma_split in step[3].split(","):
                     for plus_split in comma_split.split("+"):
                         out_list.append(plus_split)
-            #Several instances of double minuses exist, such as M00814, M00840 or M00890.
-            #Their meaning is unclear, but they do not seem to denote non-essential genes
-            elif string.startswith("-"):
-                continue
-            #If it is not followed by brackets or minus, simply take the gene following the minus
-            else:
-                string = string.partition("+")[0].partition(",")[0].partition(" ")[0].partition("(")[0].partition(")")[0].partition("-")[0]
-                if string.strip():
-                    out_list.append(string)
+            out_list.extend(non_essential_genes(step[1]))
     return out_list
     
 ###################
 #Analysis wrapper function 
 ###################   
 
-def pathway_completion_checker(KEGG_dict, kterms_list):
+def first_occurrences(tree, module):
+    """
+    Returns for every non-essential gene in the tree the position of its first occurrence when the combinations are
+    listed in order: (index of the first combination containing the gene, index of the gene in that combination)
+    """
+    counts = module["counts"]
+    number, first_len = count_combinations(tree, counts)
+    if number == 0 or tree_genes(tree, module["node_genes"]).isdisjoint(module["non_essential_set"]):
+        return {}
+    if tree[0] == "gene":
+        return {tree[1]: (0, 0)}
+    occurrences = {}
+    if tree[0] == "or":
+        offset = 0
+        for option in tree[1]:
+            for gene, (index, position) in first_occurrences(option, module).items():
+                if gene not in occurrences or (offset + index, position) < occurrences[gene]:
+                    occurrences[gene] = (offset + index, position)
+            offset += count_combinations(option, counts)[0]
+        return occurrences
+    parts = tree[1]
+    #The first combination containing a gene of a part has all other parts at their first combination
+    stride = 1
+    strides = [0] * len(parts)
+    for part_index in (range(len(parts)) if not tree[2] else reversed(range(len(parts)))):
+        strides[part_index] = stride
+        stride *= count_combinations(parts[part_index], counts)[0]
+    prefix = 0
+    for part_index, part in enumerate(parts):
+        for gene, (index, position) in first_occurrences(part, module).items():
+            occurrence = (index * strides[part_index], prefix + position)
+            if gene not in occurrences or occurrence < occurrences[gene]:
+                occurrences[gene] = occurrence
+        prefix += count_combinations(part, counts)[1]
+    return occurrences
+
+def tree_genes(tree, node_genes):
+    #Frozenset of the genes of a tree, stored per node in node_genes
+    if id(tree) in node_genes:
+        return node_genes[id(tree)]
+    if tree[0] == "gene":
+        res = frozenset([tree[1]])
+    else:
+        res = frozenset().union(*(tree_genes(child, node_genes) for child in tree[1]))
+    node_genes[id(tree)] = res
+    return res
+
+def all_genes(tree):
+    #Set of the genes of a tree, without storing the genes of every node
+    genes = set()
+    seen = set()
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if node[0] == "gene":
+            genes.add(node[1])
+        else:
+            stack.extend(node[1])
+    return genes
+
+def prepare_module(KEGG_definition, share_profiles=True):
+    """
+    Prepares what every sample needs of a module: the possibility tree with the number of combinations per node, and
+    the essential and non-essential genes of the module as frozensets. The rest (the genes per node, the first
+    occurrence of every non-essential gene and the statistics of the combinations) is added to the module when first
+    needed, see module_occurrences, non_essential_repeated and module_statistics. With share_profiles the profiles of
+    parts without genes of a sample are kept for the next samples. Returns the module as a dictionary
+    """
+    #Every reaction is parsed once, for both its possibility tree and its non-essential genes
+    parsed_reactions = [parse_definition(reaction) for reaction in KEGG_definition]
+    non_essential_list = [gene for alternatives in parsed_reactions for gene in non_essential_genes(alternatives)]
+    tree = ("and", [possibility_tree(alternatives, {}) for alternatives in parsed_reactions], True)
+    module = {"tree": tree, "counts": {}, "node_genes": {}, "shapes": {} if share_profiles else None,
+              "non_essential_set": frozenset(non_essential_list), "non_essential_counts": Counter(non_essential_list)}
+    count_combinations(tree, module["counts"])
+    module["essential_genes"] = frozenset(all_genes(tree) - module["non_essential_set"])
+    return module
+
+def module_occurrences(module):
+    #First occurrence of every non-essential gene of a prepared module (see first_occurrences)
+    if "occurrences" not in module:
+        module["occurrences"] = first_occurrences(module["tree"], module)
+    return module["occurrences"]
+
+def non_essential_repeated(module):
+    #Whether a combination of a prepared module can hold a non-essential gene more often than it is listed
+    if "non_essential_repeated" not in module:
+        module["non_essential_repeated"] = bool(module["non_essential_set"]) and \
+            bool(non_essential_occurrences(module["tree"], module, {}) - module["non_essential_counts"])
+    return module["non_essential_repeated"]
+
+def module_statistics(module):
+    #Statistics of the combinations of a prepared module (see combination_statistics)
+    if "statistics" not in module:
+        statistics = {}
+        total_genes, longest, nodes = combination_statistics(module["tree"], module["counts"], statistics)
+        module["statistics"] = {"combinations": count_combinations(module["tree"], module["counts"])[0], "longest": longest,
+                                "total_genes": total_genes, "nodes": nodes, "unique_nodes": len(statistics)}
+    return module["statistics"]
+
+def completion_profile(tree, module, present_set, profiles):
+    """
+    Returns a dictionary of number of essential genes -> most present essential genes, over the combinations
+    of a tree. Used to bound the completion that the parts of a combination not chosen yet can still reach
+    """
+    if id(tree) in profiles:
+        return profiles[id(tree)]
+    if module["shapes"] is not None and profiles is not module["shapes"] and \
+            tree_genes(tree, module["node_genes"]).isdisjoint(present_set):
+        #None of the genes of the node are present, so its profile is the same for every sample
+        return completion_profile(tree, module, frozenset(), module["shapes"])
+    if tree[0] == "gene":
+        if tree[1] in module["non_essential_set"]:
+            res = {0: 0}
+        else:
+            res = {1: int(tree[1] in present_set)}
+    elif tree[0] == "or":
+        res = {}
+        for option in tree[1]:
+            if count_combinations(option, module["counts"])[0] == 0:
+                continue
+            for essential, present in completion_profile(option, module, present_set, profiles).items():
+                if present > res.get(essential, -1):
+                    res[essential] = present
+    else:
+        res = {0: 0}
+        for part in tree[1]:
+            res = combine_profiles(res, completion_profile(part, module, present_set, profiles))
+    profiles[id(tree)] = res
+    return res
+
+def combine_profiles(profile1, profile2):
+    #Profile of a combination of both
+    res = {}
+    for essential1, present1 in profile1.items():
+        for essential2, present2 in profile2.items():
+            if present1 + present2 > res.get(essential1 + essential2, -1):
+                res[essential1 + essential2] = present1 + present2
+    return res
+
+def todo_profile(todo, module, present_set, profiles):
+    """
+    Profile of the nodes still to choose. todo is a linked list [node, position, next, profile], so states
+    share the tail of their list, and with it the profile of that tail
+    """
+    if todo is None:
+        return {0: 0}
+    if todo[3] is None:
+        todo[3] = combine_profiles(completion_profile(todo[0], module, present_set, profiles),
+                                   todo_profile(todo[2], module, present_set, profiles))
+    return todo[3]
+
+def non_essential_occurrences(tree, module, occurrences):
+    #Most occurrences of each non-essential gene in one combination of the tree
+    if id(tree) in occurrences:
+        return occurrences[id(tree)]
+    res = Counter()
+    if tree[0] == "gene":
+        if tree[1] in module["non_essential_set"]:
+            res[tree[1]] = 1
+    elif not tree_genes(tree, module["node_genes"]).isdisjoint(module["non_essential_set"]):
+        for child in tree[1]:
+            if tree[0] == "and":
+                res += non_essential_occurrences(child, module, occurrences)
+            elif count_combinations(child, module["counts"])[0] > 0:
+                res |= non_essential_occurrences(child, module, occurrences)
+    occurrences[id(tree)] = res
+    return res
+
+def highest_weight(tree, weights, counts, highest):
+    #Highest sum of the gene weights over the combinations of a tree
+    if id(tree) in highest:
+        return highest[id(tree)]
+    if tree[0] == "gene":
+        res = weights(tree[1])
+    elif tree[0] == "or":
+        res = max(highest_weight(option, weights, counts, highest) for option in tree[1]
+                  if count_combinations(option, counts)[0] > 0)
+    else:
+        res = sum(highest_weight(part, weights, counts, highest) for part in tree[1])
+    highest[id(tree)] = res
+    return res
+
+def score_combination(chosen, module, present_set):
+    """
+    Scores a combination, given as (position, gene) pairs, as when scoring the full list of combinations.
+    Returns (completion, present essential genes)
+    """
+    combination = [gene for position, gene in sorted(chosen, key=itemgetter(0))]
+    gene_is_present = [gene for gene in combination if gene in present_set]
+    #Non-essential genes do not count towards the size of the combination, as often as they are listed
+    removed = sum((Counter(combination) & module["non_essential_counts"]).values())
+    return len(gene_is_present) / (len(combination) - removed), gene_is_present
+
+def find_best_combination(module, present_set, max_searched_combinations=None):
+    """
+    Finds the most complete combination of a prepared module, given the set of its essential genes present in the
+    sample. Of equally complete combinations the first one wins, as when scoring every combination in order.
+    Modules with more than max_searched_combinations combinations are never searched in order (see README).
+    Returns (highest completion, present essential genes of that combination), or None if there is no combination.
+    """
+    tree, counts = module["tree"], module["counts"]
+    if count_combinations(tree, counts)[0] == 0:
+        return None
+    profiles = {}
+    profile = completion_profile(tree, module, present_set, profiles)
+    scale = None
+    if 0 in profile or non_essential_repeated(module):
+        if max_searched_combinations is None or count_combinations(tree, counts)[0] <= max_searched_combinations:
+            return search_best_combination(module, present_set, profiles)
+        #Too many combinations to search. Combinations without essential genes cannot be scored and are skipped, and
+        #the completion is taken as present/essential. Of equally complete combinations the one with the most
+        #essential genes wins, which the scale (larger than any number of genes in a combination) takes care of
+        profile = {essential: present for essential, present in profile.items() if essential}
+        if not profile:
+            #No combination has essential genes, so there is nothing to complete
+            return 0.0, []
+        scale = module_statistics(module)["longest"] + 1
+    #Every combination has essential genes, and no non-essential gene more often than it is listed, so the completion
+    #of a combination is present/essential and the highest completion follows from the profile. The first combination
+    #reaching it is the first one with the highest present * best_essential - essential * best_present
+    best_essential, best_present = max(profile.items(), key=lambda item: Fraction(item[1], item[0]))
+    non_essential_set = module["non_essential_set"]
+    def weights(gene):
+        if gene in non_essential_set:
+            return 0
+        if scale is None:
+            return (gene in present_set) * best_essential - best_present
+        return ((gene in present_set) * best_essential - best_present) * scale + 1
+    highest = {}
+    chosen = []
+    stack = [(tree, ())]
+    while stack:
+        node, position = stack.pop()
+        if node[0] == "gene":
+            chosen.append((position, node[1]))
+        elif node[0] == "and":
+            stack.extend((part, position + (part_index,)) for part_index, part in enumerate(node[1]))
+        else:
+            #Every part of a combination is at its own first best combination
+            node_highest = highest_weight(node, weights, counts, highest)
+            for option in node[1]:
+                if count_combinations(option, counts)[0] > 0 and highest_weight(option, weights, counts, highest) == node_highest:
+                    stack.append((option, position))
+                    break
+    return score_combination(chosen, module, present_set)
+
+def search_best_combination(module, present_set, profiles):
+    """
+    Searches the combinations of a prepared module in order for the most complete one. Combinations are chosen part
+    by part, and a branch is skipped as soon as even its best case cannot beat the best completion found so far.
+    """
+    non_essential_set, counts = module["non_essential_set"], module["counts"]
+    highest_completion = -1
+    best_pathway = []
+    #Every state holds the nodes still to choose (most significant first, with their position in the combination),
+    #the chosen genes with their position, and the present and essential gene counts of the chosen genes
+    stack = [([module["tree"], (), None, None], (), 0, 0)]
+    while stack:
+        todo, chosen, present, essential = stack.pop()
+        #The completion of a combination is at most present/essential, since non-essential genes are not counted.
+        #Combinations of only non-essential genes are always visited, since scoring them can fail as before
+        highest_possible = 0
+        for todo_essential, todo_present in todo_profile(todo, module, present_set, profiles).items():
+            if essential + todo_essential == 0:
+                highest_possible = float("inf")
+                break
+            highest_possible = max(highest_possible, (present + todo_present) / (essential + todo_essential))
+        if highest_completion >= highest_possible:
+            continue
+        while todo is not None and todo[0][0] == "gene":
+            gene = todo[0][1]
+            chosen += ((todo[1], gene),)
+            if gene not in non_essential_set:
+                essential += 1
+                present += gene in present_set
+            todo = todo[2]
+        if todo is None:
+            completion, gene_is_present = score_combination(chosen, module, present_set)
+            if completion > highest_completion:
+                highest_completion = completion
+                best_pathway = gene_is_present
+            continue
+        node, position, rest = todo[0], todo[1], todo[2]
+        if node[0] == "and":
+            parts = list(enumerate(node[1]))
+            if node[2]:
+                parts.reverse()
+            #The list is built from its end, so the most significant part comes first
+            for part_index, part in parts:
+                rest = [part, position + (part_index,), rest, None]
+            stack.append((rest, chosen, present, essential))
+        else:
+            #Push the options in reverse, so the first option is searched first
+            for option in reversed(node[1]):
+                if count_combinations(option, counts)[0] > 0:
+                    stack.append(([option, position, rest, None], chosen, present, essential))
+    return highest_completion, best_pathway
+
+def prepare_modules(KEGG_dict):
+    """
+    Prepares every module of the KEGG_dict (see prepare_module), so they can be scored for any number of samples.
+    Only worth it for several samples: pathway_completion_checker prepares the modules for a single sample itself.
+    Returns a dictionary with the KEGG module name as key and the prepared module as value
+    """
+    return {module_name: prepare_module(KEGG_dict[module_name]) for module_name in KEGG_dict}
+
+def combination_report(KEGG_dict, prepared_modules=None):
+    """
+    Returns a list of (KEGG module name, statistics of its combinations) for every module, the module with the
+    most combinations first. The combinations are counted without listing them (see combination_statistics)
+    """
+    if prepared_modules is None:
+        prepared_modules = prepare_modules(KEGG_dict)
+    report = [(module_name, module_statistics(prepared_modules[module_name])) for module_name in KEGG_dict]
+    report.sort(key=lambda item: item[1]["combinations"], reverse=True)
+    return report
+
+def pathway_completion_checker(KEGG_dict, kterms_list, prepared_modules=None, max_searched_combinations=None):
     """
     Uses several functions to find all potential combinations of genes that complete a KEGG module.
     Then find which of those combinations is most complete for the given genes in kterms_list.
-    
+    The modules are prepared first, unless already prepared with prepare_modules. Modules with more than
+    max_searched_combinations combinations are never searched in order (see find_best_combination).
+
     Returns a dictionary with the KEGG module name as key, and a tuple as value. The tuple
     contains the highest completion value found (as a 0-1 float),the combination of genes
     amounting to that completion as a list, and a list genes missing from the pathway that were still
     included during completion calculation because they were non-essential: (0.5, [gene1,gene2,gene3], [gene2])
     """
     out_dict = {}
-    #Make a dictionary containing lists of all non-essential genes per module
-    non_essential_dict = {}
-    for module_name in KEGG_dict:
-        for reaction in KEGG_dict[module_name]:
-            #Since there can be multiple reactions, check if the dictionary entry already exists, if so append to it
-            if module_name in non_essential_dict:
-                for i in non_essential_finder(reaction):
-                    non_essential_dict[module_name].append(i)
-            else:
-                non_essential_dict[module_name] = non_essential_finder(reaction)
-    #Make a dictionary containing all the possible combinations of genes to complete the pathway
-    for module_name in KEGG_dict:
-        possible_combinations = retrieve_all_possible_pathways(KEGG_dict[module_name])
-        if possible_combinations != [[]]:
-            KEGG_dict[module_name] = possible_combinations
-    #Iterate over the dictionary to check every pathway
+    kterms_set = frozenset(kterms_list)
+    if prepared_modules is None:
+        #Scored for this sample only, so nothing is kept for other samples
+        prepared_modules = {module_name: prepare_module(KEGG_dict[module_name], share_profiles=False) for module_name in KEGG_dict}
+    #Iterate over the modules, searching the possible combinations of genes of each for the most complete one
     for module_name in KEGG_dict:
-        #Iterate over each possible combinations, to check which is most complete
-        highest_completion = -1
-        best_pathway = []
+        module = prepared_modules[module_name]
+        if count_combinations(module["tree"], module["counts"]) == (1, 0):
+            #A definition without any genes. Scored as a combination of its characters, none of which are present
+            if KEGG_dict[module_name]:
+                out_dict[module_name] = (0 / len(KEGG_dict[module_name][0]), [], [])
+            continue
+        best = find_best_combination(module, module["essential_genes"] & kterms_set, max_searched_combinations)
+        if best is None:
+            continue
+        #Any non-essential gene associated with the module is mentioned in the output if it was found to be present in the organism,
+        #in the order in which they occur in the combinations
         non_essential_found = []
-        for combination in KEGG_dict[module_name]:
-            gene_is_present = []
-            #Check for each gene in the combination if it non-essential and if it is present in the tested organism
-            for gene in combination:
-                #If the gene is non-essential it will not be counted towards the completion of the combination
-                #While not factored into the calculation, any non-essential gene associated with the module will be mentioned in the output if it was found to be present in the organism
-                if gene in non_essential_dict[module_name]:
-                    if gene in kterms_list and gene not in non_essential_found:
-                        non_essential_found.append(gene)
-                else: 
-                    if gene in kterms_list:
-                        gene_is_present.append(gene)
-            #To accurately calculate the completion of essential genes, non-essential genes are removed from the combination
-            for gene in non_essential_dict[module_name]:
-                if gene in combination:
-                    combination.remove(gene)
-            number_of_genes = len(combination)
-            completion = len(gene_is_present)/number_of_genes
-            if completion > highest_completion:
-                highest_completion = completion
-                best_pathway = gene_is_present[:]
-                out_dict[module_name] = (highest_completion, best_pathway, non_essential_found)
+        if not module["non_essential_set"].isdisjoint(kterms_set):
+            occurrences = module_occurrences(module)
+            non_essential_found = sorted(occurrences.keys() & module["non_essential_set"] & kterms_set, key=occurrences.get)
+        out_dict[module_name] = (best[0], best[1], non_essential_found)
     return out_dict
     
 ####################################################################
 #MAIN
 ####################################################################    
-if __name__ == "__main__":
+if __name__ == "__main__" and sys.argv[1] == "--combinations":
+    #Only report the number of combinations of every module, to size the memory and time needed before running
+    KEGG_dict = KEGG_module_reader(sys.argv[2])
+    report = combination_report(KEGG_dict)
+    output_combination_report(sys.argv[3], report)
+    print("Modules with the most combinations:")
+    for modulename, statistics in report[:10]:
+        print("{}\t{} combinations, longest {} genes".format(modulename.partition(" ")[0], statistics["combinations"], statistics["longest"]))
+elif __name__ == "__main__":
     #Obtain inputs
     eggnog_input = sys.argv[1]
     outprefix= sys.argv[2]
     KEGG_db = sys.argv[3]
+    #Optionally, the most combinations a module can have to be searched in order
+    max_searched_combinations = int(sys.argv[4]) if len(sys.argv) > 4 else None
     #Read in the KEGG module DB
     KEGG_dict = KEGG_module_reader(KEGG_db)
     #Parse out the K terms from eggnog output_name
     kterms_list = eggnog_parser(eggnog_input)
     #Check per pathway how complete it is based on the eggnog K terms
-    completion_dict = pathway_completion_checker(KEGG_dict, kterms_list)
+    completion_dict = pathway_completion_checker(KEGG_dict, kterms_list, max_searched_combinations=max_searched_combinations)
     #Output the found completion
     output_tsv(outprefix + "_KEGG_completion.tsv",completion_dict, 0)
     output_tsv(outprefix + "_KEGG_complete_modules.tsv",completion_dict, 1)
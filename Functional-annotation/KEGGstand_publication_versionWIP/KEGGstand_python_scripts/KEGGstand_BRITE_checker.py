@@ -11,52 +11,66 @@ Writes a tab-delimited file that lists each KEGG category along with its subcate
 a tab, the number of genes found for the (sub)category is given, along with the total number of
 genes known for this category.
 """
-from typing import List, Tuple, Set, Dict
+from typing import Iterable, Iterator, List, Tuple, Set, Optional
 import re
 import json
+import cProfile
+import platform
+from datetime import datetime
 from pathlib import Path
 import argparse
 import networkx as nx
+import numpy as np
 import pandas as pd
 
+from KEGGstand_eggnog_reader import read_ko_set
+from KEGGstand_batch_inputs import collect_batch_inputs, get_sample_name
+from KEGGstand_brite_hierarchy import BriteHierarchy, compile_brite_hierarchy, default_cache_path, file_stamp, hash_kterm_json, \
+    load_brite_hierarchy, save_brite_hierarchy
+from KEGGstand_profiling import PhaseProfiler, profile_phase, sidecar_path, write_json
 
-def gen_line_reader(file_path):
-    """
-    Generator function that allows reading a text file line
-    by line, without reading the full file into memory
-    """
-    for line in open(file_path, "r"):
-        yield line
 
-
-def eggnog_parser(eggnog_path):
+def iter_kterm_json(json_path, chunk_size: int = 1 << 20) -> Iterator[dict]:
     """
-    Parses an eggnog.annotations output file. Returns a list of all the found k terms.
+    Yields the entries of a k terms json file one at a time, so the file is never held in memory as a whole. The file
+    is either a json list of entries (as written by convert_kterms_to_json.py) or newline-delimited json with one entry
+    per line. The file is read in chunks of chunk_size characters, and every entry is decoded as soon as it is complete.
     """
-    out_list = []
-    for line in gen_line_reader(eggnog_path):
-        if line.startswith("#"):
-            continue
-        ko = line.split("\t")[11]
-        #!!!!A comma means there is multiple ko terms. BLASTkoala appears to only save the first one.
-        #This script will include both ko terms
-        if ko == "-":
-            ko = ""
-        elif "," in ko:
-            for i in ko.split(","):
-                i = i.replace("ko:", "")
-                out_list.append(i)
-        else:
-            ko = ko.replace("ko:", "")
-            out_list.append(ko)
-    return out_list
-
-
-
-def read_kterm_json(json_path):
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    # None until the first character tells whether the entries are in a list
+    in_list = None
     with open(json_path, "r") as s:
-        kterms = json.load(s)
-    return kterms
+        while True:
+            # Skip the whitespace and commas between entries
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position == len(buffer):
+                chunk = s.read(chunk_size)
+                if not chunk:
+                    if in_list:
+                        raise ValueError(f"{json_path} ends before the list of entries is closed")
+                    return
+                buffer, position = chunk, 0
+                continue
+            if in_list is None:
+                in_list = buffer[position] == "["
+                if in_list:
+                    position += 1
+                continue
+            if in_list and buffer[position] == "]":
+                return
+            try:
+                entry, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The entry continues in the next chunk
+                chunk = s.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer, position = buffer[position:] + chunk, 0
+                continue
+            yield entry
 
 
 def convert_dict_to_edgelist(treedict, terminal_node=None) -> List[Tuple[str, str]]:
@@ -86,21 +100,26 @@ def convert_dict_to_edgelist(treedict, terminal_node=None) -> List[Tuple[str, st
     return edges
 
 
+def add_kterm_edges(kterm_graph: nx.DiGraph, kterm: dict):
+    # Adds the BRITE hierarchy of one kterm entry to the graph
+    kterm_id = kterm["ENTRY"]
+    kterm_brite = kterm["BRITE"]
+    orthology_name = "KEGG Orthology (KO) [BR:ko00001]"
+    if isinstance(kterm_brite, list):
+        for el in kterm_brite:
+            if orthology_name in el.keys():
+                this_el_edgelist = convert_dict_to_edgelist(el, kterm_id)
+                kterm_graph.add_edges_from(this_el_edgelist)
+    else:
+        this_term_edgelist = convert_dict_to_edgelist(kterm_brite, kterm_id)
+        kterm_graph.add_edges_from(this_term_edgelist)
+
+
 def convert_edgelist_to_graph(kterm_edgelist, kterm_dict):
     # Main function that creates a graph from the list of adjacent nodes
     kterm_graph = nx.DiGraph()
     for i in range(0, len(kterm_edgelist)):
-        kterm_id = kterm_dict[i]["ENTRY"]
-        kterm_brite = kterm_dict[i]["BRITE"]
-        orthology_name = "KEGG Orthology (KO) [BR:ko00001]"
-        if isinstance(kterm_brite, list):
-            for el in kterm_brite:
-                if orthology_name in el.keys():
-                    this_el_edgelist = convert_dict_to_edgelist(el, kterm_id)
-                    kterm_graph.add_edges_from(this_el_edgelist)
-        else:
-            this_term_edgelist = convert_dict_to_edgelist(kterm_brite, kterm_id)
-            kterm_graph.add_edges_from(this_term_edgelist)
+        add_kterm_edges(kterm_graph, kterm_dict[i])
     return kterm_graph
 
 
@@ -112,19 +131,6 @@ def get_terminal_nodes(g: nx.DiGraph) -> Set[str]:
     return terminal_nodes
 
 
-def calc_kterm_enrichment(kterm_graph: nx.DiGraph, present_kterms: Set[str]) -> Dict[str, Tuple[int, int, str]]:
-    # For each node will find total number of kterms associated with it, and number of kterms from eggnog
-    terminal_node_list = get_terminal_nodes(kterm_graph)
-    enrichments = dict()
-    for node in kterm_graph.nodes:
-        des = list(nx.descendants(kterm_graph, node))
-        this_node_total_kterms = [n for n in des if n in terminal_node_list]
-        this_node_pres_kterms = set(this_node_total_kterms).intersection(present_kterms)
-        this_node_pres_kterms_str = ",".join(this_node_pres_kterms)
-        enrichments[node] = (len(this_node_pres_kterms), len(this_node_total_kterms), this_node_pres_kterms_str)
-    return enrichments
-
-
 def dedupe_hierarchy(lines: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
     # keep only first instances of hierarchical levels and 0 kterms
     key_fun = lambda x: x[1]
@@ -144,27 +150,21 @@ def path_top_bottom(graph: nx.DiGraph, node: Tuple[str, str]):
     # Should start from the root
     # The input is node tuple ("", node_id). The hierarchy is stored in the first value of tuple.
     # The output is a list of node tuples with hierarchy in the first value of tuple.
-    all_paths = []
-    g_path = [node]
-    key_fun = lambda x: x[1]
-    def find_sux(graph, node, g_path, depth=0):
-        sux = list(graph.successors(key_fun(node)))
-        if sux == []:
-            all_paths.append(g_path)
-        else:
-            depth += 1
-            for s in sux:
-                new_s_name = (depth * "-", s)
-                this_suc_g_path = g_path.copy()
-                this_suc_g_path.append(new_s_name)
-                find_sux(graph, new_s_name, this_suc_g_path, depth)
-
-    find_sux(graph, node, g_path)
-
-    joined_paths = []
-    for path in all_paths:
-        joined_paths.extend(path)
-    return joined_paths
+    # Every node is listed once, at its first visit. Categories with the same name are the same node, and when a node
+    # is reached again all nodes below it were already listed, so it is not walked again. The walk uses a stack
+    # instead of recursion, so deep hierarchies do not hit the recursion limit
+    hier = []
+    visited = set()
+    stack = [node]
+    while stack:
+        dashes, name = stack.pop()
+        if name in visited:
+            continue
+        visited.add(name)
+        hier.append((dashes, name))
+        # Pushed in reverse, so the successors are walked in order
+        stack.extend([(dashes + "-", s) for s in reversed(list(graph.successors(name)))])
+    return hier
 
 
 def drop_orthology_and_root_from_hier(hier_repr: List[Tuple[str, str]]):
@@ -190,33 +190,70 @@ def create_hier_repr(kterm_graph) -> List[Tuple[str, str]]:
     return hier_repr
 
 
-def add_enrichment_to_hier_list(hier_repr, enrichments) -> List[Tuple[str, str, int, int, str]]:
-    #hier_enrich = ["---", node_name, 10, 20, present_kterms_str_list]
-    hier_enrich = []
-    for node in hier_repr:
-        node_name = node[1]
-        enrichment = enrichments[node_name]
-        new_node = (node[0], node[1], *enrichment)
-        hier_enrich.append(new_node)
-    return hier_enrich
-
-
-def create_kterms_graph(kterm_json) -> nx.DiGraph:
-    # convert json file to the graph representation
-    kterms_edges = []
-    for term in kterm_json:
-        kterm_edgelist = convert_dict_to_edgelist(term)
-        kterms_edges.append(kterm_edgelist)
-    kterms_graph = convert_edgelist_to_graph(kterms_edges, kterm_json)
+def create_kterms_graph(kterm_entries: Iterable[dict]) -> nx.DiGraph:
+    # convert the kterm entries to the graph representation. The entries are added one at a time, so they can be
+    # streamed from the json file (iter_kterm_json) instead of being loaded as a whole
+    kterms_graph = nx.DiGraph()
+    num_entries = 0
+    for kterm in kterm_entries:
+        add_kterm_edges(kterms_graph, kterm)
+        num_entries += 1
+    kterms_graph.graph["kterm_entries"] = num_entries
     return kterms_graph
 
-def create_hierarchical_representation(kterms_graph, eggnog_kterms) -> List[Tuple[str, str, int, int, str]]:
-    # Create hierarchical representation based on the graph
-    # Add information about number of kterms per hierarchical level (enrichment)
-    eggnog_kterm_set = set(eggnog_kterms)
-    enrichments = calc_kterm_enrichment(kterms_graph, eggnog_kterm_set)
+def compile_kterms_hierarchy(kterms_graph) -> BriteHierarchy:
+    # The display order and the K terms below every category only depend on the graph, so they are compiled once
+    # (see KEGGstand_brite_hierarchy.py) and every sample is counted against the compiled hierarchy
     hier_repr = create_hier_repr(kterms_graph)
-    hier_enrich = add_enrichment_to_hier_list(hier_repr, enrichments)
+    return compile_brite_hierarchy(kterms_graph, get_terminal_nodes(kterms_graph), hier_repr)
+
+
+def compile_kterm_json(kterm_json_path: Path, profiler: Optional[PhaseProfiler] = None) -> BriteHierarchy:
+    # Stream the k terms json into the graph and compile it
+    print(f"Reading kterms from {kterm_json_path}")
+    with profile_phase(profiler, "graph_build"):
+        kterms_graph = create_kterms_graph(iter_kterm_json(kterm_json_path))
+    with profile_phase(profiler, "hierarchy"):
+        brite_hierarchy = compile_kterms_hierarchy(kterms_graph)
+    if profiler is not None:
+        profiler.count("kterm_entries", kterms_graph.graph["kterm_entries"])
+        profiler.count("graph_edges", kterms_graph.number_of_edges())
+    return brite_hierarchy
+
+
+def load_or_compile_hierarchy(kterm_json_path: Path, cache_path: Optional[Path] = None, use_cache: bool = True,
+                              profiler: Optional[PhaseProfiler] = None) -> BriteHierarchy:
+    """
+    Returns the compiled hierarchy of the k terms json at kterm_json_path. Memory maps the compiled file if it matches
+    the json contents, otherwise reads the json, compiles it and refreshes the compiled file.
+    """
+    if not use_cache:
+        return compile_kterm_json(kterm_json_path, profiler)
+
+    if cache_path is None:
+        cache_path = default_cache_path(kterm_json_path)
+    with profile_phase(profiler, "cache_load"):
+        brite_hierarchy = load_brite_hierarchy(cache_path, kterm_json_path)
+    if brite_hierarchy is not None:
+        print(f"Loaded compiled hierarchy from {cache_path}")
+        return brite_hierarchy
+
+    print(f"No up to date compiled hierarchy found, compiling {kterm_json_path}")
+    # Stamp and hash are taken before reading, so a json that changes during the compilation is compiled again next time
+    db_stamp = file_stamp(kterm_json_path)
+    db_hash = hash_kterm_json(kterm_json_path)
+    brite_hierarchy = compile_kterm_json(kterm_json_path, profiler)
+    with profile_phase(profiler, "cache_write"):
+        save_brite_hierarchy(cache_path, db_stamp, db_hash, brite_hierarchy)
+    return brite_hierarchy
+
+
+def create_hierarchical_representation(brite_hierarchy: BriteHierarchy, eggnog_kterms, profiler: Optional[PhaseProfiler] = None) \
+        -> List[Tuple[str, str, int, int, str]]:
+    # Hierarchical representation of the compiled hierarchy,
+    # with the number of kterms per hierarchical level (enrichment)
+    with profile_phase(profiler, "enrichment"):
+        hier_enrich = brite_hierarchy.enrichment(eggnog_kterms)
     return hier_enrich
 
 
@@ -228,13 +265,98 @@ def convert_to_df_and_filter_zero(hier_repr_list) -> pd.DataFrame:
     return res_df
 
 
-def parseargs() -> Tuple[Path, Path, Path]:
-    parser = argparse.ArgumentParser(description="Estimate completion of the modules")
+def process_sample(brite_hierarchy: BriteHierarchy, eggnogfile_path: Path, out_path: Path, profiler: Optional[PhaseProfiler] = None) \
+        -> Tuple[Set[str], List[Tuple[str, str, int, int, str]], pd.DataFrame]:
+    """
+    Counts the K terms of one eggnog file per BRITE category of the compiled hierarchy and writes the table to out_path.
+    Returns the K terms of the sample, the hierarchy with counts and the written table.
+    """
+    print(f"Parsing eggnog from {eggnogfile_path}")
+    with profile_phase(profiler, "ko_parse"):
+        eggnog_kterms = read_ko_set(eggnogfile_path)
+
+    print("Creating summary")
+    hier_repr = create_hierarchical_representation(brite_hierarchy, eggnog_kterms, profiler)
+    #Output k terms found per category in hierarchical fashion, in full format
+
+    print(f"Saving summary to {out_path}")
+    with profile_phase(profiler, "write"):
+        res_df = convert_to_df_and_filter_zero(hier_repr)
+        res_df.to_csv(out_path, sep="\t", index=False)
+    return eggnog_kterms, hier_repr, res_df
+
+
+######################### Cohort mode
+
+BRITE_MATRIX_NAME = "KEGGstand_BRITE_matrix.tsv"
+
+
+def convert_counts_to_matrix(brite_hierarchy: BriteHierarchy, counts: np.ndarray, sample_names: List[str]) -> pd.DataFrame:
+    # Categories x samples table, categories without K terms in any sample are dropped as in the per-sample tables
+    count_matrix = pd.DataFrame(counts, columns=sample_names)
+    count_matrix.insert(0, "hierarchy_level", brite_hierarchy.row_dashes)
+    count_matrix.insert(1, "kegg_orthology_name", brite_hierarchy.row_names)
+    count_matrix.insert(2, "num_total_kterms", brite_hierarchy.row_totals)
+    return count_matrix[counts.any(axis=1)]
+
+
+def run_cohort(brite_hierarchy: BriteHierarchy, eggnog_paths: List[Path], profiler: Optional[PhaseProfiler] = None) \
+        -> Tuple[pd.DataFrame, int]:
+    """
+    Counts the K terms of all samples per BRITE category at once. The K terms of the samples are stored as a
+    samples x K terms matrix, which is counted against the compiled hierarchy in one pass. Returns the categories x samples
+    count table (no per-sample tables are written) and the number of K terms over all samples.
+    """
+    sample_names = []
+    masks = []
+    num_kterms = 0
+    failed = []
+    for eggnogfile_path in eggnog_paths:
+        print(f"Parsing eggnog from {eggnogfile_path}")
+        try:
+            with profile_phase(profiler, "ko_parse"):
+                eggnog_kterms = read_ko_set(eggnogfile_path)
+        except Exception as e:
+            print(f"Error, failed to process {eggnogfile_path}: {e!r}")
+            failed.append(eggnogfile_path)
+            continue
+        masks.append(brite_hierarchy.kterm_mask(eggnog_kterms))
+        sample_names.append(get_sample_name(eggnogfile_path))
+        num_kterms += len(eggnog_kterms)
+    if failed:
+        print(f"{len(failed)} of {len(eggnog_paths)} samples failed:")
+        for p in failed:
+            print(f"  {p}")
+
+    print(f"Counting {len(brite_hierarchy)} categories for {len(sample_names)} samples")
+    with profile_phase(profiler, "enrichment"):
+        masks = np.array(masks, dtype=bool).reshape(len(masks), len(brite_hierarchy.kterms))
+        counts = brite_hierarchy.count_present_matrix(masks)
+    return convert_counts_to_matrix(brite_hierarchy, counts, sample_names), num_kterms
+
+
+def parseargs(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    # prog is fixed, so usage errors of jobs run by KEGGstand_daemon.py name this script
+    parser = argparse.ArgumentParser(prog="KEGGstand_BRITE_checker.py", description="Estimate completion of the modules")
     parser.add_argument("-k", help="Path to the k terms json file", required=True, dest="kterm_json_path", type=Path)
-    parser.add_argument("-e", help="Path to the eggnog file", required=True, dest="eggnogfile_path", type=Path)
-    parser.add_argument("-o", help="Path to the output tsv table", required=True, dest="out_path", type=Path)
-    args = parser.parse_args()
-    return args.kterm_json_path, args.eggnogfile_path, args.out_path
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument("-e", help="Path to the eggnog file", dest="eggnogfile_path", type=Path)
+    inputs.add_argument("-b", "--batch", help="Cohort mode: directory of *.emapper.annotations files, a manifest file "
+                                              "listing one eggnog file per line, or a quoted glob pattern. Writes one "
+                                              "categories x samples table", dest="batch_input")
+    parser.add_argument("-o", help="Path to the output tsv table (cohort mode: path to the output directory)",
+                        required=True, dest="out_path", type=Path)
+    parser.add_argument("--category", help="Only count and write this category and its subcategories, as named in the output "
+                                           "(can be given more than once)", dest="categories", action="append", default=[])
+    parser.add_argument("--profile", help="Record the time and memory use of every phase in a json file next to the output "
+                                          "table (*.profile.json)", dest="profile", action="store_true")
+    parser.add_argument("--cprofile", help="Also write a cProfile dump of the run next to the output table (*.cprofile.prof)",
+                        dest="cprofile", action="store_true")
+    parser.add_argument("-c", "--cache", help="Path to the compiled hierarchy (default: next to the k terms json file)",
+                        dest="cache_path", type=Path, default=None)
+    parser.add_argument("--no_cache", help="Always read the k terms json file, do not read or write the compiled hierarchy",
+                        dest="no_cache", action="store_true")
+    return parser.parse_args(argv)
 
 
 def resolve_rel_path_list(path_list: List[Path]):
@@ -244,24 +366,58 @@ def resolve_rel_path_list(path_list: List[Path]):
     return res_paths
 
 
-def main():
-    kterm_json_path, eggnogfile_path, out_path = parseargs()
-    kterm_json_path, eggnogfile_path, out_path = resolve_rel_path_list([kterm_json_path, eggnogfile_path, out_path])
-
-    print(f"Reading kterms from {kterm_json_path}")
-    kterm_json = read_kterm_json(kterm_json_path)
-
-    print(f"Parsing eggnog from {eggnogfile_path}")
-    eggnog_kterms = eggnog_parser(eggnogfile_path)
-
-    print("Creating summary")
-    kterms_graph = create_kterms_graph(kterm_json)
-    hier_repr = create_hierarchical_representation(kterms_graph, eggnog_kterms)
-    #Output k terms found per category in hierarchical fashion, in full format
-
-    print(f"Saving summary to {out_path}")
-    res_df = convert_to_df_and_filter_zero(hier_repr)
-    res_df.to_csv(out_path, sep="\t", index=False)
+def main(argv: Optional[List[str]] = None, load_hierarchy=load_or_compile_hierarchy):
+    # argv and load_hierarchy are replaced by KEGGstand_daemon.py, which runs the checker on a hierarchy it already compiled
+    args = parseargs(argv)
+    kterm_json_path, out_path = resolve_rel_path_list([args.kterm_json_path, args.out_path])
+    cache_path = args.cache_path.resolve() if args.cache_path is not None else None
+    profiler = PhaseProfiler() if args.profile else None
+    cprofiler = None
+    if args.cprofile:
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+
+    brite_hierarchy = load_hierarchy(kterm_json_path, cache_path, use_cache=not args.no_cache, profiler=profiler)
+    if args.categories:
+        # Only the subtrees of the requested categories are kept, the rest of the hierarchy is not counted
+        with profile_phase(profiler, "select"):
+            brite_hierarchy = brite_hierarchy.select_categories(args.categories)
+        print(f"Selected {len(brite_hierarchy)} categories")
+    if args.batch_input is None:
+        eggnog_kterms, hier_repr, res_df = process_sample(brite_hierarchy, args.eggnogfile_path.resolve(), out_path, profiler)
+        table_path = out_path
+        num_samples, num_kterms = 1, len(eggnog_kterms)
+    else:
+        eggnog_paths = collect_batch_inputs(args.batch_input)
+        out_path.mkdir(parents=True, exist_ok=True)
+        res_df, num_kterms = run_cohort(brite_hierarchy, eggnog_paths, profiler)
+        num_samples = len(res_df.columns) - 3
+        table_path = out_path / BRITE_MATRIX_NAME
+        print(f"Saving count matrix to {table_path}")
+        with profile_phase(profiler, "matrix_write"):
+            res_df.to_csv(table_path, sep="\t", index=False)
+
+    if cprofiler is not None:
+        cprofiler.disable()
+        cprofile_path = sidecar_path(table_path, ".cprofile.prof")
+        print(f"Saving cProfile dump to {cprofile_path}")
+        cprofiler.dump_stats(cprofile_path)
+    if profiler is not None:
+        profiler.count("graph_nodes", brite_hierarchy.node_count())
+        profiler.count("samples", num_samples)
+        profiler.count("kterms", num_kterms)
+        profiler.count("categories", len(brite_hierarchy))
+        profiler.count("output_rows", len(res_df))
+        metadata = {"script": Path(__file__).name,
+                    "date": datetime.now().isoformat(timespec="seconds"),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "kterm_file": str(kterm_json_path),
+                    "input": str(args.eggnogfile_path if args.batch_input is None else args.batch_input),
+                    "categories": args.categories}
+        profile_path = sidecar_path(table_path, ".profile.json")
+        print(f"Saving profile to {profile_path}")
+        write_json(profile_path, profiler.to_dict(), metadata)
 
 
 if __name__ == "__main__":
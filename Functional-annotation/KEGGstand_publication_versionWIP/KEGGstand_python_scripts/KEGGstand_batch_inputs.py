@@ -0,0 +1,57 @@
+"""
+Input files of the batch modes, shared by KEGGstand_module_checker.py, KEGGstand_BRITE_checker.py and
+KEGGstand_compare_checkers.py: collects the eggnog files of a batch (a directory, a manifest file or a glob pattern) and
+names the samples after them.
+"""
+import glob
+from pathlib import Path
+from typing import List
+
+from KEGGstand_eggnog_reader import strip_compression_suffix, COMPRESSION_SUFFIXES
+from KEGGstand_ko_store import strip_ko_store_suffix, KO_STORE_SUFFIX
+
+BATCH_SUFFIX = ".emapper.annotations"
+
+
+def collect_batch_inputs(batch_input: str) -> List[Path]:
+    """
+    Returns the eggnog files to process in batch mode. batch_input is either a directory (all *.emapper.annotations
+    files in it are used, also when compressed with gzip or bz2 or converted into a binary K term store), a manifest
+    file listing one eggnog file per line, or a glob pattern.
+    """
+    batch_path = Path(batch_input)
+    if batch_path.is_dir():
+        # Compressed annotations (.gz, .bz2) are read transparently as well. If a sample also has a binary K term
+        # store (.kos.npz), the store is used instead of parsing the annotations again
+        inputs = dict()
+        for suffix in ("",) + COMPRESSION_SUFFIXES + (KO_STORE_SUFFIX,):
+            for p in batch_path.glob(f"*{BATCH_SUFFIX}{suffix}"):
+                inputs[get_input_name(p)] = p
+        eggnog_paths = [inputs[name] for name in sorted(inputs)]
+    elif batch_path.is_file():
+        eggnog_paths = []
+        with open(batch_path, "r") as s:
+            for line in s:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                eggnog_path = Path(line)
+                # Relative paths in the manifest are relative to the manifest itself
+                if not eggnog_path.is_absolute():
+                    eggnog_path = batch_path.parent / eggnog_path
+                eggnog_paths.append(eggnog_path)
+    else:
+        eggnog_paths = [Path(p) for p in sorted(glob.glob(batch_input))]
+    if not eggnog_paths:
+        raise FileNotFoundError(f"No eggnog files found for {batch_input}")
+    return [p.resolve() for p in eggnog_paths]
+
+
+def get_input_name(eggnog_path: Path) -> str:
+    # Name of the annotations file the input was made from: "sample.emapper.annotations(.gz|.kos.npz)" -> "sample.emapper.annotations"
+    return strip_compression_suffix(strip_ko_store_suffix(eggnog_path.name))
+
+
+def get_sample_name(eggnog_path: Path) -> str:
+    # Same naming as KEGGstand_tsv_maker.py: everything before ".emapper"
+    return eggnog_path.name.partition(".emapper")[0]
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of the module checker. Generates a synthetic KEGG module database and synthetic eggnog annotation
+files, then runs the steps of KEGGstand_module_checker.py on them and times each phase:
+    module_db_parse, graph_build, ko_parse, completion, write
+For every phase the wall time, CPU time and peak memory are recorded (see KEGGstand_profiling.py). The results are
+saved as JSON, together with the git commit of the scripts, so runs before and after a change can be compared.
+
+Usage: (python) KEGGstand_benchmark.py -o benchmark.json [--rows 1000 10000 100000 1000000] [--engine graph dp]
+"""
+from typing import Dict, List
+import os
+import random
+import argparse
+import platform
+import subprocess
+import tempfile
+from contextlib import redirect_stdout
+from datetime import datetime
+from pathlib import Path
+
+from KEGGstand_module_checker import KEGG_module_reader, parse_pathway_definition, compile_parsed_module, \
+    build_ko_module_index, find_in_which_pathway, compute_completion_of_all_pathways, \
+    compute_completion_of_all_pathways_dp, convert_completion_dict_to_df
+from KEGGstand_eggnog_reader import read_ko_set
+from KEGGstand_expression_dag import build_expression_dag
+from KEGGstand_profiling import PhaseProfiler, write_json
+
+# Number of K terms in the synthetic KEGG orthology, roughly the size of the real one
+NUM_KTERMS = 26000
+EGGNOG_HEADER = ["query", "seed_ortholog", "evalue", "score", "eggNOG_OGs", "max_annot_lvl", "COG_category",
+                 "Description", "Preferred_name", "GOs", "EC", "KEGG_ko", "KEGG_Pathway", "KEGG_Module",
+                 "KEGG_Reaction", "KEGG_rclass", "BRITE", "KEGG_TC", "CAZy", "BiGG_Reaction", "PFAMs"]
+
+
+######################### Synthetic input
+
+def random_kterm(rng: random.Random) -> str:
+    return f"K{rng.randint(1, NUM_KTERMS):05d}"
+
+
+def random_group(rng: random.Random, depth: int = 0) -> str:
+    """
+    A random step of a module definition: a K term, a complex (K+K), an optional subunit (K+K-K) or a bracketed
+    group of alternatives, which can nest further steps (up to three levels deep, like the real definitions).
+    """
+    r = rng.random()
+    if r < 0.45 or depth >= 3:
+        return random_kterm(rng)
+    if r < 0.6:
+        return "+".join(random_kterm(rng) for _ in range(rng.randint(2, 4)))
+    if r < 0.67:
+        return "+".join(random_kterm(rng) for _ in range(rng.randint(1, 3))) + "-" + random_kterm(rng)
+    alternatives = []
+    for _ in range(rng.randint(2, 5)):
+        steps = [random_group(rng, depth + 1) for _ in range(rng.choices([1, 2, 3], weights=[6, 3, 1])[0])]
+        alternatives.append(" ".join(steps))
+    return "(" + ",".join(alternatives) + ")"
+
+
+def generate_module_db(path: Path, num_modules: int, rng: random.Random) -> List[str]:
+    """
+    Writes a synthetic module database in the format of KEGG_module_db_generate.py. Like in KEGG, some groups
+    (e.g. enzyme complexes) are shared between many modules. Returns the K terms used by the modules.
+    """
+    shared_groups = [random_group(rng) for _ in range(max(10, num_modules // 8))]
+    module_kterms = set()
+    with open(path, "w") as s:
+        for i in range(num_modules):
+            steps = []
+            for _ in range(rng.randint(2, 12)):
+                steps.append(rng.choice(shared_groups) if rng.random() < 0.15 else random_group(rng))
+            definition = " ".join(steps)
+            module_kterms.update(part for part in definition.replace("(", " ").replace(")", " ").replace(",", " ")
+                                 .replace("+", " ").replace("-", " ").split())
+            s.write(f"Module: M9{i:04d} Synthetic module {i}\n")
+            s.write(f"Definition: {definition}\n")
+            s.write("Class: Pathway modules; Synthetic; Benchmark\n")
+    return sorted(module_kterms)
+
+
+def generate_eggnog_file(path: Path, num_rows: int, module_kterms: List[str], rng: random.Random):
+    """
+    Writes a synthetic eggnog-mapper v2 annotations file with num_rows genes. About a third of the genes have no
+    K term, the others mostly have K terms that occur in the modules.
+    """
+    with open(path, "w") as s:
+        s.write("## emapper-2.1.12\n## Synthetic annotations for KEGGstand_benchmark.py\n")
+        s.write("#" + "\t".join(EGGNOG_HEADER) + "\n")
+        for i in range(num_rows):
+            if rng.random() < 0.35:
+                ko_field = "-"
+            else:
+                kterms = [rng.choice(module_kterms) if rng.random() < 0.6 else random_kterm(rng)
+                          for _ in range(rng.choices([1, 2, 3], weights=[8, 1, 1])[0])]
+                ko_field = ",".join(f"ko:{kterm}" for kterm in kterms)
+            s.write(f"contig_{i // 20}_{i % 20}\t1234.GENE{i}\t1.5e-80\t250.3\tCOG0001@1|root,COG0001@2|Bacteria\t"
+                    f"2|Bacteria\tC\tSynthetic protein {i}\tgen{i % 500}\tGO:0003674,GO:0003824,GO:0008150\t1.1.1.1\t"
+                    f"{ko_field}\tko00010,map00010\tM00001\tR00001\tRC00001\tko00000,ko01000\t-\t-\t-\tPF00001\n")
+        s.write(f"## {num_rows} queries scanned\n")
+
+
+######################### Benchmark phases
+
+def benchmark_run(mod_path: Path, eggnog_path: Path, out_path: Path, engine: str, trace_memory: bool) -> Dict[str, dict]:
+    """
+    Runs the module checker steps once with the given engine, timing every phase.
+    """
+    profiler = PhaseProfiler(trace_memory=trace_memory)
+    # The scripts print every module, which would mostly measure the terminal
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        with profiler.phase("module_db_parse"):
+            kegg_modules = KEGG_module_reader(mod_path)
+            parsed_modules = {k_id: parse_pathway_definition(definitions[0]) for k_id, definitions in kegg_modules.items()}
+
+        with profiler.phase("graph_build"):
+            compiled_modules = {k_id: compile_parsed_module(kegg_modules[k_id][0], parsed_clean)
+                                for k_id, parsed_clean in parsed_modules.items()}
+            kegg_pathways = {k_id: c["graph"] for k_id, c in compiled_modules.items()}
+            ko_index = build_ko_module_index(kegg_pathways)
+            expression_dag = build_expression_dag(parsed_modules)
+
+        with profiler.phase("ko_parse"):
+            eggnog_kterms = read_ko_set(eggnog_path)
+
+        with profiler.phase("completion"):
+            pathways_with_target_genes = find_in_which_pathway(eggnog_kterms, kegg_pathways, ko_index)
+            if engine == "dp":
+                completion = compute_completion_of_all_pathways_dp(compiled_modules, pathways_with_target_genes, expression_dag)
+            else:
+                # Random samples regularly hit the graph engine's "no path" error (genes of two alternatives of the
+                # same step present), those modules are left out of the table and counted
+                completion = compute_completion_of_all_pathways(kegg_pathways, pathways_with_target_genes, skip_no_path=True)
+            failed = len(kegg_pathways) - len(completion)
+
+        with profiler.phase("write"):
+            completion_df = convert_completion_dict_to_df(completion)
+            completion_df.to_csv(out_path, sep="\t", index=True)
+    profiler.stop()
+
+    profiler.count("modules", len(compiled_modules))
+    profiler.count("graph_nodes", sum(len(graph) for graph in kegg_pathways.values()))
+    profiler.count("expression_dag_nodes", len(expression_dag))
+    profiler.count("kterms", len(eggnog_kterms))
+    profiler.count("modules_with_hits", len(pathways_with_target_genes))
+    profiler.count("failed_modules", failed)
+    return profiler.to_dict()
+
+
+def get_git_commit() -> str:
+    try:
+        res = subprocess.run(["git", "rev-parse", "HEAD"], cwd=Path(__file__).resolve().parent,
+                             capture_output=True, text=True, check=True)
+        return res.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the module checker on synthetic data")
+    parser.add_argument("-o", help="Path to the output json file", required=True, dest="out_path", type=Path)
+    parser.add_argument("--rows", help="Numbers of rows of the synthetic eggnog files", dest="rows", type=int, nargs="+",
+                        default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--modules", help="Number of modules in the synthetic module database", dest="num_modules",
+                        type=int, default=800)
+    parser.add_argument("--engine", help="Completion engines to benchmark", dest="engines", nargs="+",
+                        choices=["graph", "dp"], default=["graph", "dp"])
+    parser.add_argument("--seed", help="Seed of the synthetic data", dest="seed", type=int, default=1)
+    parser.add_argument("--work_dir", help="Directory for the synthetic files (default: a temporary directory). "
+                                           "Existing synthetic files with the same settings are reused",
+                        dest="work_dir", type=Path, default=None)
+    parser.add_argument("--trace_memory", help="Also trace the peak Python allocations per phase (slower)",
+                        dest="trace_memory", action="store_true")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    out_path = args.out_path.resolve()
+    tmp_dir = None
+    if args.work_dir is None:
+        tmp_dir = tempfile.TemporaryDirectory(prefix="KEGGstand_benchmark_")
+        work_dir = Path(tmp_dir.name)
+    else:
+        work_dir = args.work_dir.resolve()
+        work_dir.mkdir(parents=True, exist_ok=True)
+
+    rng = random.Random(args.seed)
+    mod_path = work_dir / f"synthetic_modules_{args.num_modules}_seed{args.seed}.txt"
+    print(f"Generating {args.num_modules} synthetic modules in {mod_path}")
+    module_kterms = generate_module_db(mod_path, args.num_modules, rng)
+
+    runs = []
+    for num_rows in args.rows:
+        # The K terms of the genes depend on the modules, so the file name has every setting of the generator
+        eggnog_path = work_dir / f"synthetic_{num_rows}_modules{args.num_modules}_seed{args.seed}.emapper.annotations"
+        if not eggnog_path.is_file():
+            print(f"Generating {num_rows} synthetic eggnog rows in {eggnog_path}")
+            generate_eggnog_file(eggnog_path, num_rows, module_kterms, random.Random(args.seed * 1000003 + num_rows))
+        for engine in args.engines:
+            print(f"Benchmarking {num_rows} rows with the {engine} engine")
+            result = benchmark_run(mod_path, eggnog_path, work_dir / f"{eggnog_path.name}_{engine}_KEGG_completion.tsv",
+                                   engine, args.trace_memory)
+            result["counts"]["eggnog_rows"] = num_rows
+            runs.append({"rows": num_rows, "engine": engine, **result})
+            phase_times = ", ".join(f"{name} {p['wall_s']:.3f}s" for name, p in result["phases"].items())
+            print(f"  {phase_times}, peak RSS {result['total']['peak_rss_mb']:.1f} MB")
+
+    metadata = {"date": datetime.now().isoformat(timespec="seconds"),
+                "git_commit": get_git_commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "seed": args.seed,
+                "num_modules": args.num_modules,
+                "trace_memory": args.trace_memory}
+    print(f"Saving benchmark results to {out_path}")
+    write_json(out_path, {"runs": runs}, metadata)
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+"""
+Compiled BRITE hierarchy, used by KEGGstand_BRITE_checker.py.
+
+The K terms graph (root -> categories -> K term description -> K term) only depends on the K terms json, so it is
+compiled once into interval form. The graph is walked depth first from the root, like the display order of the
+output (path_top_bottom): every node the walk reaches gets the next position of the tour, and every node covers the
+positions [start, end) of the walk below it. The K terms below a category are then a range of tour positions, and
+counting the present K terms of a sample below every category is a prefix sum lookup per category. The present K
+terms below a category are found with two binary searches in the sorted tour positions of the present K terms.
+
+A K term can be listed under several categories, and categories with the same name are the same node of the graph,
+so a K term can occur more than once in the range of a category. It is counted once: for every two consecutive
+occurrences of a K term in the tour, their lowest common ancestor in the walk gets -1. A category covering k
+occurrences of a K term covers exactly the k - 1 ancestors of its consecutive pairs, so it counts the K term once.
+
+The compiled hierarchy is stored next to the K terms json (KEGG_k_term_database.json.compiled.brite) and memory
+mapped by later runs. The file starts with BRITE_CACHE_MAGIC, the length of a json header and the header itself
+(version, hash and size/modification time of the json, and the dtype, shape and offset of every array), followed by
+the arrays of BriteHierarchy.ARRAY_FIELDS as raw little endian data, each aligned to 64 bytes:
+  - node_names, node_name_offsets: the names of all nodes of the graph as one UTF-8 byte string
+  - kterm_nodes: node of every K term, in K term order
+  - tour_nodes, tour_parents: node and tour position of the parent (-1 for the root) of every position of the walk
+  - leaf_positions, leaf_kterms, duplicate_positions, duplicate_kterms: see BriteHierarchy
+  - row_nodes, row_depths, row_starts, row_ends: node, number of dashes and tour positions of every output row
+"""
+import hashlib
+import json
+import mmap
+import os
+from bisect import bisect_right
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+BRITE_CACHE_VERSION = 1
+BRITE_CACHE_MAGIC = b"KGSBRITE"
+BRITE_CACHE_SUFFIX = ".compiled.brite"
+# Alignment of the arrays in the compiled file
+ARRAY_ALIGNMENT = 64
+# Samples counted at once by count_present_matrix, bounds the memory of the cumulative sums
+SAMPLE_CHUNK_SIZE = 64
+
+
+class BriteHierarchy:
+    """
+    The K terms graph in interval form, with the display order of the output.
+
+    node_names, node_name_offsets: names of the nodes of the graph as one UTF-8 byte string, node i is
+        node_names[node_name_offsets[i]:node_name_offsets[i + 1]]
+    kterm_nodes: node of every K term. kterms are the names of the terminal nodes (K terms) in sorted order,
+        kterm_ids the index of each
+    tour_nodes, tour_parents: node and tour position of the parent of every position of the depth first walk
+        (tour_size positions)
+    leaf_positions, leaf_kterms: tour position and K term index of every occurrence of a K term, in tour order
+    duplicate_positions, duplicate_kterms: tour position of the lowest common ancestor of every two consecutive
+        occurrences of a K term, and the K term index
+    row_nodes, row_depths: the categories in the display order of the output (see create_hier_repr) and their number
+        of dashes, row_names and row_dashes the same as strings
+    row_starts, row_ends: the tour positions [start, end) below the category of every row
+    row_totals: number of K terms below the category of every row
+    """
+    ARRAY_FIELDS = ("node_names", "node_name_offsets", "kterm_nodes", "tour_nodes", "tour_parents", "leaf_positions",
+                    "leaf_kterms", "duplicate_positions", "duplicate_kterms", "row_nodes", "row_depths", "row_starts", "row_ends")
+    __slots__ = ARRAY_FIELDS + ("kterms", "kterm_ids", "tour_size", "row_names", "row_dashes", "row_totals")
+
+    def __init__(self, node_names: np.ndarray, node_name_offsets: np.ndarray, kterm_nodes: np.ndarray,
+                 tour_nodes: np.ndarray, tour_parents: np.ndarray, leaf_positions: np.ndarray, leaf_kterms: np.ndarray,
+                 duplicate_positions: np.ndarray, duplicate_kterms: np.ndarray, row_nodes: np.ndarray,
+                 row_depths: np.ndarray, row_starts: np.ndarray, row_ends: np.ndarray):
+        self.node_names = node_names
+        self.node_name_offsets = node_name_offsets
+        self.kterm_nodes = kterm_nodes
+        self.tour_nodes = tour_nodes
+        self.tour_parents = tour_parents
+        self.leaf_positions = leaf_positions
+        self.leaf_kterms = leaf_kterms
+        self.duplicate_positions = duplicate_positions
+        self.duplicate_kterms = duplicate_kterms
+        self.row_nodes = row_nodes
+        self.row_depths = row_depths
+        self.row_starts = row_starts
+        self.row_ends = row_ends
+        # Only the names needed for the output are decoded
+        self.kterms = self.names_of(kterm_nodes)
+        self.kterm_ids = {kterm: i for i, kterm in enumerate(self.kterms)}
+        self.tour_size = len(tour_nodes)
+        self.row_names = self.names_of(row_nodes)
+        self.row_dashes = tuple("-" * depth for depth in row_depths.tolist())
+        self.row_totals = self.count_present(np.ones(len(self.kterms), dtype=bool))
+
+    def __len__(self) -> int:
+        return len(self.row_names)
+
+    def names_of(self, nodes: np.ndarray) -> Tuple[str, ...]:
+        names = self.node_names.tobytes()
+        offsets = self.node_name_offsets.tolist()
+        return tuple(names[offsets[node]:offsets[node + 1]].decode() for node in nodes.tolist())
+
+    def node_count(self) -> int:
+        return len(self.node_name_offsets) - 1
+
+    def select_categories(self, categories: Iterable[str]) -> "BriteHierarchy":
+        """
+        The hierarchy below the given categories (names as in the output, without dashes): every row of a category and
+        the rows after it with more dashes, as KEGGstand_tsv_maker.py --KEGG_cat selects them from a full output. The
+        selected categories cover disjoint ranges of the tour, only these ranges and the K terms in them are kept, so a
+        sample is only counted in the selected subtrees. Categories that are not in the hierarchy are reported.
+        """
+        wanted = set(categories)
+        selected_rows, block_rows = [], []
+        block_depth = None
+        for row, (name, depth) in enumerate(zip(self.row_names, self.row_depths.tolist())):
+            if block_depth is not None and depth <= block_depth:
+                block_depth = None
+            if block_depth is None and name in wanted:
+                block_depth = depth
+                block_rows.append(row)
+            if block_depth is not None:
+                selected_rows.append(row)
+        for name in sorted(wanted.difference(self.row_names)):
+            print(f"Category {name} is not in the hierarchy")
+        selected_rows = np.array(selected_rows, dtype=np.int64)
+        block_rows = np.array(block_rows, dtype=np.int64)
+        # The first row of a block covers the tour range of the block, ranges without positions (categories without
+        # K terms) are left out
+        range_starts, range_ends = self.row_starts[block_rows], self.row_ends[block_rows]
+        non_empty = range_starts < range_ends
+        range_starts, range_ends = range_starts[non_empty], range_ends[non_empty]
+        order = np.argsort(range_starts)
+        range_starts, range_ends = range_starts[order], range_ends[order]
+        range_offsets = np.concatenate(([0], np.cumsum(range_ends - range_starts)))
+
+        def rebase(positions: np.ndarray, range_positions: np.ndarray) -> np.ndarray:
+            # New tour position of positions in the selected ranges, the range is looked up by range_positions
+            ranges = np.searchsorted(range_starts, range_positions, side="right") - 1
+            return positions - range_starts[ranges] + range_offsets[ranges]
+
+        def inside(positions: np.ndarray) -> np.ndarray:
+            if len(range_starts) == 0:
+                return np.zeros(len(positions), dtype=bool)
+            ranges = np.searchsorted(range_starts, positions, side="right") - 1
+            return (ranges >= 0) & (positions < range_ends[np.maximum(ranges, 0)])
+
+        tour = np.concatenate([np.arange(start, end) for start, end in zip(range_starts.tolist(), range_ends.tolist())] +
+                              [np.zeros(0, dtype=np.int64)])
+        parents = self.tour_parents[tour]
+        parents_inside = inside(parents)
+        tour_parents = np.full(len(tour), -1, dtype=np.int64)
+        tour_parents[parents_inside] = rebase(parents[parents_inside], parents[parents_inside])
+        # Rows without K terms get an empty range at the start of the tour
+        old_starts, old_ends = self.row_starts[selected_rows], self.row_ends[selected_rows]
+        rows_non_empty = old_starts < old_ends
+        row_starts = np.zeros(len(selected_rows), dtype=np.int64)
+        row_ends = np.zeros(len(selected_rows), dtype=np.int64)
+        row_starts[rows_non_empty] = rebase(old_starts[rows_non_empty], old_starts[rows_non_empty])
+        row_ends[rows_non_empty] = rebase(old_ends[rows_non_empty], old_starts[rows_non_empty])
+        leaves = inside(self.leaf_positions)
+        duplicates = inside(self.duplicate_positions)
+        # Only the K terms below the selected categories are kept, in the same (sorted) order
+        kterm_ids = np.unique(self.leaf_kterms[leaves])
+        return BriteHierarchy(self.node_names, self.node_name_offsets, self.kterm_nodes[kterm_ids],
+                              self.tour_nodes[tour], tour_parents,
+                              rebase(self.leaf_positions[leaves], self.leaf_positions[leaves]),
+                              np.searchsorted(kterm_ids, self.leaf_kterms[leaves]),
+                              rebase(self.duplicate_positions[duplicates], self.duplicate_positions[duplicates]),
+                              np.searchsorted(kterm_ids, self.duplicate_kterms[duplicates]),
+                              self.row_nodes[selected_rows], self.row_depths[selected_rows], row_starts, row_ends)
+
+    def kterm_mask(self, present_kterms: Iterable[str]) -> np.ndarray:
+        # Boolean mask over the K terms of the hierarchy, K terms that are not in the hierarchy are ignored
+        mask = np.zeros(len(self.kterms), dtype=bool)
+        mask[[self.kterm_ids[kterm] for kterm in present_kterms if kterm in self.kterm_ids]] = True
+        return mask
+
+    def count_present(self, mask: np.ndarray) -> np.ndarray:
+        """
+        Number of K terms of the mask below the category of every row.
+        """
+        values = np.bincount(self.leaf_positions[mask[self.leaf_kterms]], minlength=self.tour_size) - \
+            np.bincount(self.duplicate_positions[mask[self.duplicate_kterms]], minlength=self.tour_size)
+        prefix = np.zeros(self.tour_size + 1, dtype=np.int64)
+        np.cumsum(values, out=prefix[1:])
+        return prefix[self.row_ends] - prefix[self.row_starts]
+
+    def count_present_matrix(self, masks: np.ndarray, chunk_size: int = SAMPLE_CHUNK_SIZE) -> np.ndarray:
+        """
+        Number of K terms below the category of every row for many masks at once (samples x K terms), as a
+        rows x samples matrix. The occurrences of the K terms are in tour order, so the occurrences below a row are a
+        range of them, and the masks are summed cumulatively over the occurrences, chunk_size samples at a time.
+        """
+        leaf_lows = np.searchsorted(self.leaf_positions, self.row_starts)
+        leaf_highs = np.searchsorted(self.leaf_positions, self.row_ends)
+        order = np.argsort(self.duplicate_positions, kind="stable")
+        duplicate_positions = self.duplicate_positions[order]
+        duplicate_kterms = self.duplicate_kterms[order]
+        duplicate_lows = np.searchsorted(duplicate_positions, self.row_starts)
+        duplicate_highs = np.searchsorted(duplicate_positions, self.row_ends)
+        counts = np.empty((len(self.row_names), len(masks)), dtype=np.int32)
+        for start in range(0, len(masks), chunk_size):
+            chunk = masks[start:start + chunk_size]
+            leaves = np.zeros((len(chunk), len(self.leaf_kterms) + 1), dtype=np.int32)
+            np.cumsum(chunk[:, self.leaf_kterms], axis=1, out=leaves[:, 1:])
+            duplicates = np.zeros((len(chunk), len(duplicate_kterms) + 1), dtype=np.int32)
+            np.cumsum(chunk[:, duplicate_kterms], axis=1, out=duplicates[:, 1:])
+            counts[:, start:start + chunk_size] = (leaves[:, leaf_highs] - leaves[:, leaf_lows] -
+                                                   duplicates[:, duplicate_highs] + duplicates[:, duplicate_lows]).T
+        return counts
+
+    def list_present(self, mask: np.ndarray, counts: np.ndarray) -> List[str]:
+        """
+        Comma separated K terms of the mask below the category of every row, in K number order.
+        counts are the counts of count_present, rows without K terms get an empty string.
+        """
+        present = mask[self.leaf_kterms]
+        positions = self.leaf_positions[present]
+        kterm_ids = self.leaf_kterms[present]
+        lows = np.searchsorted(positions, self.row_starts)
+        highs = np.searchsorted(positions, self.row_ends)
+        kterms = self.kterms
+        present_lists = []
+        for low, high, count in zip(lows.tolist(), highs.tolist(), counts.tolist()):
+            if count == 0:
+                present_lists.append("")
+            else:
+                present_lists.append(",".join([kterms[i] for i in np.unique(kterm_ids[low:high]).tolist()]))
+        return present_lists
+
+    def enrichment(self, present_kterms: Iterable[str]) -> List[Tuple[str, str, int, int, str]]:
+        """
+        Rows of the output for a sample: (dashes, category, number of K terms present, total, present K terms).
+        """
+        mask = self.kterm_mask(present_kterms)
+        counts = self.count_present(mask)
+        present_lists = self.list_present(mask, counts)
+        return list(zip(self.row_dashes, self.row_names, counts.tolist(), self.row_totals.tolist(), present_lists))
+
+
+def encode_names(names: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    # Names as one UTF-8 byte string and the offset of every name in it
+    encoded = [name.encode() for name in names]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def compile_brite_hierarchy(kterms_graph, terminal_nodes: Set[str], hier_repr: List[Tuple[str, str]],
+                            root: str = "root") -> BriteHierarchy:
+    """
+    Walks the K terms graph (a networkx.DiGraph) depth first from the root and compiles it into a BriteHierarchy.
+    Only the terminal nodes are counted as K terms. hier_repr is the display order of the output, (dashes, category)
+    per row.
+    """
+    kterms = sorted(terminal_nodes)
+    kterm_ids = {kterm: i for i, kterm in enumerate(kterms)}
+    # Nodes are numbered in the order the walk reaches them
+    node_ids: Dict[str, int] = dict()
+    intervals: Dict[str, Tuple[int, int]] = dict()
+    tour_nodes, tour_parents = [], []
+    leaf_positions, leaf_kterms = [], []
+    duplicate_positions, duplicate_kterms = [], []
+    last_occurrence: Dict[str, int] = dict()
+    # Tour positions of the nodes on the path to the current node, which increase along the path
+    path_positions = []
+    position = 0
+    # (node, tour position when leaving it or None when entering it)
+    stack = [(root, None)]
+    while stack:
+        node, start = stack.pop()
+        if start is not None:
+            path_positions.pop()
+            # The node covers the same K terms wherever it occurs in the walk, its first occurrence is kept.
+            # A K term does not count for itself (e.g. a category without any K terms is a terminal node)
+            if node not in intervals:
+                intervals[node] = (start + 1, position) if node in kterm_ids else (start, position)
+            continue
+        if node not in node_ids:
+            node_ids[node] = len(node_ids)
+        tour_nodes.append(node_ids[node])
+        tour_parents.append(path_positions[-1] if path_positions else -1)
+        if node in kterm_ids:
+            leaf_positions.append(position)
+            leaf_kterms.append(kterm_ids[node])
+            if node in last_occurrence:
+                # The lowest common ancestor is the deepest node on the path that was reached before the previous occurrence
+                ancestor = path_positions[bisect_right(path_positions, last_occurrence[node]) - 1]
+                duplicate_positions.append(ancestor)
+                duplicate_kterms.append(kterm_ids[node])
+            last_occurrence[node] = position
+        stack.append((node, position))
+        path_positions.append(position)
+        position += 1
+        for child in reversed(list(kterms_graph.successors(node))):
+            stack.append((child, None))
+
+    node_names, node_name_offsets = encode_names(list(node_ids))
+    row_names = [name for _, name in hier_repr]
+    return BriteHierarchy(node_names, node_name_offsets,
+                          np.array([node_ids[kterm] for kterm in kterms], dtype=np.int64),
+                          np.array(tour_nodes, dtype=np.int64), np.array(tour_parents, dtype=np.int64),
+                          np.array(leaf_positions, dtype=np.int64), np.array(leaf_kterms, dtype=np.int64),
+                          np.array(duplicate_positions, dtype=np.int64), np.array(duplicate_kterms, dtype=np.int64),
+                          np.array([node_ids[name] for name in row_names], dtype=np.int64),
+                          np.array([len(dashes) for dashes, _ in hier_repr], dtype=np.int64),
+                          np.array([intervals[name][0] for name in row_names], dtype=np.int64),
+                          np.array([intervals[name][1] for name in row_names], dtype=np.int64))
+
+
+def hash_kterm_json(kterm_json_path: Path) -> str:
+    """
+    Returns the sha256 hex digest of the K terms json contents. Used as the key of the compiled hierarchy.
+    """
+    db_hash = hashlib.sha256()
+    with open(kterm_json_path, "rb") as s:
+        for chunk in iter(lambda: s.read(1 << 20), b""):
+            db_hash.update(chunk)
+    return db_hash.hexdigest()
+
+
+def file_stamp(file_path: Path) -> List[int]:
+    # Size and modification time, an unchanged stamp means the json does not have to be hashed again
+    stat = file_path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def default_cache_path(kterm_json_path: Path) -> Path:
+    # The compiled hierarchy lives next to the K terms json by default
+    return kterm_json_path.with_name(kterm_json_path.name + BRITE_CACHE_SUFFIX)
+
+
+def read_artifact_header(s) -> Optional[Dict[str, object]]:
+    if s.read(len(BRITE_CACHE_MAGIC)) != BRITE_CACHE_MAGIC:
+        return None
+    header_length = int.from_bytes(s.read(8), "little")
+    header = json.loads(s.read(header_length).decode())
+    return header if isinstance(header, dict) else None
+
+
+def load_brite_hierarchy(cache_path: Path, kterm_json_path: Path) -> Optional[BriteHierarchy]:
+    """
+    Memory maps the compiled hierarchy at cache_path. Returns None if there is no compiled file, if it was written by
+    a different version of this script, or if it was compiled from a different K terms json. The json is only hashed
+    if its size or modification time changed since it was compiled. If it was touched but its contents are the same,
+    the compiled hierarchy is saved again with the new stamp, so the json is not hashed again on the next run.
+    """
+    if not cache_path.is_file():
+        return None
+    try:
+        with open(cache_path, "rb") as s:
+            header = read_artifact_header(s)
+            if header is None or header.get("version") != BRITE_CACHE_VERSION:
+                return None
+            db_stamp = file_stamp(kterm_json_path)
+            stamp_changed = header.get("db_stamp") != db_stamp
+            if stamp_changed and header.get("db_hash") != hash_kterm_json(kterm_json_path):
+                return None
+            # The arrays are views of the mapping, which stays open as long as they are referenced
+            mapped = mmap.mmap(s.fileno(), 0, access=mmap.ACCESS_READ)
+        arrays = dict()
+        for field in BriteHierarchy.ARRAY_FIELDS:
+            dtype, length, offset = header["arrays"][field]
+            if length == 0:
+                arrays[field] = np.zeros(0, dtype=dtype)
+            else:
+                arrays[field] = np.frombuffer(mapped, dtype=dtype, count=length, offset=offset)
+        hierarchy = BriteHierarchy(**arrays)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Could not read the compiled hierarchy from {cache_path}: {e}")
+        return None
+    if stamp_changed:
+        save_brite_hierarchy(cache_path, db_stamp, header["db_hash"], hierarchy)
+    return hierarchy
+
+
+def save_brite_hierarchy(cache_path: Path, db_stamp: List[int], db_hash: str, hierarchy: BriteHierarchy):
+    """
+    Writes the compiled hierarchy to cache_path. The file is written to a temporary file first and then moved into
+    place, so concurrent array tasks never see a partially written file.
+    """
+    arrays = [np.ascontiguousarray(getattr(hierarchy, field)) for field in BriteHierarchy.ARRAY_FIELDS]
+    arrays = [array.astype(array.dtype.newbyteorder("<")) for array in arrays]
+    header = {"version": BRITE_CACHE_VERSION, "db_hash": db_hash, "db_stamp": db_stamp, "arrays": dict()}
+    # The header holds the array offsets, so its length is fixed first with placeholder offsets of the same width
+    for field, array in zip(BriteHierarchy.ARRAY_FIELDS, arrays):
+        header["arrays"][field] = [array.dtype.str, len(array), 10 ** 15]
+    header_length = len(json.dumps(header).encode())
+    offset = -(-(len(BRITE_CACHE_MAGIC) + 8 + header_length) // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+    for field, array in zip(BriteHierarchy.ARRAY_FIELDS, arrays):
+        header["arrays"][field][2] = offset
+        offset += -(-array.nbytes // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+    header_bytes = json.dumps(header).encode().ljust(header_length)
+
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "wb") as s:
+            s.write(BRITE_CACHE_MAGIC)
+            s.write(len(header_bytes).to_bytes(8, "little"))
+            s.write(header_bytes)
+            for field, array in zip(BriteHierarchy.ARRAY_FIELDS, arrays):
+                s.write(b"\0" * (header["arrays"][field][2] - s.tell()))
+                s.write(array.tobytes())
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Could not write the compiled hierarchy to {cache_path}: {e}")
+        if tmp_path.exists():
+            tmp_path.unlink()
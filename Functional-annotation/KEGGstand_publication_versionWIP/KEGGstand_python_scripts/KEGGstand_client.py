@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Thin client of the KEGGstand worker daemon (KEGGstand_daemon.py). Takes the command line of KEGGstand_module_checker.py
+(with -m) or KEGGstand_BRITE_checker.py (with -k) unchanged, sends it to the daemon over its Unix socket and prints the
+output of the job. The daemon already holds the compiled modules and the BRITE hierarchy in memory, so a job only costs
+the scoring of the sample(s) itself. The client imports neither pandas nor networkx.
+
+If no daemon is listening on the socket, the job is run in this process instead (with the same result, but with the
+full start up cost), unless --no_fallback is given.
+
+Usage:
+(python) KEGGstand_client.py -m KEGG_module_database -e input.emapper.annotations -o output.tsv [module checker options]
+(python) KEGGstand_client.py -k KEGG_k_term_database.json -e input.emapper.annotations -o output.tsv [BRITE checker options]
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+SOCKET_ENV = "KEGGSTAND_SOCKET"
+# Options of the two checkers that take no value, every other option is followed by its value
+CHECKER_FLAGS = {"-h", "--help", "--store_kterms", "--no_cache", "--profile", "--cprofile"}
+
+
+def default_socket_path() -> Path:
+    # One daemon per user and node, unless KEGGSTAND_SOCKET points elsewhere. The socket is in a directory that only the
+    # user can access (created by the daemon)
+    if SOCKET_ENV in os.environ:
+        return Path(os.environ[SOCKET_ENV])
+    return Path(tempfile.gettempdir()) / f"KEGGstand_{os.getuid()}" / "daemon.sock"
+
+
+def write_message(s, message: Dict[str, object]):
+    # Messages are single lines of JSON
+    s.write((json.dumps(message) + "\n").encode())
+    s.flush()
+
+
+def read_message(s) -> Optional[Dict[str, object]]:
+    line = s.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+def send_request(socket_path: Path, request: Dict[str, object], timeout: Optional[float] = None) -> Dict[str, object]:
+    """
+    Sends one job to the daemon and waits for its response (at most timeout seconds, if given). Raises OSError if no
+    daemon is listening on socket_path.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(socket_path))
+        with sock.makefile("rwb") as s:
+            write_message(s, request)
+            response = read_message(s)
+    if response is None:
+        raise ConnectionError(f"The daemon on {socket_path} closed the connection without a response")
+    return response
+
+
+def find_checker_command(checker_argv: List[str]) -> Optional[str]:
+    """
+    Returns the checker a command line is for: "brite" if its first -k/-m option is -k, "modules" if it is -m, None if
+    it has neither. Option values are skipped, so a value such as -o -k_out.tsv is not taken for an option.
+    """
+    i = 0
+    while i < len(checker_argv):
+        arg = checker_argv[i]
+        if arg.startswith("-k") or arg.startswith("-m"):
+            return "brite" if arg.startswith("-k") else "modules"
+        # The value of an option is the next argument, unless it is attached (-ofile, --cache=file)
+        if arg.startswith("-") and arg not in CHECKER_FLAGS and ((arg.startswith("--") and "=" not in arg) or len(arg) == 2):
+            i += 1
+        i += 1
+    return None
+
+
+def parseargs() -> Tuple[Dict[str, object], Path, bool]:
+    parser = argparse.ArgumentParser(description="Run a KEGGstand job on the worker daemon. All options other than the ones "
+                                                 "below are those of KEGGstand_module_checker.py (with -m) or "
+                                                 "KEGGstand_BRITE_checker.py (with -k)", allow_abbrev=False)
+    parser.add_argument("-s", "--socket", help="Path to the socket of the daemon (default: $KEGGSTAND_SOCKET or a socket in a "
+                                               "per-user directory in the temporary directory)",
+                        dest="socket_path", type=Path, default=None)
+    parser.add_argument("--no_fallback", help="Fail instead of running the job in this process if no daemon is running",
+                        dest="no_fallback", action="store_true")
+    args, checker_argv = parser.parse_known_args()
+    command = find_checker_command(checker_argv)
+    if command is None:
+        parser.error("give the options of the module checker (-m) or of the BRITE checker (-k)")
+
+    # The daemon runs the checker in the working directory of the client, so relative paths stay as they are
+    request = {"command": command, "argv": checker_argv, "cwd": os.getcwd()}
+    socket_path = args.socket_path if args.socket_path is not None else default_socket_path()
+    return request, socket_path, args.no_fallback
+
+
+def main():
+    request, socket_path, no_fallback = parseargs()
+    try:
+        response = send_request(socket_path, request)
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        if no_fallback:
+            print(f"Error, no KEGGstand daemon running on {socket_path}: {e}")
+            sys.exit(1)
+        print(f"No KEGGstand daemon running on {socket_path}, running the job in this process")
+        # Imported here, so the client itself stays light when the daemon is running
+        from KEGGstand_daemon import KEGGstandWorker, run_job
+        response = run_job(KEGGstandWorker(), request, capture_output=False)
+    else:
+        print(response.get("log", ""), end="")
+    if response["status"] != "ok":
+        print(f"Error, the job failed: {response.get('error')}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Vectorized module completion for many samples at once, used by KEGGstand_module_checker.py (--engine cohort).
+
+The K terms of all samples are encoded as a boolean samples x K terms matrix. Every module definition is then
+evaluated once for all samples, using the same profiles as the dp engine (KEGGstand_completion_dp.py), but with
+one column of present gene counts per pathway length instead of a single number:
+  - plain ID: the matrix column of the K term (pathway length 1)
+  - sequence: sums of the columns of the parts (for a chain of plain IDs, the number of present genes)
+  - alternatives: per pathway length the maximum over the alternatives
+  - OPTIONAL: the alternatives of the optional sequences, plus a pathway of length 0 for skipping them
+The pathway lengths that can occur only depend on the definition, not on the sample, so each module is a fixed
+series of array operations. The definitions are evaluated through the shared expression DAG
+(KEGGstand_expression_dag.py), so groups used by several modules are computed once for the whole cohort.
+The result is the samples x modules completion matrix, equal to the completion of the dp engine for every sample.
+"""
+from functools import lru_cache
+from typing import Dict, List, Optional, Set, Tuple, Iterable
+
+import numpy as np
+
+from KEGGstand_expression_dag import ExpressionDAG, build_expression_dag, LEAF, SEQUENCE, OPTIONAL
+
+# Cohort profile: (pathway lengths, samples x pathway lengths array of the most present genes)
+CohortProfile = Tuple[Tuple[int, ...], np.ndarray]
+
+
+def build_ko_matrix(sample_ko_sets: List[Set[str]], ko_names: Iterable[str]) -> Tuple[np.ndarray, Dict[str, int]]:
+    """
+    Encodes the K terms of every sample as a boolean samples x K terms matrix. Only the K terms in ko_names
+    (the K terms used by the modules) get a column. Returns the matrix and the column of each K term.
+    """
+    ko_columns = {ko: i for i, ko in enumerate(ko_names)}
+    ko_matrix = np.zeros((len(sample_ko_sets), len(ko_columns)), dtype=bool)
+    for row, ko_set in enumerate(sample_ko_sets):
+        columns = [ko_columns[ko] for ko in ko_set if ko in ko_columns]
+        ko_matrix[row, columns] = True
+    return ko_matrix, ko_columns
+
+
+def _combine(columns: Dict[int, np.ndarray], length: int, values: np.ndarray):
+    if length in columns:
+        np.maximum(columns[length], values, out=columns[length])
+    else:
+        columns[length] = values.copy()
+
+
+def _to_profile(columns: Dict[int, np.ndarray]) -> CohortProfile:
+    lengths = tuple(sorted(columns))
+    return lengths, np.stack([columns[length] for length in lengths], axis=1)
+
+
+def _chain(first: CohortProfile, second: CohortProfile) -> CohortProfile:
+    first_lengths, first_values = first
+    second_lengths, second_values = second
+    if len(second_lengths) == 1:
+        return tuple(length + second_lengths[0] for length in first_lengths), first_values + second_values
+    if len(first_lengths) == 1:
+        return tuple(length + first_lengths[0] for length in second_lengths), second_values + first_values
+    columns = dict()
+    for i, len1 in enumerate(first_lengths):
+        for j, len2 in enumerate(second_lengths):
+            _combine(columns, len1 + len2, first_values[:, i] + second_values[:, j])
+    return _to_profile(columns)
+
+
+def _merge(profiles: List[CohortProfile]) -> CohortProfile:
+    columns = dict()
+    for lengths, values in profiles:
+        for i, length in enumerate(lengths):
+            _combine(columns, length, values[:, i])
+    return _to_profile(columns)
+
+
+def node_cohort_profile(dag: ExpressionDAG, node_id: int, ko_matrix: np.ndarray, ko_columns: Dict[str, int],
+                        memo: Dict[int, CohortProfile]) -> CohortProfile:
+    """
+    Cohort profile of a node of the shared expression DAG for all samples. Every node is evaluated once, memo
+    holds the profiles of the nodes evaluated so far.
+    """
+    profile = memo.get(node_id)
+    if profile is not None:
+        return profile
+    num_samples = ko_matrix.shape[0]
+    kind = dag.kinds[node_id]
+    args = dag.args[node_id]
+    if kind == LEAF:
+        if args in ko_columns:
+            profile = ((1,), ko_matrix[:, ko_columns[args]].astype(np.int32)[:, None])
+        else:
+            profile = ((1,), np.zeros((num_samples, 1), dtype=np.int32))
+    elif kind == SEQUENCE:
+        profile = ((0,), np.zeros((num_samples, 1), dtype=np.int32))
+        for child in args:
+            profile = _chain(profile, node_cohort_profile(dag, child, ko_matrix, ko_columns, memo))
+    else:
+        profiles = [node_cohort_profile(dag, child, ko_matrix, ko_columns, memo) for child in args]
+        if kind == OPTIONAL:
+            profiles.insert(0, ((0,), np.zeros((num_samples, 1), dtype=np.int32)))
+        profile = _merge(profiles)
+    memo[node_id] = profile
+    return profile
+
+
+@lru_cache(maxsize=None)
+def _rounded_ratio_table(max_length: int) -> np.ndarray:
+    # table[present, required] = round(present / required, 3), so the matrix holds exactly the values of the dp engine
+    table = np.zeros((max_length + 1, max_length + 1))
+    for required in range(1, max_length + 1):
+        for present in range(0, required + 1):
+            table[present, required] = round(present / required, 3)
+    return table
+
+
+def best_completion(profile: CohortProfile) -> np.ndarray:
+    """
+    Best present/required ratio per sample, rounded as in compute_completion_dp.
+    """
+    lengths, values = profile
+    keep = [i for i, length in enumerate(lengths) if length > 0]
+    if not keep:
+        return np.zeros(values.shape[0])
+    required = np.array([lengths[i] for i in keep])
+    present = values[:, keep]
+    best = np.argmax(present / required, axis=1)
+    rows = np.arange(values.shape[0])
+    table = _rounded_ratio_table(int(required.max()))
+    return table[present[rows, best], required[best]]
+
+
+def compute_cohort_completion(parsed_modules: Dict[str, list], sample_ko_sets: List[Set[str]],
+                              expression_dag: Optional[ExpressionDAG] = None) -> np.ndarray:
+    """
+    Completion of every module for every sample. parsed_modules maps the module name to its parsed and merged
+    definition tree. Returns a samples x modules array, with the modules in the order of parsed_modules.
+    expression_dag is the shared expression DAG of the modules, built from parsed_modules if not given.
+    """
+    if expression_dag is None:
+        expression_dag = build_expression_dag(parsed_modules)
+    module_kos = sorted({args for kind, args in zip(expression_dag.kinds, expression_dag.args) if kind == LEAF})
+    ko_matrix, ko_columns = build_ko_matrix(sample_ko_sets, module_kos)
+
+    memo = dict()
+    completion = np.zeros((len(sample_ko_sets), len(parsed_modules)))
+    for i, k_id in enumerate(parsed_modules):
+        root = expression_dag.roots[k_id]
+        completion[:, i] = best_completion(node_cohort_profile(expression_dag, root, ko_matrix, ko_columns, memo))
+    return completion
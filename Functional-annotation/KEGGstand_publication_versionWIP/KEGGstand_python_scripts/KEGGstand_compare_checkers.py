@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Differential harness of the two module checkers. Runs the in-house module checker
+(../../KEGGstand_in_house_KEGG_annotation/KEGGstand_python_scripts/KEGGstand_module_checker.py) and the engines of
+KEGGstand_module_checker.py on the same module database and eggnog files, and compares speed and results:
+    - KEGGstand_checker_diff.tsv: per sample and module the completion, the present genes and the pathway found by
+      every checker, for the modules where an engine disagrees with the in-house checker (or all, with --all_modules)
+    - KEGGstand_checker_timing.tsv: per checker and phase (module_db, ko_parse, completion) the wall time, CPU time
+      and peak memory, see KEGGstand_profiling.py
+The checkers run one after the other, each over all samples, and the module database is not cached, so each
+checker's module_db phase includes parsing the database from scratch.
+
+Usage: (python) KEGGstand_compare_checkers.py -m KEGG_module_database -b /dir/with/eggnog/output -o /output/dir [--engine graph dp]
+"""
+from typing import Dict, List, Optional, Tuple, Union
+import os
+import gc
+import argparse
+import importlib.util
+from contextlib import redirect_stdout
+from pathlib import Path
+
+import pandas as pd
+
+from KEGGstand_module_checker import KEGG_module_reader, compile_module_db_subset, get_pathway_graphs, \
+    find_in_which_pathway, compute_completion_of_all_pathways, compute_completion_of_all_pathways_dp
+from KEGGstand_batch_inputs import collect_batch_inputs, get_input_name, get_sample_name
+from KEGGstand_eggnog_reader import read_ko_set
+from KEGGstand_profiling import PhaseProfiler
+
+INHOUSE_CHECKER_PATH = Path(__file__).resolve().parents[2] / "KEGGstand_in_house_KEGG_annotation" / \
+    "KEGGstand_python_scripts" / "KEGGstand_module_checker.py"
+DIFF_FILE_NAME = "KEGGstand_checker_diff.tsv"
+TIMING_FILE_NAME = "KEGGstand_checker_timing.tsv"
+# Completions are compared at the precision of the publication version, which rounds them to 3 decimals
+COMPLETION_DECIMALS = 3
+
+# Completion of a module as compared here: (completion, present genes on the pathway found, pathway found), or None if
+# the checker found no pathway (the graph engine's "no path" error)
+Completion = Optional[Tuple[float, List[str], List[str]]]
+
+
+def load_inhouse_checker(script_path: Path):
+    # Both scripts are called KEGGstand_module_checker, so the in-house one is imported under another name
+    spec = importlib.util.spec_from_file_location("KEGGstand_in_house_module_checker", script_path)
+    inhouse_checker = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(inhouse_checker)
+    return inhouse_checker
+
+
+######################### Running the checkers
+
+def run_inhouse_checker(inhouse_checker, mod_path: Path, eggnog_paths: List[Path], profiler: PhaseProfiler,
+                        max_searched_combinations: Optional[int] = None) -> Dict[str, Dict[str, Completion]]:
+    """
+    Runs the in-house module checker on every sample. Returns per sample name the completion of every module.
+    """
+    with profiler.phase("module_db"):
+        kegg_dict = inhouse_checker.KEGG_module_reader(str(mod_path))
+        prepared_modules = inhouse_checker.prepare_modules(kegg_dict)
+    sample_completions = dict()
+    for eggnog_path in eggnog_paths:
+        with profiler.phase("ko_parse"):
+            kterms_list = inhouse_checker.eggnog_parser(str(eggnog_path))
+        with profiler.phase("completion"):
+            completion_dict = inhouse_checker.pathway_completion_checker(kegg_dict, kterms_list, prepared_modules,
+                                                                         max_searched_combinations)
+        # Modules without any combination of genes are left out of the in-house output, they count as 0 here. The
+        # pathway the in-house checker reports (Most_complete_pathway) is the present genes of its best combination
+        sample_completions[get_sample_name(eggnog_path)] = {k_id: (completion_dict[k_id][0], completion_dict[k_id][1],
+                                                                   completion_dict[k_id][1])
+                                                            if k_id in completion_dict else (0.0, [], [])
+                                                            for k_id in kegg_dict}
+    profiler.count("modules", len(kegg_dict))
+    profiler.count("samples", len(eggnog_paths))
+    return sample_completions
+
+
+def run_engine(engine: str, mod_path: Path, eggnog_paths: List[Path], profiler: PhaseProfiler) \
+        -> Dict[str, Dict[str, Completion]]:
+    """
+    Runs KEGGstand_module_checker.py with the given engine (graph or dp) on every sample. Returns per sample name the
+    completion of every module.
+    """
+    with profiler.phase("module_db"):
+        kegg_dict = KEGG_module_reader(mod_path)
+        compiled_modules, ko_index, expression_dag = compile_module_db_subset(kegg_dict, engine)
+        kegg_pathways = get_pathway_graphs(compiled_modules)
+    sample_completions = dict()
+    for eggnog_path in eggnog_paths:
+        with profiler.phase("ko_parse"):
+            eggnog_kterms = read_ko_set(eggnog_path)
+        with profiler.phase("completion"):
+            pathways_with_target_genes = find_in_which_pathway(eggnog_kterms, kegg_pathways, ko_index)
+            if engine == "dp":
+                completion_dict = compute_completion_of_all_pathways_dp(compiled_modules, pathways_with_target_genes,
+                                                                        expression_dag)
+            else:
+                completion_dict = compute_completion_of_all_pathways(kegg_pathways, pathways_with_target_genes,
+                                                                     skip_no_path=True)
+        # The modules the graph engine found no path for are missing
+        sample_completions[get_sample_name(eggnog_path)] = {
+            k_id: (completion_dict[k_id]["completion"], completion_dict[k_id]["present_genes"], completion_dict[k_id]["pathway"])
+            if k_id in completion_dict else None for k_id in kegg_pathways}
+    profiler.count("modules", len(kegg_dict))
+    profiler.count("samples", len(eggnog_paths))
+    profiler.count("failed_modules", sum(c is None for completions in sample_completions.values()
+                                         for c in completions.values()))
+    return sample_completions
+
+
+######################### Comparing the results
+
+def completions_agree(reference: Completion, other: Completion) -> bool:
+    # Same completion (at the precision of the publication version) and the same present genes on the pathway
+    if reference is None or other is None:
+        return reference is other
+    return round(reference[0], COMPLETION_DECIMALS) == round(other[0], COMPLETION_DECIMALS) and \
+        set(reference[1]) == set(other[1])
+
+
+def format_completion(completion: Completion) -> Tuple[Union[float, str], str, str]:
+    if completion is None:
+        return "no_path", "", ""
+    return completion[0], ",".join(completion[1]), ",".join(completion[2])
+
+
+def build_diff_table(results: Dict[str, Dict[str, Dict[str, Completion]]], engines: List[str],
+                     all_modules: bool = False) -> pd.DataFrame:
+    """
+    One row per sample and module with the completion, present genes and pathway found by every checker, and per
+    engine whether it agrees with the in-house checker. Without all_modules only the rows where some engine disagrees are kept.
+    """
+    rows = []
+    reference_results = results["inhouse"]
+    for sample_name, reference_completions in reference_results.items():
+        for k_id, reference in reference_completions.items():
+            agrees = {engine: completions_agree(reference, results[engine][sample_name].get(k_id)) for engine in engines}
+            if not all_modules and all(agrees.values()):
+                continue
+            row = {"sample": sample_name, "module": k_id.split(" ")[0], "description": k_id.partition(" ")[2]}
+            row["inhouse_completion"], row["inhouse_present_genes"], row["inhouse_pathway"] = format_completion(reference)
+            for engine in engines:
+                row[f"{engine}_completion"], row[f"{engine}_present_genes"], row[f"{engine}_pathway"] = \
+                    format_completion(results[engine][sample_name].get(k_id))
+                row[f"{engine}_agrees"] = agrees[engine]
+            rows.append(row)
+    columns = ["sample", "module", "description", "inhouse_completion", "inhouse_present_genes", "inhouse_pathway"]
+    for engine in engines:
+        columns += [f"{engine}_completion", f"{engine}_present_genes", f"{engine}_pathway", f"{engine}_agrees"]
+    return pd.DataFrame(rows, columns=columns)
+
+
+def count_agreement(results: Dict[str, Dict[str, Dict[str, Completion]]], engine: str) -> Tuple[int, int, int]:
+    # Number of (sample, module) pairs, and how many have the same completion, and also the same present genes
+    total = same_completion = same_genes = 0
+    for sample_name, reference_completions in results["inhouse"].items():
+        for k_id, reference in reference_completions.items():
+            other = results[engine][sample_name].get(k_id)
+            total += 1
+            if reference is not None and other is not None and \
+                    round(reference[0], COMPLETION_DECIMALS) == round(other[0], COMPLETION_DECIMALS):
+                same_completion += 1
+                same_genes += completions_agree(reference, other)
+    return total, same_completion, same_genes
+
+
+def build_timing_table(profiles: Dict[str, Dict[str, dict]]) -> pd.DataFrame:
+    # One row per checker and phase, plus the total of every checker
+    rows = []
+    for checker, profile in profiles.items():
+        num_samples = profile["counts"]["samples"]
+        for phase, record in list(profile["phases"].items()) + [("total", profile["total"])]:
+            row = {"checker": checker, "phase": phase, "wall_s": record["wall_s"], "cpu_s": record["cpu_s"],
+                   "wall_s_per_sample": round(record["wall_s"] / num_samples, 6) if phase != "module_db" else "",
+                   "peak_rss_mb": record["peak_rss_mb"]}
+            if "traced_peak_mb" in record:
+                row["traced_peak_mb"] = record["traced_peak_mb"]
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+######################### Main
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compare the in-house and publication module checkers on the same inputs")
+    parser.add_argument("-m", help="Path to the KEGG module database", required=True, dest="mod_path", type=Path)
+    parser.add_argument("-b", "--batch", help="Eggnog files to compare on: a directory (every *.emapper.annotations "
+                                              "file in it), a text file listing one file per line, or a glob pattern "
+                                              "within quotation marks", required=True, dest="batch_input")
+    parser.add_argument("-o", help="Output directory for the diff and timing tables", required=True, dest="out_dir", type=Path)
+    parser.add_argument("--engine", help="Engines of KEGGstand_module_checker.py to compare", dest="engines", nargs="+",
+                        choices=["graph", "dp"], default=["graph", "dp"])
+    parser.add_argument("--inhouse", help="Path to the in-house KEGGstand_module_checker.py", dest="inhouse_path",
+                        type=Path, default=INHOUSE_CHECKER_PATH)
+    parser.add_argument("--max_searched_combinations", help="Passed on to the in-house checker", dest="max_searched_combinations",
+                        type=int, default=None)
+    parser.add_argument("--all_modules", help="Write every sample and module to the diff table, not only the differences",
+                        dest="all_modules", action="store_true")
+    parser.add_argument("--trace_memory", help="Also trace the peak Python allocations per phase (slower)",
+                        dest="trace_memory", action="store_true")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    mod_path = args.mod_path.resolve()
+    out_dir = args.out_dir.resolve()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    eggnog_paths = collect_batch_inputs(args.batch_input)
+    # The in-house checker only reads uncompressed annotation files
+    unreadable = [p for p in eggnog_paths if get_input_name(p) != p.name]
+    if unreadable:
+        raise ValueError(f"The in-house checker cannot read compressed annotations or K term stores: {', '.join(map(str, unreadable))}")
+    inhouse_checker = load_inhouse_checker(args.inhouse_path)
+
+    results = dict()
+    profiles = dict()
+    for checker in ["inhouse"] + args.engines:
+        print(f"Running the {checker} checker on {len(eggnog_paths)} samples")
+        profiler = PhaseProfiler(trace_memory=args.trace_memory)
+        # Both checkers print every module, which would mostly measure the terminal
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            if checker == "inhouse":
+                results[checker] = run_inhouse_checker(inhouse_checker, mod_path, eggnog_paths, profiler,
+                                                       args.max_searched_combinations)
+            else:
+                results[checker] = run_engine(checker, mod_path, eggnog_paths, profiler)
+        profiler.stop()
+        profiles[checker] = profiler.to_dict()
+        # Free the module database of this checker before timing the next one
+        gc.collect()
+        phase_times = ", ".join(f"{name} {p['wall_s']:.3f}s" for name, p in profiles[checker]["phases"].items())
+        print(f"  {phase_times}, peak RSS {profiles[checker]['total']['peak_rss_mb']:.1f} MB")
+
+    for engine in args.engines:
+        total, same_completion, same_genes = count_agreement(results, engine)
+        print(f"{engine}: {same_completion} of {total} module completions agree with the in-house checker, "
+              f"{same_genes} also with the same present genes")
+        if engine == "graph":
+            print(f"  {profiles[engine]['counts']['failed_modules']} without a path through the present genes")
+
+    diff_path = out_dir / DIFF_FILE_NAME
+    print(f"Saving the per-module differences to {diff_path}")
+    build_diff_table(results, args.engines, args.all_modules).to_csv(diff_path, sep="\t", index=False)
+    timing_path = out_dir / TIMING_FILE_NAME
+    print(f"Saving the timing table to {timing_path}")
+    build_timing_table(profiles).to_csv(timing_path, sep="\t", index=False)
+
+
+if __name__ == "__main__":
+    main()
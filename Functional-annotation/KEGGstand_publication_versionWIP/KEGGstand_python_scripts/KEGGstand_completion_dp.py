@@ -0,0 +1,190 @@
+"""
+Exact module completion by dynamic programming over the parsed KEGG definition tree, used by
+KEGGstand_module_checker.py (--engine dp).
+
+The completion of a pathway is (present genes on the pathway) / (genes on the pathway), where genes of an optional
+chain only count if the chain is taken. Because the best ratio of a sequence is not the sum of the best ratios
+of its parts, every subtree is summarized as a profile: for each possible number of genes on the pathway
+(required), the highest number of present genes that can be reached, with a witness pathway.
+The profiles are combined bottom-up:
+  - plain ID: one gene, present or not
+  - sequence: the required and present counts of the parts add up
+  - alternatives: per required count the best of the alternatives
+  - OPTIONAL: either skip (0 genes) or take one of the optional sequences
+Only entries where more genes also means more present genes are kept: a longer pathway with the same number of
+present genes can never give a higher completion, whatever it is combined with. Subtrees without present genes
+therefore collapse to their shortest pathway, and every module is scored in a single bottom-up pass over its
+definition, without any graph search.
+
+With the shared expression DAG (KEGGstand_expression_dag.py) the profiles are memoized per DAG node, so a group
+used by several modules is only evaluated once per sample.
+"""
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from KEGGstand_expression_dag import ExpressionDAG, LEAF, SEQUENCE, ALTERNATIVES
+
+# A witness pathway is stored as a nested pair (left, right) of witnesses, a (K term, is_optional) leaf, or None
+# for an empty pathway. Chaining two witnesses is then O(1); flatten_witness turns it into the list of genes.
+Witness = Optional[tuple]
+# Profile: required genes -> (present genes, witness pathway)
+Profile = Dict[int, Tuple[int, Witness]]
+
+_EMPTY_PROFILE: Profile = {0: (0, None)}
+
+
+def _prune_profile(profile: Profile) -> Profile:
+    # Keep the entries where the present genes strictly increase with the required genes
+    pruned = dict()
+    best_present = -1
+    for required in sorted(profile):
+        present, witness = profile[required]
+        if present > best_present:
+            pruned[required] = (present, witness)
+            best_present = present
+    return pruned
+
+
+def _merge_profiles(profiles: List[Profile]) -> Profile:
+    # Alternatives: per required count keep the most present genes, earlier alternatives win ties
+    merged = dict()
+    for profile in profiles:
+        for required, (present, witness) in profile.items():
+            if required not in merged or present > merged[required][0]:
+                merged[required] = (present, witness)
+    return _prune_profile(merged)
+
+
+def _chain_witness(wit1: Witness, wit2: Witness) -> Witness:
+    if wit1 is None:
+        return wit2
+    if wit2 is None:
+        return wit1
+    return wit1, wit2
+
+
+def _chain_profiles(first: Profile, second: Profile) -> Profile:
+    # Sequence: every combination of the two parts, per summed required count keep the most present genes
+    if len(second) == 1:
+        # Chaining a single pathway only shifts the profile, which keeps it pruned
+        ((req2, (pres2, wit2)),) = second.items()
+        return {req1 + req2: (pres1 + pres2, _chain_witness(wit1, wit2)) for req1, (pres1, wit1) in first.items()}
+    chained = dict()
+    for req1, (pres1, wit1) in first.items():
+        for req2, (pres2, wit2) in second.items():
+            required = req1 + req2
+            present = pres1 + pres2
+            if required not in chained or present > chained[required][0]:
+                chained[required] = (present, _chain_witness(wit1, wit2))
+    return _prune_profile(chained)
+
+
+def sequence_profile(elements: list, present_genes: Set[str], optional_context: bool = False) -> Profile:
+    """
+    Profile of a parsed sequence (the output of parse_sequence / recursive_merge). Each element is
+    a plain ID (string), a list of alternative sequences, or an ("OPTIONAL", list_of_sequences) tuple.
+    """
+    profile = _EMPTY_PROFILE
+    for elem in elements:
+        if isinstance(elem, str):
+            elem_profile = {1: (1 if elem in present_genes else 0, (elem, optional_context))}
+        elif isinstance(elem, list):
+            elem_profile = _merge_profiles([sequence_profile(alt_seq, present_genes, optional_context) for alt_seq in elem])
+        else:
+            tag, seqs = elem
+            if tag != "OPTIONAL":
+                raise ValueError(f"Unexpected element: {elem!r}")
+            taken = [sequence_profile(seq, present_genes, optional_context=True) for seq in seqs]
+            elem_profile = _merge_profiles([_EMPTY_PROFILE] + taken)
+        profile = _chain_profiles(profile, elem_profile)
+    return profile
+
+
+def node_profile(dag: ExpressionDAG, node_id: int, present_genes: Set[str], memo: Dict[int, Profile]) -> Profile:
+    """
+    Profile of a node of the shared expression DAG. memo holds the profiles already computed for this sample and
+    is filled in along the way, so it must only be reused for the same present_genes.
+    """
+    profile = memo.get(node_id)
+    if profile is not None:
+        return profile
+    kind = dag.kinds[node_id]
+    args = dag.args[node_id]
+    if kind == LEAF:
+        profile = {1: (1 if args in present_genes else 0, (args, dag.optional_context[node_id]))}
+    elif kind == SEQUENCE:
+        profile = _EMPTY_PROFILE
+        for child in args:
+            profile = _chain_profiles(profile, node_profile(dag, child, present_genes, memo))
+    elif kind == ALTERNATIVES:
+        profile = _merge_profiles([node_profile(dag, child, present_genes, memo) for child in args])
+    else:
+        profile = _merge_profiles([_EMPTY_PROFILE] + [node_profile(dag, child, present_genes, memo) for child in args])
+    memo[node_id] = profile
+    return profile
+
+
+def flatten_witness(witness: Witness) -> List[Tuple[str, bool]]:
+    # Iterative in-order walk of the nested witness pairs
+    genes = []
+    stack = [witness]
+    while stack:
+        node = stack.pop()
+        if node is None:
+            continue
+        if isinstance(node[0], str):
+            genes.append(node)
+        else:
+            stack.append(node[1])
+            stack.append(node[0])
+    return genes
+
+
+def best_ratio(profile: Profile) -> Tuple[int, int, Witness]:
+    """
+    Returns (present, required, witness) with the highest present/required ratio in the profile. Ties are broken
+    in favour of the pathway explaining the most present genes.
+    """
+    best_present, best_required, best_witness = 0, 0, None
+    for required, (present, witness) in sorted(profile.items()):
+        if required == 0:
+            continue
+        if best_required == 0:
+            best_present, best_required, best_witness = present, required, witness
+            continue
+        # Compare present/required ratios without floating point rounding
+        lhs = present * best_required
+        rhs = best_present * required
+        if lhs > rhs or (lhs == rhs and present > best_present):
+            best_present, best_required, best_witness = present, required, witness
+    return best_present, best_required, best_witness
+
+
+def completion_from_profile(profile: Profile, present_genes: Set[str]) -> Dict[str, Union[float, List[str]]]:
+    """
+    Best completion of a module profile and its witness pathway, in the same format as compute_completion.
+    """
+    present, required, witness = best_ratio(profile)
+    if required == 0 or present == 0:
+        return {"completion": 0.0, "present_genes": [], "pathway": [], "optional": []}
+    witness_genes = flatten_witness(witness)
+    pathway = [gene for gene, _ in witness_genes]
+    pathway_present = [gene for gene in pathway if gene in present_genes]
+    optional_genes = [gene for gene, is_optional in witness_genes if is_optional]
+    completion = round(present / required, 3)
+    return {"completion": completion, "present_genes": pathway_present, "pathway": pathway, "optional": optional_genes}
+
+
+def compute_completion_dp(parsed_clean: list, present_genes: Set[str]) -> Dict[str, Union[float, List[str]]]:
+    """
+    Best completion of a module and its witness pathway, in the same format as compute_completion.
+    """
+    return completion_from_profile(sequence_profile(parsed_clean, present_genes), present_genes)
+
+
+def compute_completion_dag(dag: ExpressionDAG, k_id: str, present_genes: Set[str], memo: Dict[int, Profile]) \
+        -> Dict[str, Union[float, List[str]]]:
+    """
+    Same as compute_completion_dp for the module k_id of the shared expression DAG, reusing (and filling) the
+    per-sample profile memo.
+    """
+    return completion_from_profile(node_profile(dag, dag.roots[k_id], present_genes, memo), present_genes)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Resident KEGGstand worker for workloads of many small jobs (e.g. Slurm arrays scoring one genome per task).
+
+The daemon loads the module database(s) and the K term database(s) once, compiles the module graphs and the
+BRITE hierarchy, and then accepts jobs on a Unix socket. Jobs are sent by KEGGstand_client.py: the command line of
+KEGGstand_module_checker.py or KEGGstand_BRITE_checker.py, which the daemon runs on the databases it holds. Every job
+runs in a forked child process, which inherits the compiled databases copy-on-write (as the worker processes of the
+module checker batch mode), so several jobs run in parallel and a failing job cannot affect the daemon.
+
+The database of a job is looked up by the daemon itself before the job is forked: a database that was not given at
+start up, or whose file changed, is loaded once and kept for the jobs after it.
+
+Usage: (python) KEGGstand_daemon.py -m KEGG_module_database -k KEGG_k_term_database.json [-s socket] [-j max_jobs]
+"""
+import argparse
+import io
+import os
+import signal
+import socketserver
+import stat
+import sys
+from contextlib import nullcontext, redirect_stderr, redirect_stdout
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from KEGGstand_client import SOCKET_ENV, default_socket_path, read_message, send_request, write_message
+import KEGGstand_module_checker as module_checker
+import KEGGstand_BRITE_checker as brite_checker
+
+# Seconds a client has to send its job, the daemon waits for it before forking
+REQUEST_TIMEOUT = 10
+
+
+def file_stamp(file_path: Path) -> Tuple[int, int]:
+    # A database is reloaded when its file changes
+    file_stat = file_path.stat()
+    return file_stat.st_mtime_ns, file_stat.st_size
+
+
+class KEGGstandWorker:
+    """
+    Compiled module databases and BRITE hierarchies, per database path. get_modules and get_brite_hierarchy take the
+    arguments of load_or_compile_modules and load_or_compile_hierarchy, and replace them in the checkers.
+    """
+
+    def __init__(self, cache_path: Optional[Path] = None, use_cache: bool = True):
+        self.cache_path = cache_path
+        self.use_cache = use_cache
+        self.module_dbs: Dict[Path, Tuple[Tuple[int, int], tuple]] = dict()
+        self.brite_hierarchies: Dict[Path, Tuple[Tuple[int, int], object]] = dict()
+
+    def get_modules(self, mod_path: Path, cache_path: Optional[Path] = None, use_cache: bool = True, profiler=None) -> tuple:
+        # (compiled modules, KO index, expression DAG) of a module database. The compiled artifact options of the job
+        # only matter when the database is not in memory yet
+        stamp = file_stamp(mod_path)
+        if mod_path not in self.module_dbs or self.module_dbs[mod_path][0] != stamp:
+            compiled = module_checker.load_or_compile_modules(mod_path, cache_path if cache_path is not None else self.cache_path,
+                                                              use_cache and self.use_cache, profiler)
+            self.module_dbs[mod_path] = (stamp, compiled)
+        return self.module_dbs[mod_path][1]
+
+    def get_brite_hierarchy(self, kterm_json_path: Path, cache_path: Optional[Path] = None, use_cache: bool = True,
+                            profiler=None):
+        # The daemon's -c only moves the module artifact, the compiled hierarchy is next to the k terms json by default
+        stamp = file_stamp(kterm_json_path)
+        if kterm_json_path not in self.brite_hierarchies or self.brite_hierarchies[kterm_json_path][0] != stamp:
+            brite_hierarchy = brite_checker.load_or_compile_hierarchy(kterm_json_path, cache_path, use_cache and self.use_cache,
+                                                                      profiler)
+            self.brite_hierarchies[kterm_json_path] = (stamp, brite_hierarchy)
+        return self.brite_hierarchies[kterm_json_path][1]
+
+    def loaded(self) -> Dict[str, List[str]]:
+        return {"modules": [str(p) for p in self.module_dbs], "brite": [str(p) for p in self.brite_hierarchies]}
+
+
+def run_modules_job(worker: KEGGstandWorker, argv: List[str]):
+    module_checker.main(argv, load_modules=worker.get_modules)
+
+
+def run_brite_job(worker: KEGGstandWorker, argv: List[str]):
+    brite_checker.main(argv, load_hierarchy=worker.get_brite_hierarchy)
+
+
+JOBS = {"modules": run_modules_job, "brite": run_brite_job}
+
+
+def prepare_job(worker: KEGGstandWorker, request: Dict[str, object]):
+    """
+    Loads the database of a job into the worker. Runs in the daemon before the job is forked, so the database is kept
+    for the jobs after it. Errors are left to the job itself, which reports them to the client.
+    """
+    cwd = Path(request.get("cwd", "."))
+    try:
+        with redirect_stderr(io.StringIO()):
+            if request.get("command") == "modules":
+                args = module_checker.parse_args(request["argv"])
+                # A refresh only compiles the changed modules
+                if args.old_mod_path is None:
+                    worker.get_modules((cwd / args.mod_path).resolve(),
+                                       (cwd / args.cache_path).resolve() if args.cache_path is not None else None,
+                                       not args.no_cache)
+            elif request.get("command") == "brite":
+                args = brite_checker.parseargs(request["argv"])
+                worker.get_brite_hierarchy((cwd / args.kterm_json_path).resolve(),
+                                           (cwd / args.cache_path).resolve() if args.cache_path is not None else None,
+                                           not args.no_cache)
+    except (Exception, SystemExit):
+        pass
+
+
+def run_job(worker: KEGGstandWorker, request: Dict[str, object], capture_output: bool = True,
+            daemon_pid: Optional[int] = None) -> Dict[str, object]:
+    """
+    Runs one job in the working directory of the client and returns the response: status ("ok" or "error"), the error
+    if any, and the printed output of the job if capture_output. A status request is answered with the loaded
+    databases and daemon_pid (the job itself runs in a forked child).
+    """
+    log = io.StringIO()
+    try:
+        with redirect_stdout(log) if capture_output else nullcontext(), redirect_stderr(log) if capture_output else nullcontext():
+            if request.get("command") == "status":
+                return {"status": "ok", "loaded": worker.loaded(), "pid": daemon_pid if daemon_pid is not None else os.getpid()}
+            if request.get("command") not in JOBS:
+                raise ValueError(f"Unknown command: {request.get('command')!r}")
+            os.chdir(request["cwd"])
+            JOBS[request["command"]](worker, request["argv"])
+    except SystemExit as e:
+        # Invalid options (the checker printed its usage), -h exits with 0
+        if e.code not in (None, 0):
+            return {"status": "error", "error": f"exit status {e.code}", "log": log.getvalue()}
+    except Exception as e:
+        return {"status": "error", "error": repr(e), "log": log.getvalue()}
+    return {"status": "ok", "log": log.getvalue()}
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # The job was already read by the daemon (ForkingUnixServer.process_request)
+        request = self.server.pending_request
+        if request is None:
+            return
+        print(f"Job {request.get('command')}: {' '.join(request.get('argv', []))}")
+        response = run_job(self.server.worker, request, daemon_pid=self.server.daemon_pid)
+        write_message(self.wfile, response)
+
+
+class ForkingUnixServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    def process_request(self, request, client_address):
+        # The job is read before forking, so its database is loaded here and kept, instead of in the child of the job
+        request.settimeout(REQUEST_TIMEOUT)
+        try:
+            with request.makefile("rb") as s:
+                self.pending_request = read_message(s)
+        except (OSError, ValueError):
+            self.pending_request = None
+        request.settimeout(None)
+        if self.pending_request is not None:
+            prepare_job(self.worker, self.pending_request)
+        super().process_request(request, client_address)
+
+
+def make_private_dir(dir_path: Path):
+    # The default socket directory is shared by nobody: jobs write files as the user running the daemon
+    dir_path.mkdir(mode=0o700, exist_ok=True)
+    dir_stat = dir_path.lstat()
+    if not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid() or dir_stat.st_mode & 0o077:
+        raise PermissionError(f"{dir_path} must be a directory owned by you that only you can access (mode 700)")
+
+
+def check_socket_free(socket_path: Path):
+    """
+    Removes a socket left behind by a daemon that is no longer running. Raises an error if a daemon still answers on
+    socket_path, or if socket_path is not a socket.
+    """
+    if not os.path.lexists(socket_path):
+        return
+    if not stat.S_ISSOCK(socket_path.lstat().st_mode):
+        raise FileExistsError(f"{socket_path} exists and is not a socket")
+    try:
+        send_request(socket_path, {"command": "status"}, timeout=5)
+    except (ConnectionRefusedError, FileNotFoundError):
+        socket_path.unlink()
+        return
+    except OSError:
+        # Something accepted the connection, but did not answer as a daemon would
+        pass
+    raise RuntimeError(f"A KEGGstand daemon is already running on {socket_path}")
+
+
+def stop_on_sigterm(signum, frame):
+    # scancel and kill send SIGTERM, which should stop the daemon (and remove the socket) as Ctrl-C does
+    raise KeyboardInterrupt()
+
+
+def parseargs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Resident KEGGstand worker, jobs are sent with KEGGstand_client.py")
+    parser.add_argument("-m", help="Path to a module file to keep compiled in memory (can be given more than once)",
+                        dest="mod_paths", type=Path, action="append", default=[])
+    parser.add_argument("-k", help="Path to a k terms json file to keep in memory (can be given more than once)",
+                        dest="kterm_json_paths", type=Path, action="append", default=[])
+    parser.add_argument("-s", "--socket", help="Path to the socket to listen on (default: $KEGGSTAND_SOCKET or a socket in a "
+                                               "per-user directory in the temporary directory)", dest="socket_path", type=Path,
+                        default=None)
+    parser.add_argument("-j", "--max_jobs", help="Maximum number of jobs running in parallel", dest="max_jobs", type=int,
+                        default=os.cpu_count())
+    parser.add_argument("-c", "--cache", help="Path to the compiled module artifact (default: next to the module file)",
+                        dest="cache_path", type=Path, default=None)
+    parser.add_argument("--no_cache", help="Always parse the module and k terms files, do not read or write the compiled artifacts",
+                        dest="no_cache", action="store_true")
+    return parser.parse_args()
+
+
+def main():
+    args = parseargs()
+    socket_path = args.socket_path if args.socket_path is not None else default_socket_path()
+    try:
+        if args.socket_path is None and SOCKET_ENV not in os.environ:
+            make_private_dir(socket_path.parent)
+        check_socket_free(socket_path)
+    except (OSError, RuntimeError) as e:
+        print(f"Error, cannot listen on {socket_path}: {e}")
+        sys.exit(1)
+    worker = KEGGstandWorker(args.cache_path.resolve() if args.cache_path is not None else None, not args.no_cache)
+    for mod_path in args.mod_paths:
+        worker.get_modules(mod_path.resolve())
+    for kterm_json_path in args.kterm_json_paths:
+        worker.get_brite_hierarchy(kterm_json_path.resolve())
+
+    # Only the user running the daemon can connect to it: a job reads and writes any file the daemon's user can
+    old_umask = os.umask(0o077)
+    try:
+        server = ForkingUnixServer(str(socket_path), JobHandler)
+    finally:
+        os.umask(old_umask)
+    os.chmod(socket_path, 0o600)
+    server.worker = worker
+    server.daemon_pid = os.getpid()
+    server.max_children = args.max_jobs
+    signal.signal(signal.SIGTERM, stop_on_sigterm)
+    print(f"Listening on {socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping")
+    finally:
+        server.server_close()
+        if socket_path.exists():
+            socket_path.unlink()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Shared reader of EggNOG .emapper.annotations files, used by KEGGstand_module_checker.py, KEGGstand_BRITE_checker.py
+and Eggnog_KEGG_KO_extracter.py.
+
+The KEGG_ko column is looked up in the #query header line instead of being hardcoded, and every line is only split
+up to that column. Lines are processed as bytes, only the distinct KEGG_ko fields are decoded and split into K terms.
+Files compressed with gzip or bz2 are recognized by their first bytes and read transparently. The K terms are
+collected into a set (or a Counter of the number of genes per K term) while streaming, so the full list of K terms
+with duplicates is never held in memory.
+
+Binary K term stores written by KEGGstand_ko_store.py (*.kos.npz) are recognized by their first bytes as well, and
+read instead of parsing an annotations file.
+"""
+import bz2
+import gzip
+from collections import Counter
+from itertools import chain
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Set, Tuple, Union
+
+KO_COLUMN_NAME = "KEGG_ko"
+# Position of KEGG_ko in the eggnog-mapper v2 output, used for files without a #query header line
+DEFAULT_KO_COLUMN = 11
+
+COMPRESSION_SUFFIXES = (".gz", ".bz2")
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_BZ2_MAGIC = b"BZh"
+# .npz files are zip archives
+_ZIP_MAGIC = b"PK\x03\x04"
+# First byte of lines without an annotation: comments and empty lines
+_SKIP_LINE_STARTS = frozenset([b"#", b"\n", b"\r", b""])
+
+
+def open_annotations(eggnog_path: Union[str, Path]) -> BinaryIO:
+    """
+    Opens a (possibly gzip or bz2 compressed) annotations file for reading in binary mode.
+    """
+    with open(eggnog_path, "rb") as s:
+        magic = s.read(3)
+    if magic.startswith(_GZIP_MAGIC):
+        return gzip.open(eggnog_path, "rb")
+    if magic.startswith(_BZ2_MAGIC):
+        return bz2.open(eggnog_path, "rb")
+    return open(eggnog_path, "rb")
+
+
+def is_ko_store(eggnog_path: Union[str, Path]) -> bool:
+    # True for a binary K term store (KEGGstand_ko_store.py) instead of an annotations file
+    with open(eggnog_path, "rb") as s:
+        return s.read(4) == _ZIP_MAGIC
+
+
+def read_store(eggnog_path: Union[str, Path], with_genes: bool = True):
+    # Imported here, so reading annotations files does not need numpy
+    from KEGGstand_ko_store import read_ko_store
+    return read_ko_store(eggnog_path, with_genes)
+
+
+def strip_compression_suffix(file_name: str) -> str:
+    # "sample.emapper.annotations.gz" -> "sample.emapper.annotations"
+    for suffix in COMPRESSION_SUFFIXES:
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)]
+    return file_name
+
+
+def find_ko_column(header_line: str) -> int:
+    """
+    Returns the index of the KEGG_ko column in the #query header line.
+    """
+    columns = header_line.lstrip("#").rstrip("\r\n").split("\t")
+    if KO_COLUMN_NAME not in columns:
+        raise ValueError(f"No {KO_COLUMN_NAME} column in the eggnog header: {header_line.strip()}")
+    return columns.index(KO_COLUMN_NAME)
+
+
+def read_header(s: BinaryIO) -> Tuple[int, bytes]:
+    """
+    Reads the comment lines at the start of an opened annotations file. Returns the KEGG_ko column (from the #query
+    header line if there is one) and the first data line.
+    """
+    ko_column = DEFAULT_KO_COLUMN
+    for line in s:
+        if not line.startswith(b"#"):
+            return ko_column, line
+        if line.startswith(b"#query"):
+            ko_column = find_ko_column(line.decode())
+    return ko_column, b""
+
+
+def iter_ko_fields(eggnog_path: Union[str, Path]) -> Iterator[Tuple[bytes, bytes]]:
+    """
+    Yields (gene, KEGG_ko field) as bytes for every gene in the annotations file, including genes without K terms
+    (field "-").
+    """
+    with open_annotations(eggnog_path) as s:
+        ko_column, first_line = read_header(s)
+        for line in chain([first_line], s):
+            if line[:1] in _SKIP_LINE_STARTS:
+                continue
+            # Split only up to the KEGG_ko column, the remaining columns stay in the last field
+            fields = line.split(b"\t", ko_column + 1)
+            yield fields[0], fields[ko_column]
+
+
+def count_ko_fields(eggnog_path: Union[str, Path]) -> Counter:
+    """
+    Number of genes per distinct KEGG_ko field (as bytes) in the annotations file.
+    """
+    with open_annotations(eggnog_path) as s:
+        ko_column, first_line = read_header(s)
+        # The same loop as iter_ko_fields, but counted in a single expression without a generator per line. The
+        # comment lines at the end of eggnog-mapper output (## ... queries scanned) are skipped
+        return Counter(line.split(b"\t", ko_column + 1)[ko_column] for line in chain([first_line], s)
+                       if line[:1] not in _SKIP_LINE_STARTS)
+
+
+def split_ko_field(ko_field: bytes) -> List[str]:
+    # b"ko:K00001,ko:K00002" -> ["K00001", "K00002"], b"-" -> []
+    ko_field = ko_field.rstrip(b"\r\n")
+    if ko_field == b"-" or not ko_field:
+        return []
+    return ko_field.decode().replace("ko:", "").split(",")
+
+
+def iter_gene_kos(eggnog_path: Union[str, Path]) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Yields (gene, list of K terms) for every gene in the annotations file, the list is empty for genes without K terms.
+    """
+    if is_ko_store(eggnog_path):
+        yield from read_store(eggnog_path).iter_gene_kos()
+        return
+    for gene, ko_field in iter_ko_fields(eggnog_path):
+        yield gene.decode(), split_ko_field(ko_field)
+
+
+def read_ko_set(eggnog_path: Union[str, Path]) -> Set[str]:
+    """
+    Returns the set of all K terms found in an annotations file. A gene with multiple K terms contributes all of them.
+    """
+    if is_ko_store(eggnog_path):
+        return read_store(eggnog_path, with_genes=False).ko_set()
+    # Most genes share their KEGG_ko field with another gene, so only the distinct fields are split
+    ko_set = set()
+    for ko_field in count_ko_fields(eggnog_path):
+        ko_set.update(split_ko_field(ko_field))
+    return ko_set
+
+
+def read_ko_counts(eggnog_path: Union[str, Path]) -> Counter:
+    """
+    Returns the number of genes annotated with each K term in an annotations file.
+    """
+    if is_ko_store(eggnog_path):
+        return read_store(eggnog_path, with_genes=False).ko_counts()
+    ko_counts = Counter()
+    for ko_field, count in count_ko_fields(eggnog_path).items():
+        for ko in split_ko_field(ko_field):
+            ko_counts[ko] += count
+    return ko_counts
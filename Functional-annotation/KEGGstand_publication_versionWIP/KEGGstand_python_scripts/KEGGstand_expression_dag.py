@@ -0,0 +1,166 @@
+"""
+Shared expression DAG of all KEGG module definitions, used by KEGGstand_module_checker.py.
+
+Many modules reuse the same groups, e.g. the pyruvate dehydrogenase complex (K00161+K00162,K00163) or the
+succinate dehydrogenase alternatives. The parsed definition trees of all modules are interned (hash-consed) into a
+single DAG: every unique subexpression becomes one node, identified by its kind, its children and whether it is
+inside an optional chain. Equal subexpressions of different modules therefore get the same node id, and the
+completion engines evaluate each node once per sample, reusing the result for every module that contains it.
+
+Node kinds:
+  - LEAF: a plain K term, args is the K term
+  - SEQUENCE: args are the node ids of the consecutive steps
+  - ALTERNATIVES: args are the node ids of the alternative sequences
+  - OPTIONAL: args are the node ids of the optional sequences (skipping them is always allowed)
+A sequence with a single step is the node of that step itself. Children always have a lower node id than their
+parents, so iterating over the node ids is a valid bottom-up order.
+"""
+from typing import Dict, List, Tuple, Union
+
+LEAF = 0
+SEQUENCE = 1
+ALTERNATIVES = 2
+OPTIONAL = 3
+
+_KIND_NAMES = ("leaf", "sequence", "alternatives", "optional")
+
+
+class ExpressionDAG:
+    """
+    Hash-consed DAG of parsed module definitions.
+
+    kinds, args, optional_context: per node id the node kind, its K term or child node ids, and whether it is part
+        of an optional chain (the witness pathways mark genes in optional chains, so this is part of the node identity)
+    roots: node id of the definition of every module
+    occurrences: number of subexpressions in the definition trees of all modules (before sharing)
+    """
+    __slots__ = ("kinds", "args", "optional_context", "node_ids", "roots", "occurrences")
+
+    def __init__(self):
+        self.kinds: List[int] = []
+        self.args: List[Union[str, Tuple[int, ...]]] = []
+        self.optional_context: List[bool] = []
+        self.node_ids: Dict[tuple, int] = dict()
+        self.roots: Dict[str, int] = dict()
+        self.occurrences = 0
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def intern(self, kind: int, args: Union[str, Tuple[int, ...]], optional_context: bool) -> int:
+        # Returns the id of an existing equal node, or adds a new one
+        self.occurrences += 1
+        key = (kind, args, optional_context)
+        node_id = self.node_ids.get(key)
+        if node_id is None:
+            node_id = len(self.kinds)
+            self.node_ids[key] = node_id
+            self.kinds.append(kind)
+            self.args.append(args)
+            self.optional_context.append(optional_context)
+        return node_id
+
+    def add_sequence(self, elements: list, optional_context: bool = False) -> int:
+        """
+        Interns a parsed sequence (the output of parse_sequence / recursive_merge) and returns its node id.
+        """
+        children = []
+        for elem in elements:
+            if isinstance(elem, str):
+                children.append(self.intern(LEAF, elem, optional_context))
+            elif isinstance(elem, list):
+                alts = tuple(self.add_sequence(alt_seq, optional_context) for alt_seq in elem)
+                children.append(self.intern(ALTERNATIVES, alts, optional_context))
+            else:
+                tag, seqs = elem
+                if tag != "OPTIONAL":
+                    raise ValueError(f"Unexpected element: {elem!r}")
+                taken = tuple(self.add_sequence(seq, optional_context=True) for seq in seqs)
+                children.append(self.intern(OPTIONAL, taken, optional_context))
+        if len(children) == 1:
+            return children[0]
+        return self.intern(SEQUENCE, tuple(children), optional_context)
+
+    def add_module(self, k_id: str, parsed_clean: list) -> int:
+        self.roots[k_id] = self.add_sequence(parsed_clean)
+        return self.roots[k_id]
+
+    def children(self, node_id: int) -> Tuple[int, ...]:
+        if self.kinds[node_id] == LEAF:
+            return ()
+        return self.args[node_id]
+
+    def to_definition(self, node_id: int) -> str:
+        """
+        Renders a node back into KEGG definition syntax, e.g. for the sharing report.
+        """
+        kind = self.kinds[node_id]
+        args = self.args[node_id]
+        if kind == LEAF:
+            return args
+        parts = [self.to_definition(child) for child in args]
+        if kind == SEQUENCE:
+            return " ".join(parts)
+        if kind == ALTERNATIVES:
+            return "(" + ",".join(parts) + ")"
+        if len(args) == 1 and self.kinds[args[0]] == LEAF:
+            return "-" + parts[0]
+        return "-(" + ",".join(parts) + ")"
+
+
+def build_expression_dag(parsed_modules: Dict[str, list]) -> ExpressionDAG:
+    """
+    Interns the parsed definitions of all modules (module name -> parsed and merged definition tree) into one DAG.
+    """
+    dag = ExpressionDAG()
+    for k_id, parsed_clean in parsed_modules.items():
+        dag.add_module(k_id, parsed_clean)
+    return dag
+
+
+def modules_per_node(dag: ExpressionDAG) -> List[List[str]]:
+    # The modules whose definition contains each node
+    node_modules = [[] for _ in range(len(dag))]
+    for k_id, root in dag.roots.items():
+        seen = {root}
+        stack = [root]
+        while stack:
+            node_id = stack.pop()
+            node_modules[node_id].append(k_id)
+            for child in dag.children(node_id):
+                if child not in seen:
+                    seen.add(child)
+                    stack.append(child)
+    return node_modules
+
+
+def sharing_summary(dag: ExpressionDAG) -> Dict[str, int]:
+    """
+    Counts of the sharing found: subexpressions in all definition trees, unique nodes, and the unique groups
+    (non K term nodes) that occur in more than one module.
+    """
+    node_modules = modules_per_node(dag)
+    groups = [node_id for node_id in range(len(dag)) if dag.kinds[node_id] != LEAF]
+    return {"modules": len(dag.roots),
+            "subexpressions": dag.occurrences,
+            "unique_nodes": len(dag),
+            "unique_groups": len(groups),
+            "shared_groups": sum(1 for node_id in groups if len(node_modules[node_id]) > 1)}
+
+
+def sharing_report(dag: ExpressionDAG) -> List[Dict[str, Union[str, int]]]:
+    """
+    One row per group (non K term node) that occurs in more than one module, most shared first.
+    """
+    node_modules = modules_per_node(dag)
+    rows = []
+    for node_id in range(len(dag)):
+        if dag.kinds[node_id] == LEAF or len(node_modules[node_id]) < 2:
+            continue
+        rows.append({"node": node_id,
+                     "kind": _KIND_NAMES[dag.kinds[node_id]],
+                     "num_modules": len(node_modules[node_id]),
+                     "expression": dag.to_definition(node_id),
+                     "modules": ",".join(k_id.split(" ")[0] for k_id in node_modules[node_id])})
+    rows.sort(key=lambda row: (-row["num_modules"], row["node"]))
+    return rows
@@ -0,0 +1,189 @@
+"""
+Compact binary store of the K terms of a sample, written once from its EggNOG .emapper.annotations file so repeat
+analyses do not have to parse the text file again. Read by KEGGstand_module_checker.py, KEGGstand_BRITE_checker.py and
+Eggnog_KEGG_KO_extracter.py: the functions of KEGGstand_eggnog_reader.py recognize a store by its first bytes and read
+it instead of the annotations.
+
+The store is an uncompressed numpy .npz file (sample.emapper.annotations.kos.npz) with the arrays:
+  - kterms: sorted K numbers of all K terms of the sample (uint32, K00845 -> 845)
+  - counts: number of genes annotated with each K term (uint32)
+  - gene_offsets, gene_kos: gene -> K term index in CSR form, the K terms of gene i are
+    kterms[gene_kos[gene_offsets[i]:gene_offsets[i + 1]]], in the order of the KEGG_ko column
+  - gene_names, gene_name_offsets: the names of all genes (also the genes without K terms) as one UTF-8 byte string
+
+K terms are stored by number, so KEGG_ko entries that are not a K followed by 5 digits are left out of the store (with a
+warning), where the text reader would return them as they are.
+
+Usage: (python) KEGGstand_ko_store.py -i sample.emapper.annotations [more files or directories] [-o output_dir]
+"""
+import argparse
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import Iterator, List, Optional, Set, Tuple, Union
+
+import numpy as np
+
+from KEGGstand_eggnog_reader import iter_ko_fields, split_ko_field, strip_compression_suffix, COMPRESSION_SUFFIXES
+
+KO_STORE_SUFFIX = ".kos.npz"
+KO_STORE_VERSION = 1
+ANNOTATIONS_SUFFIX = ".emapper.annotations"
+
+
+def kterm_to_number(kterm: str) -> Optional[int]:
+    # "K00845" -> 845, None for entries that are not K terms
+    if len(kterm) != 6 or kterm[0] != "K" or not kterm[1:].isdigit():
+        return None
+    return int(kterm[1:])
+
+
+def number_to_kterm(number: int) -> str:
+    return f"K{number:05d}"
+
+
+class KOStore:
+    """
+    The K terms of one sample, with the number of genes per K term and the K terms of every gene.
+    """
+    __slots__ = ("kterms", "counts", "gene_offsets", "gene_kos", "gene_names", "gene_name_offsets")
+
+    def __init__(self, kterms: np.ndarray, counts: np.ndarray, gene_offsets: np.ndarray, gene_kos: np.ndarray,
+                 gene_names: np.ndarray, gene_name_offsets: np.ndarray):
+        self.kterms = kterms
+        self.counts = counts
+        self.gene_offsets = gene_offsets
+        self.gene_kos = gene_kos
+        self.gene_names = gene_names
+        self.gene_name_offsets = gene_name_offsets
+
+    def __len__(self) -> int:
+        # Number of genes
+        return len(self.gene_offsets) - 1
+
+    def ko_set(self) -> Set[str]:
+        return {number_to_kterm(number) for number in self.kterms.tolist()}
+
+    def ko_counts(self) -> Counter:
+        return Counter({number_to_kterm(number): count for number, count in zip(self.kterms.tolist(), self.counts.tolist())})
+
+    def iter_gene_kos(self) -> Iterator[Tuple[str, List[str]]]:
+        # Same output as KEGGstand_eggnog_reader.iter_gene_kos on the annotations file
+        names = self.gene_names.tobytes()
+        name_offsets = self.gene_name_offsets.tolist()
+        offsets = self.gene_offsets.tolist()
+        kterms = [number_to_kterm(number) for number in self.kterms.tolist()]
+        gene_kos = self.gene_kos.tolist()
+        for i in range(len(self)):
+            gene = names[name_offsets[i]:name_offsets[i + 1]].decode()
+            yield gene, [kterms[column] for column in gene_kos[offsets[i]:offsets[i + 1]]]
+
+
+def build_ko_store(eggnog_path: Union[str, Path]) -> KOStore:
+    """
+    Parses an annotations file (possibly gzip or bz2 compressed) into a KOStore. KEGG_ko entries that are not K terms
+    are skipped with a warning.
+    """
+    # Most genes share their KEGG_ko field with other genes, so every distinct field is only split once
+    field_numbers = dict()
+    skipped = set()
+    gene_names = bytearray()
+    gene_name_offsets = array("q", [0])
+    gene_offsets = array("q", [0])
+    gene_numbers = array("I")
+    for gene, ko_field in iter_ko_fields(eggnog_path):
+        numbers = field_numbers.get(ko_field)
+        if numbers is None:
+            numbers = field_numbers[ko_field] = []
+            for ko in split_ko_field(ko_field):
+                number = kterm_to_number(ko)
+                if number is not None:
+                    numbers.append(number)
+                elif ko not in skipped:
+                    print(f"Warning, {eggnog_path} has the KEGG_ko entry {ko!r}, which is not a K term and is not stored")
+                    skipped.add(ko)
+        gene_names += gene
+        gene_name_offsets.append(len(gene_names))
+        gene_numbers.extend(numbers)
+        gene_offsets.append(len(gene_numbers))
+    kterms, gene_kos = np.unique(np.frombuffer(gene_numbers, dtype=np.uint32), return_inverse=True)
+    counts = np.bincount(gene_kos, minlength=len(kterms))
+    return KOStore(kterms.astype(np.uint32), counts.astype(np.uint32),
+                   np.frombuffer(gene_offsets, dtype=np.int64), gene_kos.astype(np.uint32).ravel(),
+                   np.frombuffer(bytes(gene_names), dtype=np.uint8), np.frombuffer(gene_name_offsets, dtype=np.int64))
+
+
+def write_ko_store(store_path: Union[str, Path], store: KOStore):
+    with open(store_path, "wb") as s:
+        np.savez(s, version=np.array([KO_STORE_VERSION]), kterms=store.kterms, counts=store.counts,
+                 gene_offsets=store.gene_offsets, gene_kos=store.gene_kos, gene_names=store.gene_names,
+                 gene_name_offsets=store.gene_name_offsets)
+
+
+def read_ko_store(store_path: Union[str, Path], with_genes: bool = True) -> KOStore:
+    """
+    Reads a K term store. The arrays of a .npz file are read on access, so without with_genes only the K terms and
+    their counts are read (the gene arrays are None), which is all that is needed for the K term set.
+    """
+    with np.load(store_path, allow_pickle=False) as arrays:
+        version = int(arrays["version"][0])
+        if version != KO_STORE_VERSION:
+            raise ValueError(f"{store_path} is a version {version} K term store, expected version {KO_STORE_VERSION}")
+        if not with_genes:
+            return KOStore(arrays["kterms"], arrays["counts"], None, None, None, None)
+        return KOStore(arrays["kterms"], arrays["counts"], arrays["gene_offsets"], arrays["gene_kos"],
+                       arrays["gene_names"], arrays["gene_name_offsets"])
+
+
+def ko_store_name(eggnog_path: Path) -> str:
+    # "sample.emapper.annotations.gz" -> "sample.emapper.annotations.kos.npz"
+    return strip_compression_suffix(eggnog_path.name) + KO_STORE_SUFFIX
+
+
+def strip_ko_store_suffix(file_name: str) -> str:
+    # "sample.emapper.annotations.kos.npz" -> "sample.emapper.annotations"
+    if file_name.endswith(KO_STORE_SUFFIX):
+        return file_name[:-len(KO_STORE_SUFFIX)]
+    return file_name
+
+
+def convert_to_ko_store(eggnog_path: Path, out_dir: Path) -> Path:
+    store_path = out_dir / ko_store_name(eggnog_path)
+    print(f"Converting {eggnog_path} to {store_path}")
+    write_ko_store(store_path, build_ko_store(eggnog_path))
+    return store_path
+
+
+def collect_annotation_files(input_paths: List[Path]) -> List[Path]:
+    # Files are used as given, directories contribute all their (possibly compressed) annotation files
+    eggnog_paths = []
+    for input_path in input_paths:
+        if input_path.is_dir():
+            eggnog_paths.extend(sorted(p for suffix in ("",) + COMPRESSION_SUFFIXES
+                                       for p in input_path.glob(f"*{ANNOTATIONS_SUFFIX}{suffix}")))
+        else:
+            eggnog_paths.append(input_path)
+    return eggnog_paths
+
+
+def parseargs() -> Tuple[List[Path], Union[Path, None]]:
+    parser = argparse.ArgumentParser(description="Convert EggNOG annotation files into binary K term stores (*.kos.npz)")
+    parser.add_argument("-i", help="EggNOG annotation files or directories of them", required=True, nargs="+",
+                        dest="input_paths", type=Path)
+    parser.add_argument("-o", help="Output directory (default: next to every input file)", dest="out_dir", type=Path,
+                        default=None)
+    args = parser.parse_args()
+    return args.input_paths, args.out_dir
+
+
+def main():
+    input_paths, out_dir = parseargs()
+    if out_dir is not None:
+        out_dir.mkdir(parents=True, exist_ok=True)
+    for eggnog_path in collect_annotation_files(input_paths):
+        convert_to_ko_store(eggnog_path, out_dir if out_dir is not None else eggnog_path.parent)
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
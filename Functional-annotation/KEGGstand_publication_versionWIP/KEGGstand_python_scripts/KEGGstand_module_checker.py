@@ -1,9 +1,28 @@
-from typing import List, Dict, Union, Tuple
-import networkx as nx
+from typing import List, Dict, Union, Tuple, Optional, Set
+import os
+import pickle
+import multiprocessing
+import hashlib
+import cProfile
+import platform
+from datetime import datetime
 import pandas as pd
 import argparse
 from pathlib import Path
 
+from KEGGstand_module_graph import ModuleGraph, NoPathError
+from KEGGstand_completion_dp import compute_completion_dp, compute_completion_dag
+from KEGGstand_expression_dag import ExpressionDAG, build_expression_dag, sharing_summary, sharing_report
+from KEGGstand_cohort_engine import compute_cohort_completion
+from KEGGstand_eggnog_reader import read_ko_set, is_ko_store, COMPRESSION_SUFFIXES
+from KEGGstand_ko_store import build_ko_store, write_ko_store, ko_store_name, KO_STORE_SUFFIX
+from KEGGstand_batch_inputs import collect_batch_inputs, get_input_name, get_sample_name
+from KEGGstand_profiling import PhaseProfiler, profile_phase, profile_count, sidecar_path, write_json
+
+# Bump whenever the layout of the compiled module artifact (or the parsing that produces it) changes,
+# so that stale artifacts from older versions of this script are rebuilt instead of loaded.
+MODULE_CACHE_VERSION = 4
+
 ######################### Parsing the KEGG compressed graph representation
 
 def parse_sequence(s, i=0, end_chars=None):
@@ -188,110 +207,6 @@ def recursive_merge(elements):
 
     return new_elems
 
-def old_process_elements(elements, prev_ids, edges):
-    """
-    Given parsed elements (each of which may be):
-       • a string (enzyme ID),
-       • a list (alternatives),
-       • a tuple ("OPTIONAL", list_of_sequences),
-    and a list prev_ids (the “upstream” nodes to connect from),
-    append (source,target) edges into `edges` and return the new leaves.
-
-    Rules:
-      1) If elem is a string "X":
-         - For each p in prev_ids, append (p, "X")
-         - Then current_prev = ["X"].
-
-      2) If elem is a list (i.e. bracketed alternatives):
-         - For each alternative sequence alt_seq (which itself is a list of elements),
-           call process_elements(alt_seq, prev_ids, edges) to get leaves_for_that_alt.
-         - Combine all those leaves into new current_prev.
-
-      3) If elem is ("OPTIONAL", seqs):
-         - We have two possibilities: “skip” or “take” the entire optional subchain.
-         - Let leaves_skip = prev_ids
-         - For each sequence seq in seqs:
-             • call process_elements(seq, prev_ids, edges) to build edges for “taking” that chain.
-             • collect the leaves from that taken path.
-         - new current_prev = leaves_skip + (all leaves from taken‐paths)
-    """
-    current_prev = prev_ids
-
-    for elem in elements:
-        # Case 1: a plain ID
-        if isinstance(elem, str):
-            for p in current_prev:
-                edges.append((p, elem))
-            current_prev = [elem]
-
-        # Case 2: bracketed‐alternatives
-        elif isinstance(elem, list):
-            all_leaves = []
-            for alt_seq in elem:
-                alt_leaves = process_elements(alt_seq, current_prev, edges)
-                all_leaves.extend(alt_leaves)
-            current_prev = all_leaves
-
-        # Case 3: an optional‐chain marker
-        else:
-            tag, seqs = elem
-            if tag != "OPTIONAL":
-                raise ValueError(f"Unexpected element: {elem!r}")
-
-            # 3a) If we skip the entire optional chain, leaves_skip = current_prev
-            leaves_skip = list(current_prev)
-
-            # 3b) If we take it, we must traverse each possible sub‐sequence in seqs
-            leaves_taken = []
-            for seq in seqs:
-                taken_leaves = process_elements(seq, current_prev, edges)
-                leaves_taken.extend(taken_leaves)
-
-            # 3c) New “current_prev” is union of skip‐leaves and taken‐leaves
-            current_prev = leaves_skip + leaves_taken
-
-    return current_prev
-
-def old_build_pathway_graph(pathway_str: str):
-    """
-    Top‐level function. Given a pathway_str that can contain:
-      - plain IDs (e.g. "K00789"),
-      - complexes joined by '+',
-      - optional subchains joined by '-',
-      - bracketed alternatives "(A,B,C,...)" with commas,
-
-    this builds a directed acyclic graph (DAG) whose edges reflect:
-      BEGIN → first step(s),
-      step → next step(s),
-      optional chains either skipped or fully taken,
-      bracketed alternatives branched,
-      final leaves → END.
-
-    Returns (G, edges), where G is a networkx.DiGraph and edges is the Python list of (src, dst).
-    """
-    # 1) First parse into a raw “elements” list
-    parsed, _ = parse_sequence(pathway_str, 0, end_chars=[])
-
-    # 2) Recursively merge nested OPTIONAL groups
-    parsed_rec = recursive_merge(parsed)
-
-    # 3) Merge any consecutive OPTIONAL markers at this top level
-    parsed_clean = merge_optional_elements(parsed_rec)
-
-    # 4) Walk the cleaned elements, building edges
-    edges = []
-    leaves = process_elements(parsed_clean, ["BEGIN"], edges)
-
-    # 5) Connect every final leaf to "END"
-    for leaf in leaves:
-        edges.append((leaf, "END"))
-
-    # 6) Build the NetworkX graph
-    G = nx.DiGraph()
-    G.add_edges_from(edges)
-    return G
-
-
 def process_elements(elements, prev_ids, edges, node_optional, optional_context=False):
     """
     elements: parsed list where each item is:
@@ -346,21 +261,26 @@ def process_elements(elements, prev_ids, edges, node_optional, optional_context=
     return current_prev
 
 
-def build_pathway_graph(pathway_str):
+def parse_pathway_definition(pathway_str: str) -> list:
     """
-    Parse pathway_str and build graph and node optional labels.
+    Parse pathway_str and normalize optional groups.
 
-    Returns: (G, edges, node_optional)
-    - G: networkx.DiGraph with node attribute 'is_optional' set for each node
-    - edges: list of (src, dst) tuples
-    - node_optional: dict mapping node -> bool
+    Returns the merged definition tree, as consumed by process_elements.
     """
-    # 1) parse and normalize optional groups
     parsed, _ = parse_sequence(pathway_str, 0, end_chars=[])
     parsed_rec = recursive_merge(parsed)
     parsed_clean = merge_optional_elements(parsed_rec)
+    return parsed_clean
+
 
-    # 2) build edges while collecting node optional flags
+def collect_pathway_edges(parsed_clean) -> Tuple[List[Tuple[str, str]], Dict[str, bool]]:
+    """
+    Walk an already parsed definition tree, collecting the graph edges and node optional labels.
+
+    Returns: (edges, node_optional)
+    - edges: list of (src, dst) tuples, from BEGIN to END
+    - node_optional: dict mapping node -> bool
+    """
     edges = []
     node_optional = {}
 
@@ -373,73 +293,134 @@ def build_pathway_graph(pathway_str):
         edges.append((leaf, "END"))
 
     node_optional["END"] = False
+    return edges, node_optional
+
+
+def build_pathway_graph_from_parsed(parsed_clean) -> ModuleGraph:
+    """
+    Build the pathway graph and node optional labels from an already parsed definition tree.
+
+    Returns: G, a ModuleGraph with the optional flag set for each node
+    """
+    edges, node_optional = collect_pathway_edges(parsed_clean)
+    return ModuleGraph(edges, node_optional)
 
-    # 3) create graph and set node attributes
-    G = nx.DiGraph()
-    G.add_edges_from(edges)
 
-    # Ensure all nodes appear in node_optional map (if a node appears but wasn't assigned yet)
-    for n in G.nodes():
-        if n not in node_optional:
-            node_optional[n] = False
+def build_pathway_graph(pathway_str):
+    """
+    Parse pathway_str and build graph and node optional labels.
 
-    # Assign attribute to each node
-    for n, is_opt in node_optional.items():
-        if n in G:
-            G.nodes[n]['is_optional'] = bool(is_opt)
-    return G
+    Returns: G, a ModuleGraph with the optional flag set for each node
+    """
+    parsed_clean = parse_pathway_definition(pathway_str)
+    return build_pathway_graph_from_parsed(parsed_clean)
 
 ################################# Shortest path search
 
-def find_shortest_path_through(graph: nx.DiGraph, target_nodes: List[str], start='BEGIN', end='END') -> List[str]:
+def find_shortest_path_through(graph: ModuleGraph, target_nodes: List[str], start='BEGIN', end='END') -> List[str]:
     # Build path segments
+    node_ids = graph.node_ids
     full_path = []
-    current = start
+    current = node_ids[start]
     for target in target_nodes:
-        segment = nx.shortest_path(graph, current, target)
+        target_id = node_ids[target]
+        segment = graph.shortest_path(current, target_id)
         if full_path:
             full_path += segment[1:]  # Avoid repeating current node
         else:
             full_path += segment
-        current = target
+        current = target_id
     # Path from last target to END
-    segment = nx.shortest_path(graph, current, end)
+    segment = graph.shortest_path(current, node_ids[end])
     full_path += segment[1:]
-    return full_path
+    return [graph.node_names[node_id] for node_id in full_path]
+
+
+def compile_parsed_module(pathway_str: str, parsed_clean: list) -> Dict[str, object]:
+    """
+    Build the graph of a parsed module definition.
+
+    Returns a dict with the original definition, the parsed and merged definition tree,
+    the node optional flags and the pathway graph.
+    """
+    edges, node_optional = collect_pathway_edges(parsed_clean)
+    pathway_graph = ModuleGraph(edges, node_optional)
+    return {"definition": pathway_str, "parsed": parsed_clean, "node_optional": node_optional, "graph": pathway_graph}
+
 
+def compile_kegg_module(pathway_str: str) -> Dict[str, object]:
+    # Parse a single module definition and build its graph
+    return compile_parsed_module(pathway_str, parse_pathway_definition(pathway_str))
 
-def process_all_kegg_modules_to_pathways(kegg_dict: Dict[str, List[str]]) -> Dict[str, nx.DiGraph]:
+
+def compile_all_kegg_modules(kegg_dict: Dict[str, List[str]], profiler: Optional[PhaseProfiler] = None) -> Dict[str, Dict[str, object]]:
+    # All definitions are parsed first and the graphs are built afterwards, so both can be profiled separately
+    with profile_phase(profiler, "module_db_parse"):
+        parsed_modules = dict()
+        for k_id, pathway_kegg in kegg_dict.items():
+            pathway_str = pathway_kegg[0]
+            print(k_id, pathway_str)
+            parsed_modules[k_id] = parse_pathway_definition(pathway_str)
+    with profile_phase(profiler, "graph_build"):
+        compiled_modules = dict()
+        for k_id, parsed_clean in parsed_modules.items():
+            compiled_modules[k_id] = compile_parsed_module(kegg_dict[k_id][0], parsed_clean)
+    return compiled_modules
+
+
+def process_all_kegg_modules_to_pathways(kegg_dict: Dict[str, List[str]]) -> Dict[str, ModuleGraph]:
+    compiled_modules = compile_all_kegg_modules(kegg_dict)
+    return get_pathway_graphs(compiled_modules)
+
+
+def get_pathway_graphs(compiled_modules: Dict[str, Dict[str, object]]) -> Dict[str, ModuleGraph]:
     kegg_pathways = dict()
-    for k_id, pathway_kegg in kegg_dict.items():
-        pathway_str = pathway_kegg[0]
-        print(k_id, pathway_str)
-        pathway_graph = build_pathway_graph(pathway_str)
-        kegg_pathways[k_id] = pathway_graph
+    for k_id, compiled_module in compiled_modules.items():
+        kegg_pathways[k_id] = compiled_module["graph"]
     return kegg_pathways
 
-def find_in_which_pathway(target_gene_list: List[str], kegg_pathways: Dict[str, nx.DiGraph]) -> Dict[str, List[str]]:
+def build_ko_module_index(kegg_pathways: Dict[str, ModuleGraph]) -> Dict[str, List[Tuple[str, str]]]:
+    """
+    Inverted index of the module graphs: maps every KO to the list of (module, node) pairs it occurs in.
+    """
+    ko_index = dict()
+    for k_id, pathway_g in kegg_pathways.items():
+        for node in pathway_g.node_names:
+            if node in ("BEGIN", "END"):
+                continue
+            if node in ko_index:
+                ko_index[node].append((k_id, node))
+            else:
+                ko_index[node] = [(k_id, node)]
+    return ko_index
+
+
+def find_in_which_pathway(target_gene_list: List[str], kegg_pathways: Dict[str, ModuleGraph],
+                          ko_index: Optional[Dict[str, List[Tuple[str, str]]]] = None) -> Dict[str, List[str]]:
+    # Only the KOs that occur in some module are looked up, modules without hits are never touched
+    if ko_index is None:
+        ko_index = build_ko_module_index(kegg_pathways)
     target_genes = set(target_gene_list)
     pathways_with_target_genes = dict()
-    for gene in target_genes:
-        for k_id, pathway_g in kegg_pathways.items():
-            if pathway_g.has_node(gene):
-                if k_id in pathways_with_target_genes:
-                    pathways_with_target_genes[k_id] += [gene]
-                else:
-                    pathways_with_target_genes[k_id] = [gene]
+    for gene in target_genes.intersection(ko_index):
+        for k_id, node in ko_index[gene]:
+            if k_id in pathways_with_target_genes:
+                pathways_with_target_genes[k_id].append(node)
+            else:
+                pathways_with_target_genes[k_id] = [node]
     return pathways_with_target_genes
 
 
-def list_optional_nodes(pathway_graph: nx.DiGraph, node_list: List[str]):
+def list_optional_nodes(pathway_graph: ModuleGraph, node_list: List[str]):
     optional_nodes = []
     for node_name in node_list:
-        is_optional = pathway_graph.nodes[node_name]["is_optional"]
+        is_optional = pathway_graph.is_optional(pathway_graph.node_ids[node_name])
         if is_optional:
             optional_nodes.append(node_name)
     return optional_nodes
 
 
-def compute_completion(pathway_graph: nx.DiGraph, target_genes: List[str]) -> Dict[str, Union[str, List[str], List[str]]]:
+def compute_completion(pathway_graph: ModuleGraph, target_genes: List[str]) -> Dict[str, Union[str, List[str], List[str]]]:
     shortest_path_through_nodes = find_shortest_path_through(pathway_graph, target_genes)
     full_pathway_li = shortest_path_through_nodes[1:-1]
     completion = round(len(target_genes) / len(full_pathway_li),3)
@@ -448,27 +429,55 @@ def compute_completion(pathway_graph: nx.DiGraph, target_genes: List[str]) -> Di
     return res
 
 
-def sort_nodes(in_graph: nx.DiGraph, in_nodes: List[str]) -> List[str]:
-    #sorted_g = list(nx.topological_sort(in_graph))
-    sorted_g = list(in_graph.nodes)
-    node_ids = [sorted_g.index(node) for node in in_nodes]
+def sort_nodes(in_graph: ModuleGraph, in_nodes: List[str]) -> List[str]:
+    # Node ids follow the order in which the nodes were added to the graph
+    node_ids = [in_graph.node_ids[node] for node in in_nodes]
     sorted_nodes = [node for n_id, node in sorted(zip(node_ids, in_nodes))]
     return sorted_nodes
 
 
-def compute_completion_of_all_pathways(kegg_pathways: Dict[str, nx.DiGraph], pathways_with_target_genes: Dict[str, List[str]]) -> Dict[str, Union[str, List[str], List[str]]]:
+def compute_completion_of_all_pathways(kegg_pathways: Dict[str, ModuleGraph], pathways_with_target_genes: Dict[str, List[str]],
+                                       skip_no_path: bool = False) -> Dict[str, Union[str, List[str], List[str]]]:
+    # With skip_no_path, modules without a path through all their present genes (genes of two alternatives of the same
+    # step present) are left out of the result instead of raising NoPathError
     completion_res = dict()
     for k_id, pathway_g in kegg_pathways.items():
         if k_id in pathways_with_target_genes:
             print(k_id, pathways_with_target_genes[k_id])
             target_genes = sort_nodes(pathway_g, pathways_with_target_genes[k_id])
-            completion_info = compute_completion(pathway_g, target_genes)
+            try:
+                completion_info = compute_completion(pathway_g, target_genes)
+            except NoPathError:
+                if not skip_no_path:
+                    raise
+                continue
             completion_res[k_id] = completion_info
         else:
             completion_res[k_id] = {"completion": 0.0, "present_genes": [], "pathway": [], "optional": []}
     return completion_res
 
 
+def compute_completion_of_all_pathways_dp(compiled_modules: Dict[str, Dict[str, object]], pathways_with_target_genes: Dict[str, List[str]],
+                                          expression_dag: Optional[ExpressionDAG] = None) -> Dict[str, Union[str, List[str], List[str]]]:
+    # Same as compute_completion_of_all_pathways, but scores the parsed definition trees with the exact dynamic programming engine.
+    # With the shared expression DAG, groups used by several modules are only evaluated once for this sample
+    completion_res = dict()
+    present_genes = set()
+    for genes in pathways_with_target_genes.values():
+        present_genes.update(genes)
+    memo = dict()
+    for k_id, compiled_module in compiled_modules.items():
+        if k_id in pathways_with_target_genes:
+            print(k_id, pathways_with_target_genes[k_id])
+            if expression_dag is not None:
+                completion_res[k_id] = compute_completion_dag(expression_dag, k_id, present_genes, memo)
+            else:
+                completion_res[k_id] = compute_completion_dp(compiled_module["parsed"], set(pathways_with_target_genes[k_id]))
+        else:
+            completion_res[k_id] = {"completion": 0.0, "present_genes": [], "pathway": [], "optional": []}
+    return completion_res
+
+
 
 #################################
 
@@ -503,28 +512,125 @@ def KEGG_module_reader(KEGG_module_file_path) -> Dict[str, str]:
     return KEGG_dict
 
 
-def eggnog_parser(eggnog_path) -> List[str]:
+def hash_module_db(KEGG_module_file_path) -> str:
     """
-    Output list of ids KO ids
-    Parses an eggnog.annotations output file. Returns a list of all the found k terms.
+    Returns the sha256 hex digest of the module database contents. Used as the key of the compiled module artifact.
     """
-    out_list = []
-    for line in gen_line_reader(eggnog_path):
-        if line.startswith("#"):
-            continue
-        ko = line.split("\t")[11]
-        # !!!!A comma means there is multiple ko terms. BLASTkoala appears to only save the first one.
-        # This script will include both ko terms
-        if ko == "-":
-            ko = ""
-        elif "," in ko:
-            for i in ko.split(","):
-                i = i.replace("ko:", "")
-                out_list.append(i)
-        else:
-            ko = ko.replace("ko:", "")
-            out_list.append(ko)
-    return out_list
+    db_hash = hashlib.sha256()
+    with open(KEGG_module_file_path, "rb") as s:
+        for chunk in iter(lambda: s.read(1 << 20), b""):
+            db_hash.update(chunk)
+    return db_hash.hexdigest()
+
+
+def default_cache_path(KEGG_module_file_path: Path) -> Path:
+    # The compiled artifact lives next to the module database by default
+    return KEGG_module_file_path.with_name(KEGG_module_file_path.name + ".compiled.pkl")
+
+
+def load_compiled_modules(cache_path: Path, db_hash: str) \
+        -> Optional[Tuple[Dict[str, Dict[str, object]], Dict[str, List[Tuple[str, str]]], ExpressionDAG]]:
+    """
+    Loads the compiled modules, the KO index and the shared expression DAG from cache_path. Returns None if there is no artifact, if it was
+    written by a different version of this script, or if it was compiled from a different module database.
+    """
+    if not cache_path.is_file():
+        return None
+    try:
+        with open(cache_path, "rb") as s:
+            artifact = pickle.load(s)
+    except Exception as e:
+        print(f"Could not read compiled modules from {cache_path}: {e}")
+        return None
+    if not isinstance(artifact, dict):
+        return None
+    if artifact.get("version") != MODULE_CACHE_VERSION or artifact.get("db_hash") != db_hash:
+        return None
+    return artifact["modules"], artifact["ko_index"], artifact["expression_dag"]
+
+
+def save_compiled_modules(cache_path: Path, db_hash: str, compiled_modules: Dict[str, Dict[str, object]],
+                          ko_index: Dict[str, List[Tuple[str, str]]], expression_dag: ExpressionDAG):
+    """
+    Writes the compiled modules to cache_path. The artifact is written to a temporary file first and then
+    moved into place, so concurrent array tasks never see a partially written file.
+    """
+    artifact = {"version": MODULE_CACHE_VERSION, "db_hash": db_hash, "modules": compiled_modules, "ko_index": ko_index,
+                "expression_dag": expression_dag}
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "wb") as s:
+            pickle.dump(artifact, s, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Could not write compiled modules to {cache_path}: {e}")
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def build_module_expression_dag(compiled_modules: Dict[str, Dict[str, object]]) -> ExpressionDAG:
+    # Intern the parsed definitions of all modules into the shared expression DAG and report the sharing found
+    expression_dag = build_expression_dag({k_id: c["parsed"] for k_id, c in compiled_modules.items()})
+    summary = sharing_summary(expression_dag)
+    print(f"Shared expression DAG: {summary['subexpressions']} subexpressions in {summary['modules']} modules, "
+          f"{summary['unique_nodes']} unique, {summary['shared_groups']} of {summary['unique_groups']} groups shared between modules")
+    return expression_dag
+
+
+def write_sharing_report(expression_dag: ExpressionDAG, report_path: Path):
+    # One row per group shared between modules, most shared first
+    report_df = pd.DataFrame(sharing_report(expression_dag), columns=["node", "kind", "num_modules", "expression", "modules"])
+    print(f"Saving the sharing report to {report_path}")
+    report_df.to_csv(report_path, sep="\t", index=False)
+
+
+def compile_module_db(mod_path: Path, profiler: Optional[PhaseProfiler] = None) \
+        -> Tuple[Dict[str, Dict[str, object]], Dict[str, List[Tuple[str, str]]], ExpressionDAG]:
+    # Parse the module database and build the graphs, the KO index and the shared expression DAG
+    with profile_phase(profiler, "module_db_read"):
+        kegg_modules = KEGG_module_reader(mod_path)
+    compiled_modules = compile_all_kegg_modules(kegg_modules, profiler)
+    with profile_phase(profiler, "index_build"):
+        ko_index = build_ko_module_index(get_pathway_graphs(compiled_modules))
+        expression_dag = build_module_expression_dag(compiled_modules)
+    return compiled_modules, ko_index, expression_dag
+
+
+def compile_module_db_subset(kegg_dict: Dict[str, List[str]], engine: str = "graph", profiler: Optional[PhaseProfiler] = None) \
+        -> Tuple[Dict[str, Dict[str, object]], Dict[str, List[Tuple[str, str]]], Optional[ExpressionDAG]]:
+    # Compiles only the given modules (e.g. the modules changed by a database update), without the cache
+    compiled_modules = compile_all_kegg_modules(kegg_dict, profiler)
+    with profile_phase(profiler, "index_build"):
+        ko_index = build_ko_module_index(get_pathway_graphs(compiled_modules))
+        expression_dag = build_module_expression_dag(compiled_modules) if engine == "dp" else None
+    return compiled_modules, ko_index, expression_dag
+
+
+def load_or_compile_modules(mod_path: Path, cache_path: Optional[Path] = None, use_cache: bool = True,
+                            profiler: Optional[PhaseProfiler] = None) \
+        -> Tuple[Dict[str, Dict[str, object]], Dict[str, List[Tuple[str, str]]], ExpressionDAG]:
+    """
+    Returns the compiled modules, the KO to module index and the shared expression DAG for the module database at
+    mod_path. Loads them from the compiled artifact if it matches the database contents, otherwise parses the
+    database, compiles it and refreshes the artifact.
+    """
+    if not use_cache:
+        return compile_module_db(mod_path, profiler)
+
+    if cache_path is None:
+        cache_path = default_cache_path(mod_path)
+    with profile_phase(profiler, "cache_load"):
+        db_hash = hash_module_db(mod_path)
+        compiled = load_compiled_modules(cache_path, db_hash)
+    if compiled is not None:
+        print(f"Loaded compiled modules from {cache_path}")
+        return compiled
+
+    print(f"No up to date compiled modules found, compiling {mod_path}")
+    compiled_modules, ko_index, expression_dag = compile_module_db(mod_path, profiler)
+    with profile_phase(profiler, "cache_write"):
+        save_compiled_modules(cache_path, db_hash, compiled_modules, ko_index, expression_dag)
+    return compiled_modules, ko_index, expression_dag
 
 
 def convert_completion_dict_to_df(completion_dict):
@@ -545,13 +651,419 @@ def convert_completion_dict_to_df(completion_dict):
     return completion_df
 
 
-def parse_args() -> Tuple[Path, Path, Path]:
-    parser = argparse.ArgumentParser(description="Estimate completion of the modules")
+def convert_completion_dicts_to_matrix(sample_completions: Dict[str, Dict[str, Dict[str, Union[str, List[str], List[str]]]]],
+                                       module_names: List[str]) -> pd.DataFrame:
+    # Merge the completion of every sample into a single modules x samples table
+    matrix = dict()
+    for sample_name, completion_dict in sample_completions.items():
+        matrix[sample_name] = [completion_dict[k]["completion"] for k in module_names]
+    completion_matrix = pd.DataFrame(matrix, index=[k.split(" ")[0] for k in module_names])
+    completion_matrix.insert(0, "description", module_names)
+    completion_matrix.index.names = ["module"]
+    return completion_matrix
+
+
+######################### Stored K term sets
+
+def read_sample_kos(eggnogfile_path: Path, store_dir: Optional[Path] = None) -> Set[str]:
+    """
+    K terms of a sample. With store_dir, the sample is also converted into a binary K term store
+    (KEGGstand_ko_store.py) in that directory, unless the input already is one.
+    """
+    if store_dir is None or is_ko_store(eggnogfile_path):
+        return read_ko_set(eggnogfile_path)
+    ko_store = build_ko_store(eggnogfile_path)
+    write_ko_store(store_dir / ko_store_name(eggnogfile_path), ko_store)
+    return ko_store.ko_set()
+
+
+######################### Batch mode
+
+# Compiled modules, KO index, expression DAG, completion engine and K term storage shared by the batch worker processes,
+# set by init_batch_worker
+_batch_compiled_modules = None
+_batch_ko_index = None
+_batch_expression_dag = None
+_batch_engine = "graph"
+_batch_store_kterms = False
+
+
+def compute_sample_completion(eggnog_list: Set[str], compiled_modules: Dict[str, Dict[str, object]],
+                              ko_index: Dict[str, List[Tuple[str, str]]], engine: str = "graph",
+                              expression_dag: Optional[ExpressionDAG] = None) \
+        -> Tuple[Dict[str, Dict[str, Union[str, List[str], List[str]]]], Dict[str, List[str]]]:
+    # Completion of all compiled modules for the K terms of one sample, plus the hits per module
+    kegg_pathways = get_pathway_graphs(compiled_modules)
+    pathways_with_target_genes = find_in_which_pathway(eggnog_list, kegg_pathways, ko_index)
+    if engine == "dp":
+        completion_of_all_pathways = compute_completion_of_all_pathways_dp(compiled_modules, pathways_with_target_genes, expression_dag)
+    else:
+        completion_of_all_pathways = compute_completion_of_all_pathways(kegg_pathways, pathways_with_target_genes)
+    return completion_of_all_pathways, pathways_with_target_genes
+
+
+def process_sample(eggnogfile_path: Path, out_path: Path, compiled_modules: Dict[str, Dict[str, object]],
+                   ko_index: Dict[str, List[Tuple[str, str]]], engine: str = "graph",
+                   expression_dag: Optional[ExpressionDAG] = None,
+                   profiler: Optional[PhaseProfiler] = None, store_kterms: bool = False) -> Dict[str, Dict[str, Union[str, List[str], List[str]]]]:
+    """
+    Runs the completion estimation for a single eggnog file and writes its table to out_path. engine is either
+    "graph" (shortest path through the present genes) or "dp" (exact best completion over the definition tree,
+    evaluated through the shared expression DAG if given). With store_kterms the K terms of the sample are also
+    written next to the table (input.kos.npz), so the table can be refreshed after a module database update.
+    Returns the completion of all the modules.
+    """
+    print(f"Parsing the eggnog file {eggnogfile_path}")
+    with profile_phase(profiler, "ko_parse"):
+        eggnog_list = read_sample_kos(eggnogfile_path, out_path.parent if store_kterms else None)
+
+    print("Estimating completion")
+    with profile_phase(profiler, "completion"):
+        completion_of_all_pathways, pathways_with_target_genes = compute_sample_completion(eggnog_list, compiled_modules, ko_index,
+                                                                                           engine, expression_dag)
+
+    print("Writing to a table")
+    with profile_phase(profiler, "write"):
+        completion_df = convert_completion_dict_to_df(completion_of_all_pathways)
+
+        print(f"Saving results to {out_path}")
+        completion_df.to_csv(out_path, sep="\t", index=True)
+    profile_count(profiler, "samples", 1)
+    profile_count(profiler, "kterms", len(eggnog_list))
+    profile_count(profiler, "modules_with_hits", len(pathways_with_target_genes))
+    return completion_of_all_pathways
+
+
+def init_batch_worker(compiled_modules: Dict[str, Dict[str, object]], ko_index: Dict[str, List[Tuple[str, str]]], engine: str,
+                      expression_dag: Optional[ExpressionDAG] = None, store_kterms: bool = False):
+    # With the fork start method the compiled modules are inherited copy-on-write instead of being pickled
+    global _batch_compiled_modules, _batch_ko_index, _batch_engine, _batch_expression_dag, _batch_store_kterms
+    _batch_compiled_modules = compiled_modules
+    _batch_ko_index = ko_index
+    _batch_expression_dag = expression_dag
+    _batch_engine = engine
+    _batch_store_kterms = store_kterms
+
+
+def run_batch_sample(paths: Tuple[Path, Path], profiler: Optional[PhaseProfiler] = None):
+    eggnogfile_path, out_path = paths
+    try:
+        completion = process_sample(eggnogfile_path, out_path, _batch_compiled_modules, _batch_ko_index, _batch_engine,
+                                    _batch_expression_dag, profiler, _batch_store_kterms)
+    except Exception as e:
+        print(f"Error, failed to process {eggnogfile_path}: {e!r}")
+        return eggnogfile_path, None
+    return eggnogfile_path, completion
+
+
+def run_batch(eggnog_paths: List[Path], out_dir: Path, compiled_modules: Dict[str, Dict[str, object]],
+              ko_index: Dict[str, List[Tuple[str, str]]], threads: int = 1, engine: str = "graph",
+              expression_dag: Optional[ExpressionDAG] = None, profiler: Optional[PhaseProfiler] = None,
+              store_kterms: bool = False) -> pd.DataFrame:
+    """
+    Processes all eggnog files, writing one completion table per sample into out_dir, using a pool of threads
+    worker processes. Returns the merged modules x samples completion matrix of the samples that succeeded.
+    The phases of the samples are only profiled when they run in this process (threads 1), otherwise only the
+    time of the whole batch is recorded.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    jobs = [(p, out_dir / f"{get_input_name(p)}_KEGG_completion.tsv") for p in eggnog_paths]
+
+    init_batch_worker(compiled_modules, ko_index, engine, expression_dag, store_kterms)
+    if threads > 1 and len(jobs) > 1:
+        if "fork" in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context("fork")
+        else:
+            mp_context = multiprocessing.get_context()
+        with profile_phase(profiler, "batch_samples"):
+            with mp_context.Pool(processes=threads, initializer=init_batch_worker, initargs=(compiled_modules, ko_index, engine, expression_dag, store_kterms)) as pool:
+                results = pool.map(run_batch_sample, jobs, chunksize=1)
+    else:
+        results = [run_batch_sample(job, profiler) for job in jobs]
+
+    sample_completions = dict()
+    failed = []
+    for eggnogfile_path, completion in results:
+        if completion is None:
+            failed.append(eggnogfile_path)
+        else:
+            sample_completions[get_sample_name(eggnogfile_path)] = completion
+    if failed:
+        print(f"{len(failed)} of {len(jobs)} samples failed:")
+        for p in failed:
+            print(f"  {p}")
+    return convert_completion_dicts_to_matrix(sample_completions, list(compiled_modules.keys()))
+
+
+def run_cohort(eggnog_paths: List[Path], compiled_modules: Dict[str, Dict[str, object]],
+               expression_dag: Optional[ExpressionDAG] = None, profiler: Optional[PhaseProfiler] = None,
+               store_dir: Optional[Path] = None) -> pd.DataFrame:
+    """
+    Cohort engine: scores all samples at once with the vectorized dp engine. Only returns the modules x samples
+    completion matrix, no per-sample tables with pathways are written. If store_dir is given, the K terms of every
+    sample are stored in it.
+    """
+    sample_names = []
+    sample_ko_sets = []
+    failed = []
+    for eggnogfile_path in eggnog_paths:
+        print(f"Parsing the eggnog file {eggnogfile_path}")
+        try:
+            with profile_phase(profiler, "ko_parse"):
+                ko_set = read_sample_kos(eggnogfile_path, store_dir)
+        except Exception as e:
+            print(f"Error, failed to process {eggnogfile_path}: {e!r}")
+            failed.append(eggnogfile_path)
+            continue
+        sample_ko_sets.append(ko_set)
+        sample_names.append(get_sample_name(eggnogfile_path))
+    if failed:
+        print(f"{len(failed)} of {len(eggnog_paths)} samples failed:")
+        for p in failed:
+            print(f"  {p}")
+
+    print(f"Estimating completion of {len(compiled_modules)} modules for {len(sample_names)} samples")
+    module_names = list(compiled_modules.keys())
+    with profile_phase(profiler, "completion"):
+        completion = compute_cohort_completion({k: compiled_modules[k]["parsed"] for k in module_names}, sample_ko_sets,
+                                               expression_dag)
+    profile_count(profiler, "samples", len(sample_names))
+    profile_count(profiler, "kterms", sum(len(ko_set) for ko_set in sample_ko_sets))
+    completion_matrix = pd.DataFrame(completion.T, index=[k.split(" ")[0] for k in module_names], columns=sample_names)
+    completion_matrix.insert(0, "description", module_names)
+    completion_matrix.index.names = ["module"]
+    return completion_matrix
+
+
+######################### Refresh after a module database update
+
+MATRIX_NAME = "KEGGstand_completion_matrix.tsv"
+TABLE_SUFFIX = "_KEGG_completion.tsv"
+
+
+def hash_module_definition(definitions: List[str]) -> str:
+    return hashlib.sha256("\n".join(definitions).encode()).hexdigest()
+
+
+def diff_module_dbs(old_modules: Dict[str, List[str]], new_modules: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    """
+    Compares two module databases (as read by KEGG_module_reader) by module ID and definition hash. Returns the
+    module IDs that were added, removed, changed (different definition) or renamed (same definition, new name).
+    """
+    old_by_id = {k.split(" ")[0]: (k, hash_module_definition(defs)) for k, defs in old_modules.items()}
+    diff = {"added": [], "removed": [], "changed": [], "renamed": []}
+    new_ids = set()
+    for k, defs in new_modules.items():
+        module_id = k.split(" ")[0]
+        new_ids.add(module_id)
+        if module_id not in old_by_id:
+            diff["added"].append(module_id)
+            continue
+        old_name, old_hash = old_by_id[module_id]
+        if old_hash != hash_module_definition(defs):
+            diff["changed"].append(module_id)
+        elif old_name != k:
+            diff["renamed"].append(module_id)
+    diff["removed"] = [module_id for module_id in old_by_id if module_id not in new_ids]
+    return diff
+
+
+def load_sample_kos(sample_name: str, ko_stores: Dict[str, Path], eggnog_paths: List[Path]) -> Optional[Set[str]]:
+    """
+    K terms of a sample for a refresh: its binary K term store in ko_stores (sample name -> store) if there is one,
+    otherwise the first of eggnog_paths that exists. Returns None if neither is available.
+    """
+    if sample_name in ko_stores:
+        return read_ko_set(ko_stores[sample_name])
+    for eggnogfile_path in eggnog_paths:
+        if eggnogfile_path.is_file():
+            print(f"No stored K terms for {sample_name}, parsing the eggnog file {eggnogfile_path}")
+            return read_ko_set(eggnogfile_path)
+    return None
+
+
+def patch_completion_table(table_path: Path, recomputed: Dict[str, Dict[str, Union[str, List[str], List[str]]]],
+                           module_names: Dict[str, str]):
+    """
+    Replaces the rows of the recomputed modules in a per-sample completion table. module_names maps every module ID
+    of the new database to its name, in database order: rows of removed modules are dropped, the descriptions of the
+    other modules are updated and the rows are put in database order, as in a full run.
+    """
+    # Read as text, so the unchanged rows are written back exactly as they were
+    table = pd.read_csv(table_path, sep="\t", index_col=0, dtype=str, keep_default_na=False)
+    rows = table.to_dict(orient="index")
+    for k_id in recomputed:
+        rows.pop(k_id.split(" ")[0], None)
+    for module_id, row in convert_completion_dict_to_df(recomputed).to_dict(orient="index").items():
+        row["completion"] = str(row["completion"])
+        rows[module_id] = row
+    patched_rows = dict()
+    for module_id, name in module_names.items():
+        if module_id in rows:
+            patched_rows[module_id] = rows[module_id]
+            patched_rows[module_id]["description"] = name
+    completion_df = pd.DataFrame.from_dict(patched_rows, orient="index")
+    completion_df.index.names = ["module"]
+    completion_df.to_csv(table_path, sep="\t", index=True)
+
+
+def patch_completion_matrix(matrix_path: Path, recomputed: Dict[str, Dict[str, Dict[str, Union[str, List[str], List[str]]]]],
+                            recomputed_modules: List[str], module_names: Dict[str, str]):
+    """
+    Replaces the rows of the recomputed modules (recomputed_modules, the added and changed modules) in a modules x
+    samples completion matrix. recomputed holds their completion per sample column, samples that could not be
+    recomputed get empty values.
+    """
+    matrix = pd.read_csv(matrix_path, sep="\t", index_col=0, dtype=str, keep_default_na=False)
+    rows = matrix.to_dict(orient="index")
+    for k_id in recomputed_modules:
+        rows[k_id.split(" ")[0]] = {sample_name: str(recomputed[sample_name][k_id]["completion"]) if sample_name in recomputed else ""
+                                    for sample_name in matrix.columns if sample_name != "description"}
+    patched_rows = dict()
+    for module_id, name in module_names.items():
+        if module_id in rows:
+            patched_rows[module_id] = {**rows[module_id], "description": name}
+    completion_matrix = pd.DataFrame.from_dict(patched_rows, orient="index", columns=list(matrix.columns))
+    completion_matrix.index.names = ["module"]
+    completion_matrix.to_csv(matrix_path, sep="\t", index=True)
+
+
+def refresh_outputs(old_mod_path: Path, mod_path: Path, out_path: Path, eggnog_paths: List[Path], engine: str = "graph",
+                    profiler: Optional[PhaseProfiler] = None) \
+        -> Tuple[Dict[str, Dict[str, object]], Dict[str, List[Tuple[str, str]]], Optional[ExpressionDAG]]:
+    """
+    Updates existing outputs after a module database update, recomputing only the modules that were added or whose
+    definition changed. out_path is a per-sample completion table, a completion matrix, or a batch output directory
+    (all *_KEGG_completion.tsv tables and the completion matrix in it are updated). The K terms of every sample are
+    read from its stored K term set (--store_kterms), otherwise from its eggnog file: one of eggnog_paths or the
+    file the table was named after, next to the table. A single table refreshed with a single eggnog file (-e) is
+    taken to be the table of that eggnog file, whatever the name of the table. The matrix rows of the recomputed
+    modules are empty for samples without K terms, and if no sample has any, FileNotFoundError is raised after the
+    outputs were updated.
+    Returns the compiled modules, KO index and expression DAG (dp engine only) of the recomputed modules.
+    """
+    with profile_phase(profiler, "module_db_read"):
+        old_modules = KEGG_module_reader(old_mod_path)
+        new_modules = KEGG_module_reader(mod_path)
+    diff = diff_module_dbs(old_modules, new_modules)
+    for change, module_ids in diff.items():
+        print(f"{len(module_ids)} modules {change}: {' '.join(module_ids)}")
+    module_names = {k.split(" ")[0]: k for k in new_modules}
+    recompute_ids = set(diff["added"]) | set(diff["changed"])
+    compiled_modules, ko_index, expression_dag = compile_module_db_subset(
+        {k: defs for k, defs in new_modules.items() if k.split(" ")[0] in recompute_ids}, engine, profiler)
+    profile_count(profiler, "modules_recomputed", len(compiled_modules))
+
+    if out_path.is_dir():
+        table_paths = sorted(out_path.glob(f"*{TABLE_SUFFIX}"))
+        matrix_path = out_path / MATRIX_NAME if (out_path / MATRIX_NAME).is_file() else None
+    elif out_path.name == MATRIX_NAME:
+        table_paths, matrix_path = [], out_path
+    else:
+        table_paths, matrix_path = [out_path], None
+    store_dir = out_path if out_path.is_dir() else out_path.parent
+    ko_stores = {get_sample_name(p): p for p in store_dir.glob(f"*{KO_STORE_SUFFIX}")}
+    eggnog_by_sample = {get_sample_name(p): p for p in eggnog_paths}
+
+    sample_completions = dict()
+    failed = []
+
+    def recompute_sample(sample_name: str, extra_eggnog_paths: List[Path]):
+        if sample_name in sample_completions or sample_name in failed:
+            return
+        candidates = ([eggnog_by_sample[sample_name]] if sample_name in eggnog_by_sample else []) + extra_eggnog_paths
+        with profile_phase(profiler, "ko_parse"):
+            ko_set = load_sample_kos(sample_name, ko_stores, candidates)
+        if ko_set is None:
+            print(f"Error, no stored K terms or eggnog file found for {sample_name}")
+            failed.append(sample_name)
+            return
+        with profile_phase(profiler, "completion"):
+            sample_completions[sample_name] = compute_sample_completion(ko_set, compiled_modules, ko_index, engine,
+                                                                        expression_dag)[0]
+        profile_count(profiler, "samples", 1)
+
+    if not out_path.is_dir() and matrix_path is None and len(eggnog_paths) == 1:
+        # The table was written from this eggnog file (-e), so it is its sample. Its stored K terms are next to the
+        # table (--store_kterms), or next to the eggnog file (KEGGstand_ko_store.py)
+        eggnogfile_path = eggnog_paths[0]
+        table_samples = {out_path: get_sample_name(eggnogfile_path)}
+        ko_store_path = eggnogfile_path.with_name(ko_store_name(eggnogfile_path))
+        if ko_store_path.is_file():
+            ko_stores.setdefault(table_samples[out_path], ko_store_path)
+    else:
+        table_samples = {table_path: get_sample_name(table_path) for table_path in table_paths}
+
+    for table_path in table_paths:
+        sample_name = table_samples[table_path]
+        # Tables written next to their eggnog file are named sample.emapper.annotations_KEGG_completion.tsv
+        eggnog_name = table_path.name[:-len(TABLE_SUFFIX)] if table_path.name.endswith(TABLE_SUFFIX) else None
+        recompute_sample(sample_name, [table_path.with_name(eggnog_name + suffix) for suffix in ("",) + COMPRESSION_SUFFIXES]
+                         if eggnog_name else [])
+        if sample_name in failed:
+            print(f"Leaving {table_path} unchanged")
+            continue
+        print(f"Updating {table_path}")
+        with profile_phase(profiler, "write"):
+            patch_completion_table(table_path, sample_completions[sample_name], module_names)
+    if matrix_path is not None:
+        for sample_name in pd.read_csv(matrix_path, sep="\t", index_col=0, nrows=0).columns[1:]:
+            recompute_sample(sample_name, [])
+        print(f"Updating {matrix_path}")
+        with profile_phase(profiler, "matrix_write"):
+            patch_completion_matrix(matrix_path, sample_completions, list(compiled_modules), module_names)
+    if failed:
+        print(f"{len(failed)} samples could not be refreshed:")
+        for sample_name in failed:
+            print(f"  {sample_name}")
+        if not sample_completions:
+            raise FileNotFoundError(f"No stored K terms or eggnog file found for any sample of {out_path}")
+    return compiled_modules, ko_index, expression_dag
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    # prog is fixed, so usage errors of jobs run by KEGGstand_daemon.py name this script
+    parser = argparse.ArgumentParser(prog="KEGGstand_module_checker.py", description="Estimate completion of the modules")
     parser.add_argument("-m", help="Path to the module file", required=True, dest="mod_path", type=Path)
-    parser.add_argument("-e", help="Path to the eggnog file", required=True, dest="eggnogfile_path", type=Path)
-    parser.add_argument("-o", help="Path to the output tsv table", required=True, dest="out_path", type=Path)
-    args = parser.parse_args()
-    return args.mod_path, args.eggnogfile_path, args.out_path
+    inputs = parser.add_mutually_exclusive_group()
+    inputs.add_argument("-e", help="Path to the eggnog file", dest="eggnogfile_path", type=Path)
+    inputs.add_argument("-b", "--batch", help="Batch mode: directory of *.emapper.annotations files, a manifest file "
+                                              "listing one eggnog file per line, or a quoted glob pattern", dest="batch_input")
+    parser.add_argument("-o", help="Path to the output tsv table (batch mode: path to the output directory)",
+                        required=True, dest="out_path", type=Path)
+    parser.add_argument("--store_kterms", help="Also store the K terms of every sample next to its output, as a binary K term "
+                                               "store (input.kos.npz, see KEGGstand_ko_store.py) that can be used as input instead "
+                                               "of the eggnog file, "
+                                               "so the output can be refreshed after a module database update",
+                        dest="store_kterms", action="store_true")
+    parser.add_argument("--refresh", help="Update the existing output table, matrix or batch output directory given with -o "
+                                          "after a module database update: path to the old module file, -m is the new one. "
+                                          "Only added and changed modules are recomputed. -e/-b optionally give the eggnog "
+                                          "files of samples without stored K terms", dest="old_mod_path", type=Path, default=None)
+    parser.add_argument("-t", "--threads", help="Number of samples processed in parallel in batch mode",
+                        dest="threads", type=int, default=1)
+    parser.add_argument("--engine", help="Completion engine: graph (shortest path through the present genes), dp "
+                                         "(exact best completion over the module definition) or cohort (dp for all "
+                                         "samples at once, batch mode only, writes only the completion matrix)",
+                        dest="engine", choices=["graph", "dp", "cohort"], default="graph")
+    parser.add_argument("-c", "--cache", help="Path to the compiled module artifact (default: next to the module file)",
+                        dest="cache_path", type=Path, default=None)
+    parser.add_argument("--no_cache", help="Always parse the module file, do not read or write the compiled artifact",
+                        dest="no_cache", action="store_true")
+    parser.add_argument("--sharing_report", help="Write a tsv table of the definition groups shared between modules",
+                        dest="sharing_report_path", type=Path, default=None)
+    parser.add_argument("--profile", help="Record the time and memory use of every phase in a json file next to the output "
+                                          "table (*.profile.json)", dest="profile", action="store_true")
+    parser.add_argument("--cprofile", help="Also write a cProfile dump of the run next to the output table (*.cprofile.prof), "
+                                           "which can be inspected with pstats or snakeviz", dest="cprofile", action="store_true")
+    args = parser.parse_args(argv)
+    if args.old_mod_path is None and args.eggnogfile_path is None and args.batch_input is None:
+        parser.error("one of the arguments -e -b/--batch --refresh is required")
+    if args.engine == "cohort" and args.old_mod_path is not None:
+        parser.error("--refresh recomputes with the graph or dp engine, use --engine dp for a cohort completion matrix")
+    if args.engine == "cohort" and args.batch_input is None:
+        parser.error("--engine cohort can only be used in batch mode (-b)")
+    return args
 
 
 def resolve_rel_path_list(path_list: List[Path]):
@@ -561,25 +1073,88 @@ def resolve_rel_path_list(path_list: List[Path]):
     return res_paths
 
 
-def main():
-    mod_path, eggnogfile_path, out_path = parse_args()
-    mod_path, eggnogfile_path, out_path = resolve_rel_path_list([mod_path, eggnogfile_path, out_path])
-    print(f"Parsing the module list from {mod_path}")
-    kegg_modules = KEGG_module_reader(mod_path)
-    kegg_pathways = process_all_kegg_modules_to_pathways(kegg_modules)
-
-    print(f"Parsing the eggnog file {eggnogfile_path}")
-    eggnog_list = eggnog_parser(eggnogfile_path)
-
-    print("Estimating completion")
-    pathways_with_target_genes = find_in_which_pathway(eggnog_list, kegg_pathways)
-    completion_of_all_pathways = compute_completion_of_all_pathways(kegg_pathways, pathways_with_target_genes)
-
-    print("Writing to a table")
-    completion_df = convert_completion_dict_to_df(completion_of_all_pathways)
-
-    print(f"Saving results to {out_path}")
-    completion_df.to_csv(out_path, sep="\t", index=True)
+def write_profile(profiler: PhaseProfiler, profile_path: Path, args: argparse.Namespace,
+                  compiled_modules: Dict[str, Dict[str, object]], ko_index: Dict[str, List[Tuple[str, str]]],
+                  expression_dag: Optional[ExpressionDAG]):
+    # In refresh mode the compiled modules are only the recomputed ones
+    profiler.count("modules", len(compiled_modules))
+    profiler.count("graph_nodes", sum(len(c["graph"]) for c in compiled_modules.values()))
+    profiler.count("module_kterms", len(ko_index))
+    if expression_dag is not None:
+        profiler.count("expression_dag_nodes", len(expression_dag))
+    metadata = {"script": Path(__file__).name,
+                "date": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "module_file": str(args.mod_path),
+                "input": str(args.eggnogfile_path if args.batch_input is None else args.batch_input),
+                "engine": args.engine,
+                "threads": args.threads}
+    if args.old_mod_path is not None:
+        metadata["refreshed_from"] = str(args.old_mod_path)
+    print(f"Saving profile to {profile_path}")
+    write_json(profile_path, profiler.to_dict(), metadata)
+
+
+def collect_refresh_inputs(args: argparse.Namespace) -> List[Path]:
+    # Eggnog files of the samples without stored K terms, optional in refresh mode
+    if args.eggnogfile_path is not None:
+        return [args.eggnogfile_path.resolve()]
+    if args.batch_input is not None:
+        return collect_batch_inputs(args.batch_input)
+    return []
+
+
+def main(argv: Optional[List[str]] = None, load_modules=load_or_compile_modules):
+    # argv and load_modules are replaced by KEGGstand_daemon.py, which runs the checker on modules it already compiled
+    args = parse_args(argv)
+    mod_path, out_path = resolve_rel_path_list([args.mod_path, args.out_path])
+    cache_path = args.cache_path.resolve() if args.cache_path is not None else None
+    profiler = PhaseProfiler() if args.profile else None
+    cprofiler = None
+    if args.cprofile:
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+
+    if args.old_mod_path is not None:
+        print(f"Refreshing {out_path} from {args.old_mod_path} to {mod_path}")
+        compiled_modules, ko_index, expression_dag = refresh_outputs(args.old_mod_path.resolve(), mod_path, out_path,
+                                                                     collect_refresh_inputs(args), args.engine, profiler)
+        table_path = out_path / MATRIX_NAME if out_path.is_dir() else out_path
+    else:
+        print(f"Parsing the module list from {mod_path}")
+        compiled_modules, ko_index, expression_dag = load_modules(mod_path, cache_path, use_cache=not args.no_cache,
+                                                                  profiler=profiler)
+        if args.sharing_report_path is not None:
+            write_sharing_report(expression_dag, args.sharing_report_path.resolve())
+
+        if args.batch_input is None:
+            eggnogfile_path = args.eggnogfile_path.resolve()
+            process_sample(eggnogfile_path, out_path, compiled_modules, ko_index, args.engine, expression_dag, profiler,
+                           args.store_kterms)
+            table_path = out_path
+        else:
+            eggnog_paths = collect_batch_inputs(args.batch_input)
+            if args.engine == "cohort":
+                out_path.mkdir(parents=True, exist_ok=True)
+                completion_matrix = run_cohort(eggnog_paths, compiled_modules, expression_dag, profiler,
+                                               out_path if args.store_kterms else None)
+            else:
+                print(f"Processing {len(eggnog_paths)} eggnog files with {args.threads} processes")
+                completion_matrix = run_batch(eggnog_paths, out_path, compiled_modules, ko_index, args.threads, args.engine,
+                                              expression_dag, profiler, args.store_kterms)
+            table_path = out_path / MATRIX_NAME
+            print(f"Saving completion matrix to {table_path}")
+            with profile_phase(profiler, "matrix_write"):
+                completion_matrix.to_csv(table_path, sep="\t", index=True)
+
+    if cprofiler is not None:
+        cprofiler.disable()
+        cprofile_path = sidecar_path(table_path, ".cprofile.prof")
+        print(f"Saving cProfile dump to {cprofile_path}")
+        cprofiler.dump_stats(cprofile_path)
+    if profiler is not None:
+        write_profile(profiler, sidecar_path(table_path, ".profile.json"), args, compiled_modules, ko_index, expression_dag)
     print("Done")
 
 
@@ -0,0 +1,193 @@
+"""
+Compact graph representation of a single KEGG module, used by KEGGstand_module_checker.py.
+
+Module graphs are small (usually fewer than 50 nodes), so instead of a networkx.DiGraph every module is stored as
+integer node ids with CSR (compressed sparse row) successor and predecessor arrays, a bitmask of the optional nodes
+and a precomputed topological order.
+
+Node ids, neighbour order and the shortest path search follow networkx exactly (node insertion order,
+edge insertion order and the bidirectional breadth first search of nx.shortest_path), so the pathways found
+are identical to the ones found with the networkx graphs.
+"""
+import sys
+from array import array
+from typing import Dict, List, Iterable, Tuple
+
+
+_UNSEEN = -2
+_NONE = -1
+
+
+class NoPathError(ValueError):
+    """
+    Raised when there is no path between two nodes of a module graph.
+    """
+
+
+def _build_csr(num_nodes: int, edges: List[Tuple[int, int]]) -> Tuple[array, array]:
+    # Edges are already deduplicated and in insertion order, so the neighbour order per node is kept
+    counts = [0] * (num_nodes + 1)
+    for src, _ in edges:
+        counts[src + 1] += 1
+    for i in range(num_nodes):
+        counts[i + 1] += counts[i]
+    indptr = array("i", counts)
+    indices = array("i", [0] * len(edges))
+    fill = counts[:-1]
+    for src, dst in edges:
+        indices[fill[src]] = dst
+        fill[src] += 1
+    return indptr, indices
+
+
+class ModuleGraph:
+    """
+    Directed graph of a KEGG module with BEGIN and END nodes.
+
+    node_names: node name per node id, in networkx node insertion order
+    succ_indptr, succ_indices: CSR arrays of the successors of each node
+    pred_indptr, pred_indices: CSR arrays of the predecessors of each node
+    optional_mask: bit i is set if node i is an optional (non-essential) gene
+    topo_order: node ids in topological order, empty if the graph has a cycle (a K term used at two steps)
+    """
+    __slots__ = ("node_names", "node_ids", "succ_indptr", "succ_indices", "pred_indptr", "pred_indices",
+                 "optional_mask", "topo_order", "topo_rank")
+
+    def __init__(self, edges: Iterable[Tuple[str, str]], node_optional: Dict[str, bool]):
+        node_ids = dict()
+        id_edges = []
+        seen_edges = set()
+        for src, dst in edges:
+            for node in (src, dst):
+                if node not in node_ids:
+                    # K terms recur across modules, interning lets all module graphs share one copy of each name
+                    node_ids[sys.intern(node)] = len(node_ids)
+            id_edge = (node_ids[src], node_ids[dst])
+            if id_edge not in seen_edges:
+                seen_edges.add(id_edge)
+                id_edges.append(id_edge)
+
+        num_nodes = len(node_ids)
+        self.node_names = tuple(node_ids)
+        self.node_ids = node_ids
+        self.succ_indptr, self.succ_indices = _build_csr(num_nodes, id_edges)
+        self.pred_indptr, self.pred_indices = _build_csr(num_nodes, [(dst, src) for src, dst in id_edges])
+
+        optional_mask = 0
+        for node, node_id in node_ids.items():
+            if node_optional.get(node, False):
+                optional_mask |= 1 << node_id
+        self.optional_mask = optional_mask
+
+        self.topo_order = self._topological_order()
+        topo_rank = array("i", [0] * num_nodes)
+        for rank, node_id in enumerate(self.topo_order):
+            topo_rank[node_id] = rank
+        self.topo_rank = topo_rank if len(self.topo_order) == num_nodes else array("i")
+
+    def __contains__(self, node_name: str) -> bool:
+        return node_name in self.node_ids
+
+    def __len__(self) -> int:
+        return len(self.node_names)
+
+    def successors(self, node_id: int):
+        return self.succ_indices[self.succ_indptr[node_id]:self.succ_indptr[node_id + 1]]
+
+    def predecessors(self, node_id: int):
+        return self.pred_indices[self.pred_indptr[node_id]:self.pred_indptr[node_id + 1]]
+
+    def is_optional(self, node_id: int) -> bool:
+        return bool(self.optional_mask >> node_id & 1)
+
+    def _topological_order(self) -> array:
+        # Kahn's algorithm, returns an empty array if the graph is not acyclic
+        num_nodes = len(self.node_names)
+        in_degree = [self.pred_indptr[i + 1] - self.pred_indptr[i] for i in range(num_nodes)]
+        queue = [i for i in range(num_nodes) if in_degree[i] == 0]
+        order = []
+        while queue:
+            node_id = queue.pop(0)
+            order.append(node_id)
+            for succ_id in self.successors(node_id):
+                in_degree[succ_id] -= 1
+                if in_degree[succ_id] == 0:
+                    queue.append(succ_id)
+        if len(order) != num_nodes:
+            return array("i")
+        return array("i", order)
+
+    def shortest_path(self, source: int, target: int) -> List[int]:
+        """
+        Shortest path from source to target as a list of node ids. Port of the networkx bidirectional breadth
+        first search, so ties between equally short paths are broken the same way as nx.shortest_path.
+        """
+        if source == target:
+            return [source]
+        # In an acyclic graph nothing is reachable from a node that comes later in the topological order
+        if self.topo_rank and self.topo_rank[target] < self.topo_rank[source]:
+            raise NoPathError(f"No path between {self.node_names[source]} and {self.node_names[target]}.")
+
+        succ_indptr, succ_indices = self.succ_indptr, self.succ_indices
+        pred_indptr, pred_indices = self.pred_indptr, self.pred_indices
+        pred = [_UNSEEN] * len(self.node_names)
+        succ = [_UNSEEN] * len(self.node_names)
+        pred[source] = _NONE
+        succ[target] = _NONE
+        forward_fringe = [source]
+        reverse_fringe = [target]
+        meet = _NONE
+        while forward_fringe and reverse_fringe and meet == _NONE:
+            if len(forward_fringe) <= len(reverse_fringe):
+                this_level = forward_fringe
+                forward_fringe = []
+                for v in this_level:
+                    for w in succ_indices[succ_indptr[v]:succ_indptr[v + 1]]:
+                        if pred[w] == _UNSEEN:
+                            forward_fringe.append(w)
+                            pred[w] = v
+                        if succ[w] != _UNSEEN:
+                            meet = w
+                            break
+                    if meet != _NONE:
+                        break
+            else:
+                this_level = reverse_fringe
+                reverse_fringe = []
+                for v in this_level:
+                    for w in pred_indices[pred_indptr[v]:pred_indptr[v + 1]]:
+                        if succ[w] == _UNSEEN:
+                            succ[w] = v
+                            reverse_fringe.append(w)
+                        if pred[w] != _UNSEEN:
+                            meet = w
+                            break
+                    if meet != _NONE:
+                        break
+        if meet == _NONE:
+            raise NoPathError(f"No path between {self.node_names[source]} and {self.node_names[target]}.")
+
+        path = []
+        w = meet
+        while w != _NONE:
+            path.append(w)
+            w = pred[w]
+        path.reverse()
+        w = succ[path[-1]]
+        while w != _NONE:
+            path.append(w)
+            w = succ[w]
+        return path
+
+    def to_networkx(self):
+        """
+        Converts the module graph to a networkx.DiGraph with the 'is_optional' node attribute, e.g. for plotting.
+        """
+        import networkx as nx
+        G = nx.DiGraph()
+        for node_id, node_name in enumerate(self.node_names):
+            G.add_node(node_name, is_optional=self.is_optional(node_id))
+        for node_id, node_name in enumerate(self.node_names):
+            for succ_id in self.successors(node_id):
+                G.add_edge(node_name, self.node_names[succ_id])
+        return G
@@ -0,0 +1,132 @@
+"""
+Per-phase timing and memory measurements, used by KEGGstand_benchmark.py and the --profile option of
+KEGGstand_module_checker.py and KEGGstand_BRITE_checker.py.
+
+Every phase of a run (e.g. parsing the module database, building the graphs, estimating completion) is recorded with
+its wall time, CPU time and peak resident memory (RSS). On Linux the peak RSS is reset at the start of every phase
+(through /proc/self/clear_refs), so it is the peak of that phase only. Elsewhere it is the peak of the whole process
+up to the end of the phase. Optionally the peak of the Python allocations in the phase is traced with tracemalloc,
+which is exact per phase but slows the run down.
+"""
+import json
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+_CLEAR_REFS_PATH = "/proc/self/clear_refs"
+_STATUS_PATH = "/proc/self/status"
+
+
+def reset_peak_rss() -> bool:
+    """
+    Resets the peak RSS of this process (Linux only). Returns False if this is not possible.
+    """
+    try:
+        with open(_CLEAR_REFS_PATH, "w") as s:
+            s.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def get_peak_rss_mb() -> float:
+    """
+    Peak RSS of this process in MB, since the last reset_peak_rss if that succeeded.
+    """
+    try:
+        with open(_STATUS_PATH, "r") as s:
+            for line in s:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kB elsewhere
+    if sys.platform == "darwin":
+        return max_rss / (1024 * 1024)
+    return max_rss / 1024
+
+
+class PhaseProfiler:
+    """
+    Records wall time, CPU time and peak memory per phase, plus counts of the processed items.
+
+    with profiler.phase("module_db_parse"):
+        ...
+    profiler.count("modules", len(modules))
+    """
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.phases: Dict[str, Dict[str, Union[float, bool]]] = dict()
+        self.counts: Dict[str, int] = dict()
+
+    @contextmanager
+    def phase(self, name: str):
+        rss_reset = reset_peak_rss()
+        if self.trace_memory:
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            record = {"wall_s": round(time.perf_counter() - wall_start, 6),
+                      "cpu_s": round(time.process_time() - cpu_start, 6),
+                      "peak_rss_mb": round(get_peak_rss_mb(), 3),
+                      "peak_rss_phase_only": rss_reset}
+            if self.trace_memory:
+                record["traced_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 3)
+            # A phase that is entered more than once (e.g. once per sample) accumulates its times
+            if name in self.phases:
+                previous = self.phases[name]
+                record["wall_s"] = round(record["wall_s"] + previous["wall_s"], 6)
+                record["cpu_s"] = round(record["cpu_s"] + previous["cpu_s"], 6)
+                record["peak_rss_mb"] = max(record["peak_rss_mb"], previous["peak_rss_mb"])
+                if self.trace_memory:
+                    record["traced_peak_mb"] = max(record["traced_peak_mb"], previous["traced_peak_mb"])
+            self.phases[name] = record
+
+    def count(self, name: str, value: int):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def stop(self):
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def to_dict(self) -> Dict[str, dict]:
+        total = {"wall_s": round(sum(p["wall_s"] for p in self.phases.values()), 6),
+                 "cpu_s": round(sum(p["cpu_s"] for p in self.phases.values()), 6),
+                 "peak_rss_mb": max((p["peak_rss_mb"] for p in self.phases.values()), default=0.0)}
+        return {"phases": self.phases, "total": total, "counts": self.counts}
+
+
+def profile_phase(profiler: Optional[PhaseProfiler], name: str):
+    # Context manager that records the phase if profiling is enabled, and does nothing otherwise
+    if profiler is None:
+        return nullcontext()
+    return profiler.phase(name)
+
+
+def profile_count(profiler: Optional[PhaseProfiler], name: str, value: int):
+    if profiler is not None:
+        profiler.count(name, value)
+
+
+def sidecar_path(out_path: Path, suffix: str) -> Path:
+    # Profiling output is written next to the output table, e.g. out.tsv -> out.tsv.profile.json
+    return out_path.with_name(out_path.name + suffix)
+
+
+def write_json(out_path: Path, data: dict, metadata: Optional[dict] = None):
+    if metadata is not None:
+        data = {"metadata": metadata, **data}
+    with open(out_path, "w") as s:
+        json.dump(data, s, indent=4)
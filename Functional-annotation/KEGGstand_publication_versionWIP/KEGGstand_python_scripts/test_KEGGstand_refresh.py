@@ -0,0 +1,86 @@
+"""
+Check of the refresh of a single completion table (KEGGstand_module_checker.py --refresh with -e), run with pytest.
+"""
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+import KEGGstand_module_checker as module_checker
+
+OLD_MODULES = """Module: M00001 Test module one
+Definition: K00001 (K00002,K00003) K00004
+Module: M00002 Test module two
+Definition: K00005 K00006
+"""
+NEW_MODULES = """Module: M00001 Test module one
+Definition: K00001 (K00002,K00003)
+Module: M00002 Test module two
+Definition: K00005 K00006
+"""
+ADDED_MODULE = """Module: M00003 Test module three
+Definition: K00005
+"""
+HEADER = "#query\tseed_ortholog\tKEGG_ko\n"
+GENES = ["g1\tx\tko:K00001\n", "g2\tx\tko:K00003\n", "g3\tx\t-\n", "g4\tx\tko:K00005,ko:K00006\n"]
+
+
+def write_inputs(tmp_path: Path):
+    (tmp_path / "old.txt").write_text(OLD_MODULES)
+    (tmp_path / "new.txt").write_text(NEW_MODULES)
+    eggnog_path = tmp_path / "S.emapper.annotations"
+    eggnog_path.write_text("## emapper-2.1\n" + HEADER + "".join(GENES))
+    return tmp_path / "old.txt", tmp_path / "new.txt", eggnog_path
+
+
+def score(mod_path: Path, eggnog_path: Path, out_path: Path, store_kterms: bool = False):
+    compiled_modules, ko_index, expression_dag = module_checker.load_or_compile_modules(mod_path, use_cache=False)
+    module_checker.process_sample(eggnog_path, out_path, compiled_modules, ko_index, "dp", expression_dag,
+                                  store_kterms=store_kterms)
+
+
+def score_batch(mod_path: Path, eggnog_path: Path, out_dir: Path, store_kterms: bool = False) -> Path:
+    compiled_modules, ko_index, expression_dag = module_checker.load_or_compile_modules(mod_path, use_cache=False)
+    out_dir.mkdir()
+    completion_matrix = module_checker.run_batch([eggnog_path], out_dir, compiled_modules, ko_index, 1, "dp", expression_dag,
+                                                 store_kterms=store_kterms)
+    completion_matrix.to_csv(out_dir / module_checker.MATRIX_NAME, sep="\t", index=True)
+    return out_dir / module_checker.MATRIX_NAME
+
+
+def test_refresh_single_table_from_eggnog_file(tmp_path):
+    old_path, new_path, eggnog_path = write_inputs(tmp_path)
+    score(old_path, eggnog_path, tmp_path / "result.tsv")
+    score(new_path, eggnog_path, tmp_path / "full.tsv")
+    assert (tmp_path / "result.tsv").read_text() != (tmp_path / "full.tsv").read_text()
+    # The table is not named after the sample, the eggnog file given with -e is its sample
+    module_checker.refresh_outputs(old_path, new_path, tmp_path / "result.tsv", [eggnog_path], "dp")
+    assert (tmp_path / "result.tsv").read_text() == (tmp_path / "full.tsv").read_text()
+
+
+def test_refresh_single_table_from_stored_kterms(tmp_path):
+    old_path, new_path, eggnog_path = write_inputs(tmp_path)
+    score(old_path, eggnog_path, tmp_path / "result.tsv", store_kterms=True)
+    score(new_path, eggnog_path, tmp_path / "full.tsv")
+    # Only the K terms stored next to the table are left
+    eggnog_path.unlink()
+    module_checker.refresh_outputs(old_path, new_path, tmp_path / "result.tsv", [eggnog_path], "dp")
+    assert (tmp_path / "result.tsv").read_text() == (tmp_path / "full.tsv").read_text()
+
+
+def test_refresh_matrix_without_kterms(tmp_path):
+    old_path, new_path, eggnog_path = write_inputs(tmp_path)
+    new_path.write_text(NEW_MODULES + ADDED_MODULE)
+    matrix_path = score_batch(old_path, eggnog_path, tmp_path / "result", store_kterms=True)
+    full_matrix_path = score_batch(new_path, eggnog_path, tmp_path / "full")
+    # Neither the stored K terms nor the eggnog file of the sample are left
+    eggnog_path.unlink()
+    for ko_store_path in (tmp_path / "result").glob(f"*{module_checker.KO_STORE_SUFFIX}"):
+        ko_store_path.unlink()
+    with pytest.raises(FileNotFoundError):
+        module_checker.refresh_outputs(old_path, new_path, matrix_path, [], "dp")
+    # The added and changed modules are still listed, without a completion for the sample
+    matrix = pd.read_csv(matrix_path, sep="\t", index_col=0, dtype=str, keep_default_na=False)
+    full_matrix = pd.read_csv(full_matrix_path, sep="\t", index_col=0, dtype=str, keep_default_na=False)
+    full_matrix.loc[["M00001", "M00003"], "S"] = ""
+    assert matrix.equals(full_matrix)